@@ -0,0 +1,192 @@
+"""
+基準測試用的 OpenAI 相容假服務
+
+提供 /v1/embeddings 與 /v1/chat/completions（含 stream），回應內容固定、延遲可設定，
+讓 rag-api、vector-generator 在不連外、不計費的情況下跑完整流程。
+
+向量沿用 rag-api embeddings.HashProvider（字元 bigram 雜湊後正規化）：相同文字得到相同向量，
+共用字詞的文字 cosine 較高，因此 kNN 結果有意義、可在不同次執行間比較；
+與 EMBEDDING_PROVIDER=hash 產生的向量一致。
+
+延遲設定（毫秒）：
+    FAKE_EMBEDDING_LATENCY_MS            每次 embeddings 呼叫的固定延遲
+    FAKE_EMBEDDING_LATENCY_PER_INPUT_MS  每筆輸入額外延遲（批次呼叫較慢）
+    FAKE_CHAT_LATENCY_MS                 chat 第一個 token 前的延遲
+    FAKE_CHAT_TOKEN_INTERVAL_MS          stream 模式每個 token 間隔
+    FAKE_LATENCY_JITTER                  延遲隨機浮動比例（0.1 = ±10%），以 FAKE_SEED 固定亂數序列
+
+用法：
+    python fake_openai.py            # 預設監聽 0.0.0.0:8090
+"""
+
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import sys
+import time
+import uuid
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Union
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+# 容器內 embeddings.py 位於 /scripts（PYTHONPATH），本機執行時取同層的 rag-api
+sys.path.append(str(Path(__file__).resolve().parent.parent / "rag-api"))
+from embeddings import HashProvider  # noqa: E402
+
+PORT = int(os.getenv("FAKE_OPENAI_PORT", "8090"))
+EMBEDDING_LATENCY_MS = float(os.getenv("FAKE_EMBEDDING_LATENCY_MS", "80"))
+EMBEDDING_LATENCY_PER_INPUT_MS = float(os.getenv("FAKE_EMBEDDING_LATENCY_PER_INPUT_MS", "2"))
+CHAT_LATENCY_MS = float(os.getenv("FAKE_CHAT_LATENCY_MS", "400"))
+CHAT_TOKEN_INTERVAL_MS = float(os.getenv("FAKE_CHAT_TOKEN_INTERVAL_MS", "20"))
+LATENCY_JITTER = float(os.getenv("FAKE_LATENCY_JITTER", "0.1"))
+SEED = int(os.getenv("FAKE_SEED", "42"))
+
+# 與 vector_service 的維度對應一致
+MODEL_DIMS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+DEFAULT_DIMS = 1536
+
+CANNED_ANSWER = (
+    "根據檢索到的文件，相關紀錄如下：{count} 份文件與查詢有關。"
+    "（此為基準測試假服務的固定回應，內容不代表實際分析。）"
+)
+
+app = FastAPI(title="Fake OpenAI", version="1.0.0")
+_rng = random.Random(SEED)
+
+
+async def _delay(ms: float):
+    if ms <= 0:
+        return
+    if LATENCY_JITTER > 0:
+        ms *= 1 + _rng.uniform(-LATENCY_JITTER, LATENCY_JITTER)
+    await asyncio.sleep(ms / 1000)
+
+
+# ==================== Embeddings ====================
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str]]
+    encoding_format: Optional[str] = None
+    dimensions: Optional[int] = None
+
+
+@lru_cache(maxsize=8)
+def _provider(dims: int) -> HashProvider:
+    return HashProvider(dims)
+
+
+def embed(text: str, dims: int) -> List[float]:
+    """字元 bigram 雜湊向量（與 EMBEDDING_PROVIDER=hash 相同）"""
+    return _provider(dims).embed([text])[0]
+
+
+def _dims_for(request: EmbeddingRequest) -> int:
+    if request.dimensions:
+        return request.dimensions
+    return MODEL_DIMS.get(request.model, 3072 if "3-large" in request.model else DEFAULT_DIMS)
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: EmbeddingRequest):
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    await _delay(EMBEDDING_LATENCY_MS + EMBEDDING_LATENCY_PER_INPUT_MS * len(texts))
+
+    dims = _dims_for(request)
+    data = []
+    for index, text in enumerate(texts):
+        vector = embed(text, dims)
+        if request.encoding_format == "base64":
+            # openai-python 未指定格式時預設要求 base64（float32 little-endian）
+            packed = struct.pack(f"<{len(vector)}f", *vector)
+            embedding = base64.b64encode(packed).decode("ascii")
+        else:
+            embedding = [round(v, 6) for v in vector]
+        data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+    tokens = sum(len(text) for text in texts)
+    return {
+        "object": "list",
+        "data": data,
+        "model": request.model,
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+# ==================== Chat ====================
+class ChatRequest(BaseModel):
+    model: str
+    messages: List[dict]
+    stream: bool = False
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+
+
+def _answer(request: ChatRequest) -> str:
+    prompt = "".join(str(m.get("content") or "") for m in request.messages)
+    return CANNED_ANSWER.format(count=prompt.count("文件"))
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatRequest):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+    answer = _answer(request)
+
+    if not request.stream:
+        await _delay(CHAT_LATENCY_MS + CHAT_TOKEN_INTERVAL_MS * len(answer))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": request.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(answer), "total_tokens": len(answer)},
+        }
+
+    def chunk(delta: dict, finish_reason: Optional[str] = None) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": request.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def events():
+        await _delay(CHAT_LATENCY_MS)
+        yield chunk({"role": "assistant", "content": ""})
+        for char in answer:
+            yield chunk({"content": char})
+            await _delay(CHAT_TOKEN_INTERVAL_MS)
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy"}
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="warning")
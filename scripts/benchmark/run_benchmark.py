@@ -0,0 +1,419 @@
+"""
+RAG API 負載測試 / 基準測試
+
+以固定並行數重播查詢組合（queries.jsonl），量測用戶端延遲 p50/p95/p99、吞吐量，
+並以 debug=true 取得伺服器端各階段耗時（metadata.stages_ms），輸出可互相比較的 JSON。
+若 rag-api 有 /metrics，另記錄測試期間每個請求平均的外部呼叫次數（ES / MySQL / OpenAI）。
+
+查詢組合每行一筆 JSON，除 weight（出現比例，預設 1）與 name（報表分組用）外，
+其餘欄位原樣作為 SearchRequest 送出，例如：
+    {"name": "product", "query": "01-B01 設變", "mode": "hybrid", "top_k": 5, "use_gpt": false}
+
+用法：
+    python run_benchmark.py --url http://localhost:8010 --concurrency 8 --requests 400
+    python run_benchmark.py --endpoint batch --batch-size 10 --requests 400
+    python run_benchmark.py --baseline logs/benchmark/before.json --max-regression 10
+
+--es-url 指定時，開始前會等到 erp-* 文件數穩定且全部都已產生向量
+（搭配 docker-compose.benchmark.yml 由假服務建立整套測試資料）。
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+SCHEMA_VERSION = 1
+DEFAULT_QUERIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.jsonl")
+_METRIC_LINE = re.compile(r'^rag_external_calls_total\{(?P<labels>[^}]*)\}\s+(?P<value>\S+)$')
+
+
+# ==================== 統計 ====================
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """線性內插百分位數"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    value = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return round(value, 1)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": round(sum(values) / len(values), 1) if values else None,
+        "max": round(max(values), 1) if values else None,
+    }
+
+
+# ==================== 查詢組合 ====================
+def load_queries(path: str) -> List[dict]:
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise SystemExit(f"{path}:{line_no} 不是有效的 JSON: {e}")
+            if not item.get("query"):
+                raise SystemExit(f"{path}:{line_no} 缺少 query")
+            queries.append(item)
+    if not queries:
+        raise SystemExit(f"{path} 沒有查詢")
+    return queries
+
+
+def build_schedule(queries: List[dict], total: int, seed: int) -> List[dict]:
+    """依 weight 展開後以固定種子洗牌，重複排到 total 筆；同設定每次順序相同"""
+    pool = []
+    for item in queries:
+        pool.extend([item] * max(1, int(item.get("weight", 1))))
+    rng = random.Random(seed)
+    schedule = []
+    while len(schedule) < total:
+        rng.shuffle(pool)
+        schedule.extend(pool)
+    return schedule[:total]
+
+
+def to_request_body(item: dict) -> dict:
+    body = {k: v for k, v in item.items() if k not in ("weight", "name")}
+    body.setdefault("use_gpt", False)
+    body["debug"] = True
+    return body
+
+
+# ==================== 準備 ====================
+async def wait_for_api(client: httpx.AsyncClient, url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await client.get(f"{url}/health", timeout=5)
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"等待 {url}/health 逾時")
+        await asyncio.sleep(2)
+
+
+async def wait_for_index(es_url: str, auth, pattern: str, timeout: float, settle: float):
+    """等到文件數 > 0、沒有缺向量的文件，且連續兩次輪詢文件數不變"""
+    deadline = time.monotonic() + timeout
+    previous = None
+    async with httpx.AsyncClient(auth=auth, timeout=10) as client:
+        while True:
+            try:
+                total = (await client.get(f"{es_url}/{pattern}/_count")).json()["count"]
+                missing = (
+                    await client.post(
+                        f"{es_url}/{pattern}/_count",
+                        json={"query": {"bool": {"must_not": {"exists": {"field": "content_vector"}}}}},
+                    )
+                ).json()["count"]
+                print(f"⏳ {pattern}: {total} 份文件，{missing} 份尚無向量")
+                if total > 0 and missing == 0 and total == previous:
+                    return total
+                previous = total if missing == 0 else None
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                print(f"⏳ 等待 Elasticsearch: {e}")
+            if time.monotonic() > deadline:
+                raise SystemExit(f"等待 {pattern} 建立完成逾時")
+            await asyncio.sleep(settle)
+
+
+async def scrape_external_calls(client: httpx.AsyncClient, url: str) -> Optional[Dict[str, float]]:
+    """讀取 rag_external_calls_total；/metrics 不可用時回傳 None"""
+    try:
+        response = await client.get(f"{url}/metrics", timeout=5)
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    counts = {}
+    for line in response.text.splitlines():
+        match = _METRIC_LINE.match(line)
+        if not match:
+            continue
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group("labels")))
+        counts[f"{labels.get('service')}.{labels.get('operation')}"] = float(match.group("value"))
+    return counts
+
+
+# ==================== 執行 ====================
+class Recorder:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.server_ms: List[float] = []
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+        self.by_name: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.error_samples: List[str] = []
+        self.cache_hits = 0
+        self.documents: List[int] = []
+
+    def ok(self, item: dict, latency_ms: float, result: dict):
+        self.latencies.append(latency_ms)
+        self.by_name[item.get("name") or item.get("mode", "hybrid")].append(latency_ms)
+        self.server_ms.append(result.get("search_time_ms", 0))
+        self.documents.append(result.get("total", 0))
+        metadata = result.get("metadata") or {}
+        if metadata.get("cache") == "hit":
+            self.cache_hits += 1
+        for stage, ms in (metadata.get("stages_ms") or {}).items():
+            self.stages[stage].append(ms)
+
+    def fail(self, kind: str, detail: str):
+        self.errors[kind] += 1
+        if len(self.error_samples) < 10:
+            self.error_samples.append(f"{kind}: {detail[:200]}")
+
+
+async def send(client, url, endpoint, items, recorder: Optional[Recorder]):
+    """送出一次請求（batch 模式一次送多筆）；recorder 為 None 時為暖身"""
+    started = time.perf_counter()
+    try:
+        if endpoint == "batch":
+            response = await client.post(
+                f"{url}/query/batch",
+                json={"requests": [to_request_body(item) for item in items]},
+            )
+        else:
+            response = await client.post(f"{url}/query", json=to_request_body(items[0]))
+    except httpx.HTTPError as e:
+        if recorder:
+            recorder.fail(type(e).__name__, str(e))
+        return
+    latency_ms = (time.perf_counter() - started) * 1000
+    if recorder is None:
+        return
+    if response.status_code != 200:
+        recorder.fail(f"http_{response.status_code}", response.text)
+        return
+    payload = response.json()
+    if endpoint == "batch":
+        # 整批耗時算在每個項目上：代表呼叫端拿到該項目結果的時間
+        for item, result in zip(items, payload.get("results", [])):
+            recorder.ok(item, latency_ms, result)
+    else:
+        recorder.ok(items[0], latency_ms, payload)
+
+
+async def run_load(client, url, endpoint, units, concurrency, recorder):
+    queue: asyncio.Queue = asyncio.Queue()
+    for unit in units:
+        queue.put_nowait(unit)
+
+    async def worker():
+        while True:
+            try:
+                unit = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await send(client, url, endpoint, unit, recorder)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return os.getenv("GIT_COMMIT") or None
+
+
+# ==================== 比較 ====================
+def compare(report: dict, baseline: dict) -> List[tuple]:
+    """回傳 [(指標, 基準值, 本次值, 變化%)]；延遲越高越差、吞吐量越低越差"""
+    rows = []
+    pairs = [
+        (f"latency {p}", baseline["latency_ms"].get(p), report["latency_ms"].get(p))
+        for p in ("p50", "p95", "p99")
+    ]
+    pairs.append(("throughput rps", baseline.get("throughput_rps"), report.get("throughput_rps")))
+    for stage in sorted(set(report["stages_ms"]) & set(baseline.get("stages_ms", {}))):
+        pairs.append(
+            (f"stage {stage} p95", baseline["stages_ms"][stage]["p95"], report["stages_ms"][stage]["p95"])
+        )
+    for name, before, after in pairs:
+        if before in (None, 0) or after is None:
+            continue
+        rows.append((name, before, after, round((after - before) / before * 100, 1)))
+    return rows
+
+
+def print_report(report: dict):
+    latency = report["latency_ms"]
+    print(
+        f"\n📊 {report['requests']} 筆（錯誤 {report['errors']['total']}），"
+        f"{report['duration_s']} 秒，{report['throughput_rps']} req/s"
+    )
+    print(
+        f"   延遲 ms  p50 {latency['p50']}  p95 {latency['p95']}  "
+        f"p99 {latency['p99']}  max {latency['max']}"
+    )
+    for stage, stats in sorted(report["stages_ms"].items(), key=lambda kv: -(kv[1]["p95"] or 0)):
+        print(f"   {stage:<18} p50 {stats['p50']:>8}  p95 {stats['p95']:>8}  (n={stats['count']})")
+    if report.get("external_calls_per_request"):
+        calls = ", ".join(f"{k}={v}" for k, v in report["external_calls_per_request"].items())
+        print(f"   外部呼叫/請求: {calls}")
+
+
+# ==================== 主程式 ====================
+async def main_async(args):
+    queries = load_queries(args.queries)
+    auth = (args.es_user, args.es_pass) if args.es_user else None
+    indexed_docs = None
+    if args.es_url:
+        indexed_docs = await wait_for_index(
+            args.es_url.rstrip("/"), auth, args.index_pattern, args.ready_timeout, args.settle
+        )
+
+    url = args.url.rstrip("/")
+    batch_size = args.batch_size if args.endpoint == "batch" else 1
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        await wait_for_api(client, url, args.ready_timeout)
+
+        def units(schedule):
+            return [schedule[i : i + batch_size] for i in range(0, len(schedule), batch_size)]
+
+        if args.warmup:
+            warmup = build_schedule(queries, args.warmup, args.seed + 1)
+            await run_load(client, url, args.endpoint, units(warmup), args.concurrency, None)
+
+        recorder = Recorder()
+        schedule = build_schedule(queries, args.requests, args.seed)
+        calls_before = await scrape_external_calls(client, url)
+        started = time.perf_counter()
+        await run_load(client, url, args.endpoint, units(schedule), args.concurrency, recorder)
+        duration = time.perf_counter() - started
+        calls_after = await scrape_external_calls(client, url)
+
+    completed = len(recorder.latencies)
+    external = None
+    if calls_before is not None and calls_after is not None and completed:
+        external = {
+            key: round((value - calls_before.get(key, 0)) / completed, 2)
+            for key, value in sorted(calls_after.items())
+            if value - calls_before.get(key, 0) > 0
+        }
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "label": args.label,
+        "config": {
+            "url": url,
+            "endpoint": args.endpoint,
+            "batch_size": batch_size,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "queries_file": os.path.basename(args.queries),
+            "query_count": len(queries),
+            "indexed_documents": indexed_docs,
+        },
+        "requests": completed,
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(completed / duration, 2) if duration else None,
+        "latency_ms": summarize(recorder.latencies),
+        "server_time_ms": summarize(recorder.server_ms),
+        "stages_ms": {stage: summarize(values) for stage, values in sorted(recorder.stages.items())},
+        "by_query": {name: summarize(values) for name, values in sorted(recorder.by_name.items())},
+        "documents_per_query": summarize(recorder.documents),
+        "cache_hit_ratio": round(recorder.cache_hits / completed, 4) if completed else 0.0,
+        "external_calls_per_request": external,
+        "errors": {
+            "total": sum(recorder.errors.values()),
+            "by_kind": dict(recorder.errors),
+            "samples": recorder.error_samples,
+        },
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG API 負載測試")
+    parser.add_argument("--url", default=os.getenv("RAG_API_URL", "http://localhost:8010"))
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--endpoint", choices=["query", "batch"], default="query")
+    parser.add_argument("--batch-size", type=int, default=10, help="--endpoint batch 時每批筆數")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400, help="計入統計的查詢筆數")
+    parser.add_argument("--warmup", type=int, default=40, help="暖身筆數（不計入統計）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--label", default="", help="寫入報告的標記（例如分支或設定名稱）")
+    parser.add_argument("--output", default="", help="報告路徑（預設 logs/benchmark/bench-<時間>.json）")
+    parser.add_argument("--baseline", default="", help="與先前的報告比較")
+    parser.add_argument(
+        "--max-regression", type=float, default=None,
+        help="p95 延遲比基準增加超過此百分比時以非零狀態結束",
+    )
+    parser.add_argument("--es-url", default=os.getenv("ES_URL", ""))
+    parser.add_argument("--es-user", default=os.getenv("ES_USER", "elastic"))
+    parser.add_argument("--es-pass", default=os.getenv("ES_PASS", ""))
+    parser.add_argument("--index-pattern", default="erp-*")
+    parser.add_argument("--ready-timeout", type=float, default=900)
+    parser.add_argument("--settle", type=float, default=10, help="等待索引時的輪詢間隔（秒）")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+
+    output = args.output or os.path.join(
+        "logs", "benchmark", f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 報告已寫入 {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n🔍 與基準比較（{baseline.get('label') or baseline.get('git_commit')}）")
+        for name, before, after, change in compare(report, baseline):
+            print(f"   {name:<24} {before:>10} → {after:>10}  ({change:+.1f}%)")
+        if args.max_regression is not None:
+            before = baseline["latency_ms"].get("p95")
+            after = report["latency_ms"].get("p95")
+            if before and after and (after - before) / before * 100 > args.max_regression:
+                print(f"❌ p95 延遲退步超過 {args.max_regression}%")
+                sys.exit(1)
+
+    if report["errors"]["total"]:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
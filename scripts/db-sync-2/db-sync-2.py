@@ -5,7 +5,7 @@
 同步 PDF 相關表到 Elasticsearch
 """
 
-import os, sys, time, json, pymysql, requests, signal
+import os, re, sys, time, json, pymysql, requests, signal
 from datetime import datetime, date
 from decimal import Decimal
 from typing import Dict, List, Any, Optional
@@ -37,6 +37,54 @@ AUTO_STOP_EMPTY_ROUNDS = int(os.environ.get("AUTO_STOP_EMPTY_ROUNDS", "3"))
 # 狀態檔配置
 STATE_FILE = os.environ.get("STATE_FILE", "/state/.sync_state.json")
 
+# 段落索引配置（technical_documents.content 切成段落供 rag-api 檢索）
+PASSAGE_INDEX = os.environ.get("PASSAGE_INDEX", "erp-passages")
+PASSAGE_SIZE = int(os.environ.get("PASSAGE_SIZE", "800"))
+PASSAGE_OVERLAP = int(os.environ.get("PASSAGE_OVERLAP", "150"))
+# 段落欄位版本：新增欄位時遞增，既有段落索引會整批重建（2: doc_date / department）
+PASSAGE_SCHEMA_VERSION = 2
+
+# 結果摺疊鍵：同一份文件（跨索引的 doc_id / original_doc_id）或同一 FMEA 案號共用一個 collapse_key，
+# rag-api 以 ES collapse 去除重複；版本寫入 _meta.collapse_key，既有文件以 _update_by_query 補上
+COLLAPSE_KEY_VERSION = 1
+# 依案號摺疊的資料表（每個案號有多列）
+COLLAPSE_CASE_FIELDS = {'fmea_records': 'case_number'}
+
+# 識別碼子欄位：品號與各類單號另建 .norm（去分隔符、小寫的 keyword）與 .prefix（edge-ngram），
+# rag-api 以 term / 前綴比對取代 fuzziness。版本寫入 _meta.identifier_fields，
+# 既有索引補 analysis 設定需短暫關閉索引，只在明確執行 `python db-sync-2.py --migrate-identifiers` 時進行；
+# 未遷移的索引平常同步時略過子欄位，rag-api 維持 fuzziness
+IDENTIFIER_FIELDS_VERSION = 1
+IDENTIFIER_ANALYSIS = {
+    "char_filter": {
+        "identifier_strip": {"type": "pattern_replace", "pattern": "[\\s\\-_./]+", "replacement": ""}
+    },
+    "filter": {
+        "identifier_edge_ngram": {"type": "edge_ngram", "min_gram": 2, "max_gram": 24}
+    },
+    "normalizer": {
+        "identifier_normalizer": {
+            "type": "custom",
+            "char_filter": ["identifier_strip"],
+            "filter": ["lowercase", "asciifolding"]
+        }
+    },
+    "analyzer": {
+        "identifier_prefix": {
+            "type": "custom",
+            "tokenizer": "keyword",
+            "char_filter": ["identifier_strip"],
+            "filter": ["lowercase", "asciifolding", "identifier_edge_ngram"]
+        },
+        "identifier_search": {
+            "type": "custom",
+            "tokenizer": "keyword",
+            "char_filter": ["identifier_strip"],
+            "filter": ["lowercase", "asciifolding"]
+        }
+    }
+}
+
 # ========== 日誌配置 ==========
 logging.basicConfig(
     level=logging.INFO,
@@ -57,6 +105,107 @@ def to_bool(v):
     return None
 
 
+# ========== 文字前處理 ==========
+def clean_content(text: str, preserve_line_breaks: bool = True) -> str:
+    """清理文本中的無用標記（規則需與 rag-api 的 snippets.clean_content 一致）"""
+    if not text:
+        return text
+
+    # 移除頁碼標記
+    text = re.sub(r"\[第\s*\d+\s*頁\]", "", text)
+    text = re.sub(r"【第\s*\d+\s*頁】", "", text)
+    text = re.sub(r"Page\s+\d+", "", text, flags=re.IGNORECASE)
+
+    if preserve_line_breaks:
+        # 保留換行，只清理多餘空格
+        text = re.sub(r"[ \t]+", " ", text)
+        text = re.sub(r"\n{3,}", "\n\n", text)
+        text = "\n".join(line.strip() for line in text.split("\n"))
+    else:
+        # 合併所有空白字符
+        text = re.sub(r"\s+", " ", text)
+
+    return text.strip()
+
+
+PAGE_MARKER_PATTERN = re.compile(r"\[第\s*(\d+)\s*頁\]|【第\s*(\d+)\s*頁】")
+SENTENCE_BOUNDARIES = "。！？\n；"
+
+
+def split_pages(content: str) -> List[tuple]:
+    """依頁碼標記切分全文，返回 [(頁碼, 清理後文字)]；第一個標記前的文字視為第 1 頁"""
+    pages = []
+    page_no = 1
+    last_end = 0
+    for match in PAGE_MARKER_PATTERN.finditer(content):
+        text = clean_content(content[last_end:match.start()], preserve_line_breaks=True)
+        if text:
+            pages.append((page_no, text))
+        page_no = int(match.group(1) or match.group(2))
+        last_end = match.end()
+    text = clean_content(content[last_end:], preserve_line_breaks=True)
+    if text:
+        pages.append((page_no, text))
+    return pages
+
+
+def split_passages(content: str, size: int = PASSAGE_SIZE, overlap: int = PASSAGE_OVERLAP) -> List[Dict]:
+    """
+    將全文切成重疊的段落
+
+    段落長度上限為 size，優先在換頁處、其次在句子邊界斷開（只在後半段尋找，
+    避免段落過短）；相鄰段落重疊 overlap 字元。每個段落記錄涵蓋的頁碼範圍。
+    """
+    pages = split_pages(content or "")
+    if not pages:
+        return []
+
+    text = ""
+    page_starts = []  # [(起始位置, 頁碼)]
+    for page_no, page_text in pages:
+        if text:
+            text += "\n"
+        page_starts.append((len(text), page_no))
+        text += page_text
+
+    def page_at(offset: int) -> int:
+        current = page_starts[0][1]
+        for start, page_no in page_starts:
+            if start > offset:
+                break
+            current = page_no
+        return current
+
+    passages = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            floor = start + size // 2
+            page_breaks = [s for s, _ in page_starts if floor < s <= end]
+            if page_breaks:
+                end = page_breaks[-1]
+            else:
+                for i in range(end - 1, floor, -1):
+                    if text[i] in SENTENCE_BOUNDARIES:
+                        end = i + 1
+                        break
+
+        passage = text[start:end].strip()
+        if passage:
+            passages.append({
+                "content": passage,
+                "page_start": page_at(start),
+                "page_end": page_at(max(start, end - 1)),
+            })
+
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+
+    return passages
+
+
 # ========== 狀態管理 ==========
 class StateManager:
     """管理同步狀態的持久化"""
@@ -86,8 +235,11 @@ class StateManager:
             if state_dir:
                 os.makedirs(state_dir, exist_ok=True)
             
-            with open(self.state_file, 'w', encoding='utf-8') as f:
+            # 先寫暫存檔再替換，讓 rag-api 等讀取端不會讀到寫到一半的檔案
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
                 json.dump(self.state, f, indent=2, ensure_ascii=False, default=str)
+            os.replace(tmp_file, self.state_file)
         except Exception as e:
             logger.error(f"❌ 無法保存狀態檔: {e}")
     
@@ -111,6 +263,8 @@ class ElasticsearchClient:
         if ES_USER and ES_PASS:
             self.session.auth = HTTPBasicAuth(ES_USER, ES_PASS)
         self.session.headers.update({'Content-Type': 'application/json'})
+        # 已提示過需要遷移 analysis 的索引（每個索引只提示一次）
+        self._analysis_warned = set()
         
     def check_connection(self):
         """檢查 Elasticsearch 連接"""
@@ -127,17 +281,34 @@ class ElasticsearchClient:
             logger.error(f"❌ 無法連接到 Elasticsearch: {e}")
             return False
     
-    def create_index(self, index_name: str, doc_type: str = 'general'):
-        """建立索引並設定 mapping"""
+    def create_index(self, index_name: str, doc_type: str = 'general', migrate: bool = False):
+        """
+        建立索引並設定 mapping
+
+        Args:
+            migrate: 既有索引缺少 analysis 設定時關閉索引補上（僅 --migrate-identifiers 使用）
+        """
         try:
+            mapping = self._get_mapping_for_type(doc_type)
+
             # 檢查索引是否存在
             response = self.session.head(f"{ES_URL}/{index_name}")
             if response.status_code == 200:
                 logger.debug(f"索引 {index_name} 已存在")
+                # 新欄位引用的 analyzer 須先存在，否則整個 mapping 更新失敗；尚未遷移時先不加識別碼子欄位
+                mappings = mapping["mappings"]
+                if not self.ensure_analysis(index_name, mapping["settings"]["analysis"], apply=migrate):
+                    mappings = without_identifier_subfields(mappings)
+                # 補上新增的欄位（既有欄位不變）
+                response = self.session.put(
+                    f"{ES_URL}/{index_name}/_mapping",
+                    json=mappings
+                )
+                if response.status_code != 200:
+                    logger.warning(f"⚠️ 更新 {index_name} mapping 失敗: {response.text}")
                 return True
             
             # 建立新索引
-            mapping = self._get_mapping_for_type(doc_type)
             response = self.session.put(
                 f"{ES_URL}/{index_name}",
                 json=mapping
@@ -162,17 +333,20 @@ class ElasticsearchClient:
                 "number_of_replicas": 1,
                 "refresh_interval": "30s",
                 "analysis": {
+                    **IDENTIFIER_ANALYSIS,
                     "analyzer": {
                         "chinese_analyzer": {
                             "type": "standard",
                             "stopwords": "_chinese_"
-                        }
+                        },
+                        **IDENTIFIER_ANALYSIS["analyzer"]
                     }
                 }
             },
             "mappings": {
                 "properties": {
                     "doc_id": {"type": "keyword"},
+                    "collapse_key": {"type": "keyword"},
                     "created_at": {"type": "date"},
                     "last_modified": {"type": "date"}
                 }
@@ -182,9 +356,9 @@ class ElasticsearchClient:
         # 根據類型添加特定欄位
         if doc_type == 'ecn_notice':
             base_mapping["mappings"]["properties"].update({
-                "notice_number": {"type": "keyword"},
-                "application_number": {"type": "keyword"},
-                "product_code": {"type": "keyword"},
+                "notice_number": identifier_field(),
+                "application_number": identifier_field(),
+                "product_code": identifier_field(),
                 "product_name": {
                     "type": "text",
                     "analyzer": "chinese_analyzer",
@@ -200,8 +374,8 @@ class ElasticsearchClient:
         
         elif doc_type == 'ecn_application':
             base_mapping["mappings"]["properties"].update({
-                "application_number": {"type": "keyword"},
-                "product_code": {"type": "keyword"},
+                "application_number": identifier_field(),
+                "product_code": identifier_field(),
                 "product_name": {
                     "type": "text",
                     "analyzer": "chinese_analyzer",
@@ -218,7 +392,7 @@ class ElasticsearchClient:
         
         elif doc_type == 'complaint':
             base_mapping["mappings"]["properties"].update({
-                "complaint_number": {"type": "keyword"},
+                "complaint_number": identifier_field(),
                 "complaint_type": {"type": "keyword"},
                 "customer_code": {"type": "keyword"},
                 "customer_name": {
@@ -226,7 +400,7 @@ class ElasticsearchClient:
                     "analyzer": "chinese_analyzer",
                     "fields": {"keyword": {"type": "keyword"}}
                 },
-                "product_code": {"type": "keyword"},
+                "product_code": identifier_field(),
                 "product_name": {
                     "type": "text",
                     "analyzer": "chinese_analyzer",
@@ -239,7 +413,7 @@ class ElasticsearchClient:
         
         elif doc_type == 'fmea':
             base_mapping["mappings"]["properties"].update({
-                "case_number": {"type": "keyword"},
+                "case_number": identifier_field(),
                 "case_name": {
                     "type": "text",
                     "analyzer": "chinese_analyzer",
@@ -267,15 +441,28 @@ class ElasticsearchClient:
                 "revision_date": {"type": "date"}
             })
         
+        elif doc_type == 'passage':
+            base_mapping["mappings"]["properties"].update({
+                "passage_id": {"type": "keyword"},
+                "doc_type": {"type": "keyword"},
+                "file_name": {"type": "keyword"},
+                "chunk_index": {"type": "integer"},
+                "page_start": {"type": "integer"},
+                "page_end": {"type": "integer"},
+                "doc_date": {"type": "date"},
+                "department": {"type": "keyword"},
+                "content": {"type": "text", "analyzer": "chinese_analyzer"}
+            })
+
         elif doc_type == 'document':
             base_mapping["mappings"]["properties"].update({
                 "original_doc_id": {"type": "keyword"},
                 "doc_type": {"type": "keyword"},
-                "doc_number": {"type": "keyword"},
+                "doc_number": identifier_field(),
                 "doc_date": {"type": "date"},
                 "file_name": {"type": "keyword"},
                 "file_url": {"type": "keyword"},
-                "product_codes": {"type": "keyword"},
+                "product_codes": identifier_field(),
                 "product_names": {
                     "type": "text",
                     "analyzer": "chinese_analyzer",
@@ -284,6 +471,7 @@ class ElasticsearchClient:
                 "applicant": {"type": "keyword"},
                 "department": {"type": "keyword"},
                 "summary": {"type": "text", "analyzer": "chinese_analyzer"},
+                "summary_clean": {"type": "text", "index": False},
                 "keywords": {"type": "keyword"},
                 "status": {"type": "keyword"},
                 "priority": {"type": "keyword"}
@@ -336,6 +524,174 @@ class ElasticsearchClient:
             logger.error(f"❌ 批次索引時發生錯誤: {e}")
             return 0
     
+    def refresh_index(self, index_name: str) -> bool:
+        """強制 refresh，讓剛寫入的文檔立即可被搜尋"""
+        try:
+            response = self.session.post(f"{ES_URL}/{index_name}/_refresh")
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"⚠️  refresh {index_name} 失敗: {e}")
+            return False
+
+    def delete_by_doc_ids(self, index_name: str, doc_ids: List[str]) -> bool:
+        """刪除指定 doc_id 的所有文檔（重建段落前清掉舊段落）"""
+        if not doc_ids:
+            return True
+        try:
+            response = self.session.post(
+                f"{ES_URL}/{index_name}/_delete_by_query",
+                params={"conflicts": "proceed", "refresh": "false"},
+                json={"query": {"terms": {"doc_id": doc_ids}}}
+            )
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"⚠️  刪除 {index_name} 舊文檔失敗: {e}")
+            return False
+
+    def ensure_analysis(self, index_name: str, analysis: dict, apply: bool = False) -> bool:
+        """
+        檢查既有索引的 analysis 元件，回傳是否齊全
+
+        analysis 設定只能在索引關閉時修改，關閉期間所有搜尋該索引的查詢都會失敗，
+        因此只有 apply=True（明確執行遷移）時才關閉、補上並重新開啟。
+        """
+        try:
+            response = self.session.get(f"{ES_URL}/{index_name}/_settings")
+            if response.status_code != 200:
+                return False
+            current = {}
+            for body in response.json().values():
+                current = body.get('settings', {}).get('index', {}).get('analysis', {})
+            missing = {
+                kind: {name: spec for name, spec in components.items() if name not in current.get(kind, {})}
+                for kind, components in analysis.items()
+            }
+            missing = {kind: components for kind, components in missing.items() if components}
+            if not missing:
+                return True
+            names = sorted(n for c in missing.values() for n in c)
+            if not apply:
+                if index_name not in self._analysis_warned:
+                    self._analysis_warned.add(index_name)
+                    logger.warning(
+                        f"⚠️ {index_name} 缺少 analysis 設定 {names}，識別碼子欄位暫不建立；"
+                        f"請於離峰時段執行 `python db-sync-2.py --migrate-identifiers`"
+                    )
+                return False
+
+            logger.info(f"🔧 {index_name} 補上 analysis 設定: {names}")
+            response = self.session.post(f"{ES_URL}/{index_name}/_close")
+            if response.status_code != 200:
+                logger.warning(f"⚠️ 關閉 {index_name} 失敗: {response.text[:500]}")
+                return False
+            updated = False
+            try:
+                response = self.session.put(
+                    f"{ES_URL}/{index_name}/_settings",
+                    json={"analysis": missing}
+                )
+                if response.status_code != 200:
+                    logger.warning(f"⚠️ 更新 {index_name} analysis 失敗: {response.text[:500]}")
+                else:
+                    updated = True
+            finally:
+                opened = self.open_index(index_name)
+            return updated and opened
+        except Exception as e:
+            logger.warning(f"⚠️ 更新 {index_name} analysis 失敗: {e}")
+            return False
+
+    def open_index(self, index_name: str, attempts: int = 3) -> bool:
+        """重新開啟索引；失敗時重試，仍失敗則記錄錯誤（索引維持關閉，搜尋會失敗）"""
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self.session.post(
+                    f"{ES_URL}/{index_name}/_open",
+                    params={"wait_for_active_shards": "1"},
+                    timeout=120
+                )
+                if response.status_code == 200 and response.json().get('acknowledged'):
+                    return True
+                error = response.text[:500]
+            except Exception as e:
+                error = str(e)
+            logger.warning(f"⚠️ 重新開啟 {index_name} 失敗（第 {attempt} 次）: {error}")
+            time.sleep(2 * attempt)
+        logger.error(f"❌ {index_name} 仍為關閉狀態，請手動執行 POST {index_name}/_open")
+        return False
+
+    def ensure_identifier_fields(self, index_name: str) -> bool:
+        """
+        既有文件尚未建立識別碼子欄位時重新索引，完成後記錄版本（rag-api 據此略過 fuzziness）
+
+        子欄位不存在（索引尚未遷移 analysis 設定）或重建失敗時不記錄版本，返回 False。
+        """
+        if self.get_mapping_meta(index_name).get('identifier_fields', 0) >= IDENTIFIER_FIELDS_VERSION:
+            return True
+        if not self.has_field(index_name, '*.prefix'):
+            return False
+        if not self.reindex_in_place(index_name):
+            return False
+        return self.update_mapping_meta(index_name, identifier_fields=IDENTIFIER_FIELDS_VERSION)
+
+    def reindex_in_place(self, index_name: str) -> bool:
+        """以 _update_by_query 重新索引全部文件，讓新加入的子欄位套用到既有資料"""
+        try:
+            response = self.session.post(
+                f"{ES_URL}/{index_name}/_update_by_query",
+                params={"conflicts": "proceed", "refresh": "true", "wait_for_completion": "true"},
+                timeout=600
+            )
+            if response.status_code != 200:
+                logger.warning(f"⚠️ {index_name} 重建欄位失敗: {response.text[:500]}")
+                return False
+            result = response.json()
+            if result.get('failures'):
+                logger.warning(f"⚠️ {index_name} 重建欄位部分失敗: {result['failures'][:3]}")
+                return False
+            logger.info(f"🔧 {index_name} 重建識別碼子欄位: {result.get('updated', 0)} 筆")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ {index_name} 重建欄位失敗: {e}")
+            return False
+
+    def backfill_collapse_key(self, index_name: str, case_field: Optional[str] = None) -> bool:
+        """為缺少 collapse_key 的既有文件補上摺疊鍵（與 collapse_key_for 相同規則）"""
+        script = """
+            def src = ctx._source;
+            if (params.case_field != null && src[params.case_field] != null && src[params.case_field] != '') {
+                src.collapse_key = 'case:' + src[params.case_field];
+            } else if (src.original_doc_id != null) {
+                src.collapse_key = src.original_doc_id;
+            } else if (src.doc_id != null) {
+                src.collapse_key = src.doc_id;
+            } else {
+                src.collapse_key = ctx._id;
+            }
+        """
+        try:
+            response = self.session.post(
+                f"{ES_URL}/{index_name}/_update_by_query",
+                params={"conflicts": "proceed", "refresh": "true", "wait_for_completion": "true"},
+                json={
+                    "query": {"bool": {"must_not": {"exists": {"field": "collapse_key"}}}},
+                    "script": {"source": script, "lang": "painless", "params": {"case_field": case_field}},
+                },
+                timeout=600
+            )
+            if response.status_code != 200:
+                logger.warning(f"⚠️ {index_name} 補寫 collapse_key 失敗: {response.text[:500]}")
+                return False
+            result = response.json()
+            if result.get('failures'):
+                logger.warning(f"⚠️ {index_name} 補寫 collapse_key 部分失敗: {result['failures'][:3]}")
+                return False
+            logger.info(f"🔗 {index_name} 補寫 collapse_key: {result.get('updated', 0)} 筆")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ {index_name} 補寫 collapse_key 失敗: {e}")
+            return False
+
     def get_doc_count(self, index_name: str) -> int:
         """獲取索引中的文檔數量"""
         try:
@@ -346,7 +702,84 @@ class ElasticsearchClient:
         except Exception:
             return 0
 
+    def has_field(self, index_name: str, field: str) -> bool:
+        """索引 mapping 中是否有指定欄位（可用萬用字元）"""
+        try:
+            response = self.session.get(f"{ES_URL}/{index_name}/_mapping/field/{field}")
+            if response.status_code == 200:
+                return any(body.get('mappings') for body in response.json().values())
+        except Exception as e:
+            logger.warning(f"⚠️ 讀取 {index_name} 欄位 mapping 失敗: {e}")
+        return False
+
+    def get_mapping_meta(self, index_name: str) -> dict:
+        """讀取索引 mapping 的 _meta（索引不存在時為空）"""
+        try:
+            response = self.session.get(f"{ES_URL}/{index_name}/_mapping")
+            if response.status_code == 200:
+                for body in response.json().values():
+                    return body.get('mappings', {}).get('_meta', {}) or {}
+        except Exception as e:
+            logger.warning(f"⚠️ 讀取 {index_name} _meta 失敗: {e}")
+        return {}
+
+    def update_mapping_meta(self, index_name: str, **values) -> bool:
+        """合併寫入索引 mapping 的 _meta（PUT 會整個取代 _meta，故先讀後寫）"""
+        meta = self.get_mapping_meta(index_name)
+        meta.update(values)
+        try:
+            response = self.session.put(
+                f"{ES_URL}/{index_name}/_mapping",
+                json={"_meta": meta}
+            )
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"⚠️ 更新 {index_name} _meta 失敗: {e}")
+            return False
+
+def identifier_field() -> dict:
+    """識別碼欄位的 mapping：原值 keyword 加上 .norm / .prefix 子欄位"""
+    return {
+        "type": "keyword",
+        "fields": {
+            "norm": {"type": "keyword", "normalizer": "identifier_normalizer"},
+            "prefix": {
+                "type": "text",
+                "analyzer": "identifier_prefix",
+                "search_analyzer": "identifier_search",
+                "index_options": "docs",
+                "norms": False
+            }
+        }
+    }
+
+def without_identifier_subfields(mappings: dict) -> dict:
+    """將識別碼欄位換成不含子欄位的 keyword（索引尚未遷移 analysis 設定時使用）"""
+    plain = identifier_field()
+    properties = {
+        name: {"type": "keyword"} if spec == plain else spec
+        for name, spec in mappings.get("properties", {}).items()
+    }
+    return {**mappings, "properties": properties}
+
+def collapse_key_for(table_name: str, row: Dict) -> str:
+    """文件的摺疊鍵：依案號摺疊的表用案號，其餘用關聯的 technical_documents.doc_id"""
+    case_field = COLLAPSE_CASE_FIELDS.get(table_name)
+    if case_field and row.get(case_field):
+        return f"case:{row[case_field]}"
+    return row.get('original_doc_id') or row.get('doc_id') or str(row.get('id'))
+
 # ========== MySQL 同步器 ==========
+# 方案A：每種表單同步到不同索引（資料表, 索引, mapping 類型）
+SYNC_TABLES = [
+    # PDF 文件相關表
+    ('ecn_notices', 'erp-ecn-notices', 'ecn_notice'),
+    ('ecn_applications', 'erp-ecn-applications', 'ecn_application'),
+    ('complaint_records', 'erp-complaint-records', 'complaint'),
+    ('fmea_records', 'erp-fmea', 'fmea'),
+    ('structured_documents', 'erp-structure', 'document'),
+]
+
 class MySQLSyncer:
     def __init__(self, es_client: ElasticsearchClient):
         self.es_client = es_client
@@ -381,6 +814,8 @@ class MySQLSyncer:
         try:
             # 建立或更新索引
             self.es_client.create_index(index_name, doc_type)
+            self._ensure_collapse_key(table_name, index_name)
+            self.es_client.ensure_identifier_fields(index_name)
             
             # 獲取上次同步時間
             last_sync_time = self.state_mgr.get_last_sync_time(table_name)
@@ -436,6 +871,9 @@ class MySQLSyncer:
                 result = cursor.fetchone()
                 max_modified_time = result['max_time'] if result else datetime.now()
             
+            # 水位前進前先 refresh，rag-api 依水位失效快取後即可查到新資料
+            self.es_client.refresh_index(index_name)
+
             # 更新狀態
             self.state_mgr.update_sync_time(table_name, max_modified_time, indexed_total)
             
@@ -449,6 +887,14 @@ class MySQLSyncer:
             logger.error(f"❌ 同步 {table_name} 時發生錯誤: {e}")
             return False
     
+    def _ensure_collapse_key(self, table_name: str, index_name: str):
+        """既有索引的文件尚無 collapse_key 時補寫，完成後記錄版本（rag-api 據此啟用 collapse）"""
+        meta = self.es_client.get_mapping_meta(index_name)
+        if meta.get('collapse_key', 0) >= COLLAPSE_KEY_VERSION:
+            return
+        if self.es_client.backfill_collapse_key(index_name, COLLAPSE_CASE_FIELDS.get(table_name)):
+            self.es_client.update_mapping_meta(index_name, collapse_key=COLLAPSE_KEY_VERSION)
+
     def _sync_batch(self, table_name: str, index_name: str, offset: int, limit: int, where_clause: str = "") -> int:
         """同步一批資料"""
         conn = None
@@ -493,11 +939,17 @@ class MySQLSyncer:
                                         row[field] = json.loads(row[field])
                                 except Exception:
                                     row[field] = []
+
+                        # 預先清理摘要，rag-api 直接顯示
+                        if row.get('summary'):
+                            row['summary_clean'] = clean_content(row['summary'], preserve_line_breaks=True)
                     
                     if table_name == 'fmea_records':
                         if 'is_customer_complaint' in row:
                             row['is_customer_complaint'] = to_bool(row['is_customer_complaint'])
 
+                    row['collapse_key'] = collapse_key_for(table_name, row)
+
                     batch.append(row)
                     
                     if len(batch) >= BATCH_SIZE:
@@ -517,20 +969,130 @@ class MySQLSyncer:
             if conn:
                 conn.close()
     
+    def sync_technical_documents(self) -> bool:
+        """
+        處理 technical_documents：預先計算清理後全文並重建段落索引
+
+        - content_clean / content_lower 寫回 MySQL，rag-api 直接讀取
+        - 全文切成重疊段落寫入 PASSAGE_INDEX（_id = doc_id-段落序號），
+          vector 服務再補上 content_vector
+        - 段落帶上 structured_documents 的 doc_date / department，
+          供 rag-api 以與記錄索引相同的 filter 過濾
+
+        處理 last_modified 超過上次水位的資料列；尚無水位或段落欄位版本落後時全部處理。
+        UPDATE 時保留 last_modified，避免自身寫入觸發下一輪重算。
+        返回是否有更新。
+        """
+        table_name = 'technical_documents'
+        if not self.connection or not self.connection.open:
+            if not self.connect():
+                return False
+
+        self.es_client.create_index(PASSAGE_INDEX, 'passage')
+        # 新建的索引沒有 passage_schema；不依段落數判斷，語料切不出段落時才不會每輪重建
+        schema = self.es_client.get_mapping_meta(PASSAGE_INDEX).get('passage_schema', 0)
+        rebuild = schema < PASSAGE_SCHEMA_VERSION
+
+        last_sync_time = self.state_mgr.get_last_sync_time(table_name)
+        where_clause = "td.content IS NOT NULL"
+        params = []
+        if not rebuild and last_sync_time:
+            # 增量只走 idx_last_modified 範圍；尚無水位（首次執行）時全表處理一次即為補算
+            where_clause += " AND td.last_modified > %s"
+            params.append(last_sync_time)
+
+        updated = 0
+        passage_total = 0
+        last_id = 0
+        max_modified_time = None
+        try:
+            while not should_stop:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(
+                        f"""
+                        SELECT td.id, td.doc_id, td.doc_type, td.file_name, td.content,
+                               td.last_modified, sd.doc_date, sd.department
+                        FROM {table_name} td
+                        LEFT JOIN structured_documents sd ON sd.original_doc_id = td.doc_id
+                        WHERE {where_clause} AND td.id > %s
+                        ORDER BY td.id LIMIT %s
+                        """,
+                        (*params, last_id, BATCH_SIZE)
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+
+                    values = []
+                    passages = []
+                    for row in rows:
+                        cleaned = clean_content(row['content'], preserve_line_breaks=True) or ""
+                        values.append((cleaned, cleaned.lower(), row['id']))
+                        if max_modified_time is None or row['last_modified'] > max_modified_time:
+                            max_modified_time = row['last_modified']
+
+                        for chunk_index, passage in enumerate(split_passages(row['content'])):
+                            passage_id = f"{row['doc_id']}-{chunk_index:04d}"
+                            passages.append({
+                                "id": passage_id,
+                                "passage_id": passage_id,
+                                "doc_id": row['doc_id'],
+                                "doc_type": row['doc_type'],
+                                "file_name": row['file_name'],
+                                "chunk_index": chunk_index,
+                                "doc_date": row['doc_date'].isoformat() if row['doc_date'] else None,
+                                "department": row['department'] or None,
+                                "last_modified": row['last_modified'].isoformat(),
+                                **passage,
+                            })
+
+                    # 先換掉段落再寫回 MySQL；段落寫入失敗則整批重試，不前進水位
+                    self.es_client.delete_by_doc_ids(PASSAGE_INDEX, [row['doc_id'] for row in rows])
+                    indexed = 0
+                    for offset in range(0, len(passages), BATCH_SIZE):
+                        indexed += self.es_client.bulk_index(
+                            PASSAGE_INDEX, passages[offset:offset + BATCH_SIZE]
+                        )
+                    if indexed < len(passages):
+                        raise RuntimeError(f"段落寫入不完整 ({indexed}/{len(passages)})")
+
+                    cursor.executemany(
+                        f"""
+                        UPDATE {table_name}
+                        SET content_clean = %s, content_lower = %s, last_modified = last_modified
+                        WHERE id = %s
+                        """,
+                        values
+                    )
+                self.connection.commit()
+                updated += len(rows)
+                passage_total += len(passages)
+                last_id = rows[-1]['id']
+
+            if updated:
+                self.es_client.refresh_index(PASSAGE_INDEX)
+                # 依 id 順序掃描，已處理列的 last_modified 最大值只有在掃完全部後才是安全水位；
+                # 中斷時不前進，下一輪重掃（重複處理無副作用）
+                if not should_stop:
+                    self.state_mgr.update_sync_time(table_name, max_modified_time, updated)
+                logger.info(f"✅ {table_name} 預先清理全文: {updated} 筆，段落 {passage_total} 筆")
+            # 全部重建完成後才記錄段落欄位版本（沒有寫入任何段落也記錄），中斷時下一輪仍會重建
+            if rebuild and not should_stop:
+                self.es_client.update_mapping_meta(
+                    PASSAGE_INDEX, passage_schema=PASSAGE_SCHEMA_VERSION
+                )
+            return updated > 0
+
+        except Exception as e:
+            self.connection.rollback()
+            logger.error(f"❌ 處理 {table_name} 全文時發生錯誤: {e}")
+            return False
+
     def sync_all(self) -> bool:
         """同步所有配置的資料表，返回是否有任何新數據"""
-        # 方案A：每種表單同步到不同索引
-        tables = [
-            # PDF 文件相關表
-            ('ecn_notices', 'erp-ecn-notices', 'ecn_notice'),
-            ('ecn_applications', 'erp-ecn-applications', 'ecn_application'),
-            ('complaint_records', 'erp-complaint-records', 'complaint'),
-            ('fmea_records', 'erp-fmea', 'fmea'),
-            ('structured_documents', 'erp-structure', 'document'),
-        ]
-        
-        had_any_new_data = False
-        for table_name, index_name, doc_type in tables:
+        # rag-api 讀取預先清理的全文與段落索引
+        had_any_new_data = self.sync_technical_documents()
+        for table_name, index_name, doc_type in SYNC_TABLES:
             if should_stop:
                 break
             had_new_data = self.sync_table(table_name, index_name, doc_type)
@@ -545,6 +1107,27 @@ class MySQLSyncer:
             self.connection.close()
             logger.info("MySQL 連接已關閉")
 
+# ========== 識別碼子欄位遷移 ==========
+def migrate_identifiers(es_client: ElasticsearchClient) -> bool:
+    """
+    為既有索引補上 analysis 設定與識別碼子欄位（`python db-sync-2.py --migrate-identifiers`）
+
+    每個索引會短暫關閉，期間 rag-api 對該索引的搜尋會失敗，請於離峰時段執行。
+    子欄位以 _update_by_query 重建，完成後記錄 _meta.identifier_fields（rag-api 據此略過 fuzziness）。
+    """
+    ok = True
+    for index_name, doc_type in [(index, kind) for _, index, kind in SYNC_TABLES] + [(PASSAGE_INDEX, 'passage')]:
+        if should_stop:
+            return False
+        logger.info(f"🔧 遷移 {index_name}")
+        if not es_client.create_index(index_name, doc_type, migrate=True):
+            ok = False
+            continue
+        if doc_type != 'passage' and not es_client.ensure_identifier_fields(index_name):
+            ok = False
+    logger.info("✅ 識別碼子欄位遷移完成" if ok else "⚠️ 識別碼子欄位遷移未全部完成，請檢查上方日誌後重新執行")
+    return ok
+
 # ========== 信號處理 ==========
 def signal_handler(signum, frame):
     global should_stop
@@ -577,6 +1160,7 @@ def main():
     logger.info("  - complaint_records → erp-complaint-records")
     logger.info("  - fmea_records → erp-fmea")
     logger.info("  - structured_documents → erp-documents")
+    logger.info(f"  - technical_documents → {PASSAGE_INDEX}（段落 {PASSAGE_SIZE} 字，重疊 {PASSAGE_OVERLAP} 字）")
     logger.info("=" * 60)
     
     # 建立客戶端
@@ -591,6 +1175,10 @@ def main():
     
     if should_stop:
         return
+
+    # 一次性遷移：補上 analysis 設定（會短暫關閉索引）後結束，不進入同步迴圈
+    if '--migrate-identifiers' in sys.argv[1:]:
+        sys.exit(0 if migrate_identifiers(es_client) else 1)
     
     # 建立同步器
     syncer = MySQLSyncer(es_client)
@@ -0,0 +1,377 @@
+"""
+向量提供者
+
+rag-api（查詢向量）與 vector 服務（文件向量）共用此模組，兩邊以相同的
+EMBEDDING_* 環境變數建立同一個提供者，確保查詢與索引的向量來自同一模型。
+
+    EMBEDDING_PROVIDER=openai  OpenAI 相容 API（EMBEDDING_MODEL、OPENAI_BASE_URL）
+    EMBEDDING_PROVIDER=local   本機 CPU 推論：EMBEDDING_MODEL_PATH 下的 model.onnx + tokenizer.json
+                               （例如以 optimum 匯出的 bge / e5 / MiniLM），並行請求合併成一次推論
+    EMBEDDING_PROVIDER=hash    字元 bigram 雜湊，不需模型、結果固定，供測試使用
+
+提供者的 signature()（provider / model / dims）由 vector 服務寫入索引 mapping 的
+_meta.embedding；rag-api 據此排除向量來源不一致的索引。
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import math
+import os
+from typing import Dict, List, Optional
+
+try:
+    from openai import AsyncOpenAI, OpenAI
+except ImportError:
+    AsyncOpenAI = OpenAI = None
+
+try:
+    import numpy as np
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+except ImportError:
+    np = ort = Tokenizer = None
+
+logger = logging.getLogger(__name__)
+
+# 未記錄 _meta 的既有索引皆由 OpenAI 產生
+LEGACY_PROVIDER = "openai"
+
+
+class EmbeddingProvider:
+    """提供者基底類別；子類別實作 embed（同步、失敗時拋出例外）"""
+
+    name = "base"
+
+    def __init__(self, model: str, dimension: int):
+        self.model = model
+        self.dimension = dimension
+
+    def embed(self, texts: List[str], input_type: str = "document") -> List[List[float]]:
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str], input_type: str = "query") -> List[List[float]]:
+        return await asyncio.to_thread(self.embed, texts, input_type)
+
+    async def aclose(self):
+        pass
+
+    def signature(self) -> Dict:
+        return {"provider": self.name, "model": self.model, "dims": self.dimension}
+
+    def compatible_with(self, meta: Optional[Dict], dims: Optional[int]) -> bool:
+        """
+        索引既有向量是否與本提供者一致
+
+        Args:
+            meta: 索引 _meta.embedding（未記錄時為 None）
+            dims: 索引 content_vector 的維度（尚未建立向量欄位時為 None）
+        """
+        if dims is None:
+            return True
+        if dims != self.dimension:
+            return False
+        if not meta:
+            return self.name == LEGACY_PROVIDER
+        return meta.get("provider") == self.name and meta.get("model") == self.model
+
+
+# ==================== OpenAI ====================
+class OpenAIProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(
+        self,
+        model: str,
+        api_key: Optional[str],
+        base_url: str,
+        timeout: Optional[float] = None,
+        dimensions: Optional[int] = None,
+    ):
+        if OpenAI is None:
+            raise RuntimeError("未安裝 openai 套件")
+        if not api_key:
+            raise RuntimeError("未設置 OPENAI_API_KEY")
+        super().__init__(model, dimensions or (3072 if "3-large" in model else 1536))
+        self._dimensions = dimensions
+        self._client_kwargs = {"api_key": api_key, "base_url": base_url}
+        if timeout:
+            self._client_kwargs["timeout"] = timeout
+        self._client = None
+        self._async_client = None
+
+    def _request(self, texts: List[str]) -> Dict:
+        request = {"model": self.model, "input": texts, "encoding_format": "float"}
+        if self._dimensions:
+            request["dimensions"] = self._dimensions
+        return request
+
+    @staticmethod
+    def _vectors(response) -> List[List[float]]:
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def embed(self, texts: List[str], input_type: str = "document") -> List[List[float]]:
+        if self._client is None:
+            self._client = OpenAI(**self._client_kwargs)
+        return self._vectors(self._client.embeddings.create(**self._request(texts)))
+
+    async def aembed(self, texts: List[str], input_type: str = "query") -> List[List[float]]:
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(**self._client_kwargs)
+        return self._vectors(await self._async_client.embeddings.create(**self._request(texts)))
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+
+
+# ==================== 本機 ONNX ====================
+class MicroBatcher:
+    """
+    將同一時間的多個請求合併為一次推論
+
+    第一個請求到達後最多再等 max_wait 秒（或湊滿 max_batch 筆），
+    整批在背景執行緒推論後依序拆回各請求。推論一次只跑一批，
+    因此高並行時批次自然變大、單筆成本下降。
+    """
+
+    def __init__(self, fn, max_batch: int, max_wait: float):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((texts, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch:
+                try:
+                    # 上一批推論期間累積的請求直接併入
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(item)
+                count += len(item[0])
+
+            # 呼叫端已取消（逾時）的請求不再推論
+            batch = [(texts, future) for texts, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                vectors = await asyncio.to_thread(
+                    self.fn, [text for texts, _ in batch for text in texts]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for texts, future in batch:
+                if not future.done():
+                    future.set_result(vectors[offset : offset + len(texts)])
+                offset += len(texts)
+
+    async def aclose(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+
+
+class LocalOnnxProvider(EmbeddingProvider):
+    """
+    以 onnxruntime 在 CPU 上推論 sentence embedding 模型
+
+    模型目錄需包含 model.onnx 與 tokenizer.json；輸出為 token 向量時依
+    attention mask 做 mean pooling（或取 CLS），最後 L2 正規化以配合 cosine。
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        model_path: str,
+        model: Optional[str] = None,
+        max_tokens: int = 512,
+        threads: int = 0,
+        batch_size: int = 32,
+        batch_wait_ms: float = 5,
+        pooling: str = "mean",
+        query_prefix: str = "",
+        document_prefix: str = "",
+    ):
+        if ort is None:
+            raise RuntimeError("local 向量需要安裝 onnxruntime、tokenizers 與 numpy")
+        if not model_path:
+            raise RuntimeError("未設置 EMBEDDING_MODEL_PATH")
+
+        model_file = model_path if model_path.endswith(".onnx") else os.path.join(model_path, "model.onnx")
+        model_dir = os.path.dirname(os.path.abspath(model_file))
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        if self.tokenizer.padding is None:
+            pad_token = next(
+                (t for t in ("[PAD]", "<pad>") if self.tokenizer.token_to_id(t) is not None),
+                "[PAD]",
+            )
+            self.tokenizer.enable_padding(
+                pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token
+            )
+
+        options = ort.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            model_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = max(1, batch_size)
+        self.pooling = pooling
+        self.prefixes = {"query": query_prefix, "document": document_prefix}
+
+        # 維度以實際推論一次取得，不依賴模型設定檔
+        super().__init__(model or os.path.basename(model_dir), 0)
+        self.dimension = len(self._infer(["dimension probe"])[0])
+        self._batcher = MicroBatcher(self._embed_prefixed, self.batch_size, batch_wait_ms / 1000)
+        logger.info(f"本機向量模型: {model_file} ({self.dimension} 維)")
+
+    def _infer(self, texts: List[str]) -> List[List[float]]:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        output = self.session.run(
+            None, {name: value for name, value in feeds.items() if name in self.input_names}
+        )[0]
+
+        if output.ndim == 3:
+            if self.pooling == "cls":
+                output = output[:, 0]
+            else:
+                mask = attention_mask[..., None].astype(np.float32)
+                output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.clip(norms, 1e-12, None)).astype(np.float64).tolist()
+
+    def _embed_prefixed(self, texts: List[str]) -> List[List[float]]:
+        """依長度排序後分批推論（同批長度相近，padding 較少），再還原順序"""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start : start + self.batch_size]
+            for i, vector in zip(chunk, self._infer([texts[i] for i in chunk])):
+                vectors[i] = vector
+        return vectors
+
+    def embed(self, texts: List[str], input_type: str = "document") -> List[List[float]]:
+        prefix = self.prefixes.get(input_type, "")
+        return self._embed_prefixed([prefix + text for text in texts])
+
+    async def aembed(self, texts: List[str], input_type: str = "query") -> List[List[float]]:
+        prefix = self.prefixes.get(input_type, "")
+        return await self._batcher.submit([prefix + text for text in texts])
+
+    async def aclose(self):
+        await self._batcher.aclose()
+
+
+# ==================== 測試用雜湊向量 ====================
+class HashProvider(EmbeddingProvider):
+    """字元 bigram 雜湊後正規化：相同文字得到相同向量，共用字詞的文字 cosine 較高"""
+
+    name = "hash"
+
+    def __init__(self, dimension: int = 256):
+        super().__init__("hash-bigram-v1", dimension)
+
+    def _embed_one(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        text = " ".join((text or "").lower().split())
+        grams = [text[i : i + 2] for i in range(len(text) - 1)] or [text]
+        for gram in grams:
+            digest = hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm == 0:
+            vector[0] = 1.0
+            return vector
+        return [v / norm for v in vector]
+
+    def embed(self, texts: List[str], input_type: str = "document") -> List[List[float]]:
+        return [self._embed_one(text) for text in texts]
+
+    async def aembed(self, texts: List[str], input_type: str = "query") -> List[List[float]]:
+        # 純計算且很快，不必切到執行緒
+        return self.embed(texts, input_type)
+
+
+# ==================== 建立 ====================
+def _env_number(name: str, default: float, cast=int):
+    """讀取數值環境變數；未設定或空字串用預設值，格式錯誤時拋出 RuntimeError"""
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return cast(default)
+    try:
+        return cast(raw)
+    except ValueError:
+        raise RuntimeError(f"{name} 必須是數字: {raw!r}") from None
+
+
+def build_provider(timeout: Optional[float] = None) -> EmbeddingProvider:
+    """
+    依 EMBEDDING_* 環境變數建立提供者；設定錯誤或缺少套件時拋出 RuntimeError
+
+    Args:
+        timeout: OpenAI 請求逾時秒數（None 使用套件預設）
+    """
+    provider = os.getenv("EMBEDDING_PROVIDER", "openai").strip().lower()
+    dims = _env_number("EMBEDDING_DIMS", 0) or None
+
+    if provider == "openai":
+        return OpenAIProvider(
+            model=os.getenv("EMBEDDING_MODEL") or "text-embedding-3-small",
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=(os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/"),
+            timeout=timeout,
+            dimensions=dims,
+        )
+    if provider == "local":
+        return LocalOnnxProvider(
+            model_path=os.getenv("EMBEDDING_MODEL_PATH", ""),
+            model=os.getenv("EMBEDDING_LOCAL_MODEL") or None,
+            max_tokens=_env_number("EMBEDDING_MAX_TOKENS", 512),
+            threads=_env_number("EMBEDDING_THREADS", 0),
+            batch_size=_env_number("EMBEDDING_LOCAL_BATCH_SIZE", 32),
+            batch_wait_ms=_env_number("EMBEDDING_BATCH_WAIT_MS", 5, float),
+            pooling=os.getenv("EMBEDDING_POOLING", "mean").lower(),
+            query_prefix=os.getenv("EMBEDDING_QUERY_PREFIX", ""),
+            document_prefix=os.getenv("EMBEDDING_DOCUMENT_PREFIX", ""),
+        )
+    if provider == "hash":
+        return HashProvider(dims or 256)
+    raise RuntimeError(f"未知的 EMBEDDING_PROVIDER: {provider}（openai | local | hash）")
@@ -0,0 +1,186 @@
+"""
+檢索結果融合
+
+各檢索來源（ES 關鍵字、ES 向量、ES 段落、MySQL 品號、MySQL 全文）的分數尺度不同：
+BM25 無上限、cosine 介於 0~1、MySQL 為命中加分。直接相加會讓某一來源主導排序，
+因此改由融合器依「排名」或「正規化後的分數」合併。
+
+rankings 格式：{來源名稱: [(文件鍵, 原始分數), ...]}，每個列表依分數由高到低排序。
+"""
+
+import json
+import logging
+import math
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Ranking = List[Tuple[str, float]]
+
+DEFAULT_WEIGHTS = {
+    "es_keyword": 1.0,
+    "es_vector": 1.0,
+    "es_passages": 1.0,
+    "mysql_products": 1.0,
+    "mysql_keywords": 0.5,
+    # ES rrf retriever 已合併關鍵字與向量兩個來源
+    "es_hybrid": 2.0,
+}
+
+
+class ResultFuser:
+    """融合器基底類別；子類別實作 _fuse"""
+
+    name = "base"
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+
+    def fuse(self, rankings: Dict[str, Ranking]) -> List[Tuple[str, float]]:
+        """回傳依融合分數由高到低排序的 [(文件鍵, 融合分數)]"""
+        scores: Dict[str, float] = {}
+        for source, ranking in rankings.items():
+            weight = self.weights.get(source, 1.0)
+            if weight <= 0 or not ranking:
+                continue
+            for key, value in self._fuse(ranking):
+                scores[key] = scores.get(key, 0.0) + weight * value
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def _fuse(self, ranking: Ranking) -> List[Tuple[str, float]]:
+        raise NotImplementedError
+
+
+class RRFFuser(ResultFuser):
+    """Reciprocal Rank Fusion：只看名次，score = Σ weight / (k + rank)"""
+
+    name = "rrf"
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, k: int = 60):
+        super().__init__(weights)
+        self.k = k
+
+    def _fuse(self, ranking: Ranking) -> List[Tuple[str, float]]:
+        contributions = []
+        rank = 0
+        previous = None
+        for position, (key, score) in enumerate(ranking, start=1):
+            # 同分視為同名次（例如品號命中集合）
+            if score != previous:
+                rank = position
+                previous = score
+            contributions.append((key, 1.0 / (self.k + rank)))
+        return contributions
+
+
+class MinMaxFuser(ResultFuser):
+    """各來源分數以 min-max 縮放到 0~1 後加權相加"""
+
+    name = "minmax"
+
+    def _fuse(self, ranking: Ranking) -> List[Tuple[str, float]]:
+        values = [score for _, score in ranking]
+        low, high = min(values), max(values)
+        if high == low:
+            return [(key, 1.0) for key, _ in ranking]
+        return [(key, (score - low) / (high - low)) for key, score in ranking]
+
+
+class ZScoreFuser(ResultFuser):
+    """各來源分數以 z-score 標準化後加權相加"""
+
+    name = "zscore"
+
+    def _fuse(self, ranking: Ranking) -> List[Tuple[str, float]]:
+        values = [score for _, score in ranking]
+        mean = sum(values) / len(values)
+        std = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+        if std == 0:
+            return [(key, 1.0) for key, _ in ranking]
+        return [(key, (score - mean) / std) for key, score in ranking]
+
+
+FUSERS = {
+    RRFFuser.name: RRFFuser,
+    MinMaxFuser.name: MinMaxFuser,
+    ZScoreFuser.name: ZScoreFuser,
+}
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """解析 "es_keyword=1,es_vector=1.5" 格式的權重設定"""
+    weights = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        source, value = item.split("=", 1)
+        try:
+            weights[source.strip()] = float(value)
+        except ValueError:
+            logger.warning(f"⚠️ 忽略無效的融合權重: {item}")
+    return weights
+
+
+def build_fuser(
+    method: str, weights: Optional[Dict[str, float]] = None, rrf_k: int = 60
+) -> ResultFuser:
+    """依名稱建立融合器；未知名稱退回 RRF"""
+    fuser_cls = FUSERS.get((method or "").lower())
+    if fuser_cls is None:
+        logger.warning(f"⚠️ 未知的融合方法 {method}，改用 rrf")
+        fuser_cls = RRFFuser
+    if fuser_cls is RRFFuser:
+        return RRFFuser(weights, k=rrf_k)
+    return fuser_cls(weights)
+
+
+class FusionEvalLogger:
+    """
+    離線評估掛鉤：將每次查詢的各來源排序與融合結果寫入 JSONL
+
+    記錄可搭配標註檔以 fusion_eval.py 重播，比較不同融合方法與權重，
+    不需再打 ES / MySQL。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def log(
+        self,
+        query: str,
+        mode: str,
+        method: str,
+        rankings: Dict[str, Ranking],
+        fused: List[Tuple[str, float]],
+    ):
+        if not self.path:
+            return
+        record = {
+            "ts": datetime.now().isoformat(),
+            "query": query,
+            "mode": mode,
+            "method": method,
+            "rankings": {
+                source: [[key, score] for key, score in ranking]
+                for source, ranking in rankings.items()
+            },
+            "fused": [[key, score] for key, score in fused],
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"⚠️ 寫入融合評估記錄失敗: {e}")
@@ -0,0 +1,120 @@
+"""
+融合方法離線評估
+
+重播 rag-api 以 FUSION_EVAL_LOG 記錄的各來源排序，對照人工標註計算
+Recall@k、MRR、nDCG@k，比較不同融合方法與權重。
+
+標註檔 (JSONL)，每行一筆：
+    {"query": "L112006 設變原因", "relevant": ["DOC_001", "DOC_017"]}
+
+用法：
+    python fusion_eval.py --log /logs/fusion_eval.jsonl --qrels qrels.jsonl \\
+        --methods rrf,minmax,zscore --weights "es_vector=1.5" --k 10
+"""
+
+import argparse
+import json
+import math
+import sys
+from typing import Dict, List
+
+from fusion import FUSERS, build_fuser, parse_weights
+
+
+def load_jsonl(path: str) -> List[Dict]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).lower()
+
+
+def recall_at_k(ranked: List[str], relevant: set, k: int) -> float:
+    if not relevant:
+        return 0.0
+    return len(set(ranked[:k]) & relevant) / len(relevant)
+
+
+def reciprocal_rank(ranked: List[str], relevant: set) -> float:
+    for position, key in enumerate(ranked, start=1):
+        if key in relevant:
+            return 1.0 / position
+    return 0.0
+
+
+def ndcg_at_k(ranked: List[str], relevant: set, k: int) -> float:
+    dcg = sum(
+        1.0 / math.log2(position + 1)
+        for position, key in enumerate(ranked[:k], start=1)
+        if key in relevant
+    )
+    ideal = sum(1.0 / math.log2(position + 1) for position in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def evaluate(records: List[Dict], qrels: Dict[str, set], fuser, k: int) -> Dict:
+    totals = {"recall": 0.0, "mrr": 0.0, "ndcg": 0.0}
+    evaluated = 0
+    for record in records:
+        relevant = qrels.get(normalize_query(record["query"]))
+        if not relevant:
+            continue
+        rankings = {
+            source: [(key, float(score)) for key, score in ranking]
+            for source, ranking in record["rankings"].items()
+        }
+        ranked = [key for key, _ in fuser.fuse(rankings)]
+        totals["recall"] += recall_at_k(ranked, relevant, k)
+        totals["mrr"] += reciprocal_rank(ranked, relevant)
+        totals["ndcg"] += ndcg_at_k(ranked, relevant, k)
+        evaluated += 1
+
+    if not evaluated:
+        return {"queries": 0}
+    return {"queries": evaluated, **{name: value / evaluated for name, value in totals.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="融合方法離線評估")
+    parser.add_argument("--log", required=True, help="FUSION_EVAL_LOG 記錄檔")
+    parser.add_argument("--qrels", required=True, help="人工標註 JSONL")
+    parser.add_argument("--methods", default=",".join(FUSERS), help="逗號分隔的融合方法")
+    parser.add_argument("--weights", default="", help='來源權重，例如 "es_vector=1.5"')
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parser.add_argument("--k", type=int, default=10, help="評估截斷名次")
+    args = parser.parse_args()
+
+    records = load_jsonl(args.log)
+    qrels = {
+        normalize_query(item["query"]): set(item.get("relevant", []))
+        for item in load_jsonl(args.qrels)
+    }
+    weights = parse_weights(args.weights)
+
+    results = {}
+    for method in [m.strip() for m in args.methods.split(",") if m.strip()]:
+        if method not in FUSERS:
+            print(f"未知的融合方法: {method}", file=sys.stderr)
+            continue
+        fuser = build_fuser(method, weights, rrf_k=args.rrf_k)
+        results[method] = evaluate(records, qrels, fuser, args.k)
+
+    print(f"{'method':<10}{'queries':>8}{'recall@' + str(args.k):>12}{'MRR':>8}{'nDCG@' + str(args.k):>10}")
+    for method, metrics in results.items():
+        if not metrics.get("queries"):
+            print(f"{method:<10}{0:>8}")
+            continue
+        print(
+            f"{method:<10}{metrics['queries']:>8}{metrics['recall']:>12.3f}"
+            f"{metrics['mrr']:>8.3f}{metrics['ndcg']:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+識別碼索引
+
+將 MySQL 中所有已知的品號與單號（產品代碼、通知單/申請單/異常單號、文檔編號、案號）
+載入記憶體，查詢時先行辨識：
+
+- 完全比對：正規化後（NFKC、大寫、去空白）的 dict 查詢
+- 前綴比對：排序後的鍵以 bisect 取範圍
+- 容錯比對：SymSpell 刪除法，預先產生每個鍵刪去 1..max_distance 個字元的變體，
+  查詢時以查詢字串的刪除變體取候選，再以 Damerau-Levenshtein（OSA）距離驗證
+
+建立一次後可用 update() 增量加入新資料；刪除的資料由定期全量重建清除。
+"""
+
+import re
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from itertools import combinations
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# 查詢中可能是識別碼的英數片段（允許以 - _ . / 連接）
+_TOKEN = re.compile(r"[A-Za-z0-9]+(?:[-_./][A-Za-z0-9]+)*")
+_DIGIT = re.compile(r"\d")
+
+# 超過此長度的鍵不產生刪除變體（僅能完全/前綴比對）
+MAX_FUZZY_KEY_LENGTH = 32
+
+
+def normalize_identifier(text: str) -> str:
+    """比對用的正規化：全形轉半形、大寫、去除空白"""
+    return "".join(unicodedata.normalize("NFKC", text or "").upper().split())
+
+
+def code_tokens(query: str) -> List[str]:
+    """查詢中像品號/單號的片段（含數字、長度 3 以上，依出現順序去重）"""
+    text = unicodedata.normalize("NFKC", query or "")
+    return [
+        token
+        for token in dict.fromkeys(_TOKEN.findall(text))
+        if len(token) >= 3 and _DIGIT.search(token)
+    ]
+
+
+def _deletes(key: str, max_distance: int) -> Set[str]:
+    """刪去 1..max_distance 個字元的所有變體"""
+    variants = set()
+    for distance in range(1, min(max_distance, len(key) - 1) + 1):
+        for positions in combinations(range(len(key)), distance):
+            variants.add("".join(c for i, c in enumerate(key) if i not in positions))
+    return variants
+
+
+def _osa_distance(a: str, b: str, limit: int) -> int:
+    """Damerau-Levenshtein（相鄰換位算一次）；超過 limit 時提早回傳 limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (
+                previous2 is not None
+                and i > 1
+                and j > 1
+                and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class IdentifierMatch(NamedTuple):
+    token: str  # 查詢中的原字串
+    value: str  # 資料庫中的正式值
+    kinds: FrozenSet[str]
+    match: str  # exact | prefix | fuzzy
+    distance: int
+
+
+class QueryIdentifiers(NamedTuple):
+    matches: Tuple[IdentifierMatch, ...] = ()
+    unresolved: Tuple[str, ...] = ()  # 像識別碼但索引中找不到的片段
+
+    def values(self, kind: Optional[str] = None) -> List[str]:
+        """辨識出的正式值（依出現順序去重），可限定種類"""
+        return list(
+            dict.fromkeys(
+                m.value for m in self.matches if kind is None or kind in m.kinds
+            )
+        )
+
+
+class IdentifierIndex:
+    """品號/單號的記憶體索引"""
+
+    def __init__(self, max_distance: int = 2, prefix_limit: int = 5):
+        self.max_distance = max_distance
+        self.prefix_limit = prefix_limit
+        # 正規化鍵 -> {"values": 正式值, "kinds": 種類, "doc_ids": 文件}
+        self._entries: Dict[str, Dict[str, set]] = {}
+        self._keys: List[str] = []
+        self._deletes: Dict[str, Set[str]] = {}
+        self.watermark = None  # 已載入資料的最大 last_modified
+        self.loaded_at: Optional[float] = None
+
+    @classmethod
+    def build(cls, rows: Iterable[Dict], **kwargs) -> "IdentifierIndex":
+        index = cls(**kwargs)
+        index.update(rows)
+        return index
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, rows: Iterable[Dict]):
+        """
+        加入資料列
+
+        Args:
+            rows: [{"kind", "value", "doc_id", "last_modified"}]
+        """
+        for row in rows:
+            value = str(row.get("value") or "").strip()
+            key = normalize_identifier(value)
+            if len(key) < 2:
+                continue
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"values": set(), "kinds": set(), "doc_ids": set()}
+                self._entries[key] = entry
+                insort(self._keys, key)
+                if len(key) <= MAX_FUZZY_KEY_LENGTH:
+                    for variant in _deletes(key, self.max_distance):
+                        self._deletes.setdefault(variant, set()).add(key)
+            entry["values"].add(value)
+            entry["kinds"].add(row["kind"])
+            if row.get("doc_id"):
+                entry["doc_ids"].add(row["doc_id"])
+            modified = row.get("last_modified")
+            if modified is not None and (self.watermark is None or modified > self.watermark):
+                self.watermark = modified
+        self.loaded_at = self.loaded_at or time.monotonic()
+
+    # ---------- 查詢 ----------
+    def exact(self, text: str) -> Optional[str]:
+        key = normalize_identifier(text)
+        return key if key in self._entries else None
+
+    def prefix(self, text: str, limit: Optional[int] = None) -> List[str]:
+        """以 text 開頭的鍵（最多 limit 個）"""
+        key = normalize_identifier(text)
+        limit = limit or self.prefix_limit
+        start = bisect_left(self._keys, key)
+        found = []
+        for candidate in self._keys[start:]:
+            if not candidate.startswith(key) or len(found) >= limit:
+                break
+            found.append(candidate)
+        return found
+
+    def fuzzy(self, text: str, max_distance: Optional[int] = None) -> List[Tuple[str, int]]:
+        """
+        編輯距離 max_distance 內最接近的鍵（同距離者依字母序）
+
+        由距離 1 開始逐步放寬，多數打錯一個字的查詢只需產生少量刪除變體。
+        """
+        key = normalize_identifier(text)
+        limit = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        for distance in range(1, limit + 1):
+            candidates = set()
+            for variant in {key} | _deletes(key, distance):
+                if variant in self._entries:
+                    candidates.add(variant)
+                candidates.update(self._deletes.get(variant, ()))
+            scored = [
+                (candidate, found)
+                for candidate in candidates
+                if (found := _osa_distance(key, candidate, distance)) <= distance
+            ]
+            if scored:
+                return sorted(scored, key=lambda item: (item[1], item[0]))
+        return []
+
+    def entry(self, key: str) -> Optional[Dict[str, set]]:
+        return self._entries.get(key)
+
+    def doc_ids(self, values: Iterable[str]) -> Set[str]:
+        """識別碼對應的文件 doc_id"""
+        found = set()
+        for value in values:
+            entry = self._entries.get(normalize_identifier(value))
+            if entry:
+                found |= entry["doc_ids"]
+        return found
+
+    @staticmethod
+    def _fuzzy_distance(key: str) -> int:
+        """短代碼只做完全比對，避免誤認其他代碼"""
+        if len(key) < 5:
+            return 0
+        return 1 if len(key) < 9 else 2
+
+    def resolve(self, query: str) -> QueryIdentifiers:
+        """
+        找出查詢中的識別碼：完全比對 → 前綴（候選不超過 prefix_limit）→ 容錯比對
+
+        只有含數字且長度 3 以上的片段會做前綴/容錯比對；純英文字只接受完全比對。
+        """
+        matches: List[IdentifierMatch] = []
+        unresolved: List[str] = []
+        text = unicodedata.normalize("NFKC", query or "")
+        for token in dict.fromkeys(_TOKEN.findall(text)):
+            if len(token) < 3:
+                continue
+            key = self.exact(token)
+            if key:
+                matches.extend(self._matches(token, [(key, 0)], "exact"))
+                continue
+            if not _DIGIT.search(token):
+                continue
+            normalized = normalize_identifier(token)
+            found = []
+            if len(normalized) >= 4:
+                prefixed = self.prefix(normalized, self.prefix_limit + 1)
+                if 0 < len(prefixed) <= self.prefix_limit:
+                    found = self._matches(token, [(k, 0) for k in prefixed], "prefix")
+            if not found:
+                fuzzy = self.fuzzy(normalized, self._fuzzy_distance(normalized))
+                if fuzzy:
+                    best = fuzzy[0][1]
+                    closest = [item for item in fuzzy if item[1] == best][:3]
+                    found = self._matches(token, closest, "fuzzy")
+            if found:
+                matches.extend(found)
+            else:
+                unresolved.append(token)
+        return QueryIdentifiers(tuple(matches), tuple(unresolved))
+
+    def _matches(self, token: str, keys: List[Tuple[str, int]], match: str) -> List[IdentifierMatch]:
+        found = []
+        for key, distance in keys:
+            entry = self._entries[key]
+            kinds = frozenset(entry["kinds"])
+            for value in sorted(entry["values"]):
+                found.append(IdentifierMatch(token, value, kinds, match, distance))
+        return found
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "identifiers": len(self._entries),
+            "identifier_delete_variants": len(self._deletes),
+        }
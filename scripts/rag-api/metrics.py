@@ -0,0 +1,239 @@
+"""
+RAG API 指標
+
+以 Prometheus 格式輸出各檢索階段延遲、外部呼叫與錯誤次數、快取命中率、
+進行中請求數與結果數分布。prometheus_client 未安裝時指標不輸出，
+但每個請求的階段耗時仍會記錄（供 debug 模式放入回應 metadata）。
+
+階段耗時以 ContextVar 保存：請求開始時 start_request() 建立新的 dict，
+之後同一請求衍生的 asyncio 任務與 to_thread 執行緒都會記錄到同一份。
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        CollectorRegistry,
+        Counter,
+        Gauge,
+        Histogram,
+        generate_latest,
+    )
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    CollectorRegistry = None
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+RESULT_SIZE_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 30, 50)
+
+_stage_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "stage_timings", default=None
+)
+
+
+class _NoopMetric:
+    """prometheus_client 未安裝時的替代品"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+
+class _StatsCollector:
+    """抓取時才讀取快取與連線池統計，不另外維護計數"""
+
+    def __init__(self, sources: Dict[str, Callable[[], Dict]]):
+        self.sources = sources
+
+    def collect(self):
+        hits = CounterMetricFamily(
+            "rag_cache_hits", "快取命中次數", labels=["cache"]
+        )
+        misses = CounterMetricFamily(
+            "rag_cache_misses", "快取未命中次數", labels=["cache"]
+        )
+        ratio = GaugeMetricFamily(
+            "rag_cache_hit_ratio", "快取命中率", labels=["cache"]
+        )
+        entries = GaugeMetricFamily(
+            "rag_cache_entries", "快取項目數", labels=["cache"]
+        )
+        pool = GaugeMetricFamily(
+            "rag_mysql_pool_connections", "MySQL 連線池連線數", labels=["state"]
+        )
+
+        for name, source in self.sources.items():
+            try:
+                stats = source()
+            except Exception as e:
+                logger.warning(f"⚠️ 讀取 {name} 統計失敗: {e}")
+                continue
+            if name == "mysql_pool":
+                pool.add_metric(["in_use"], stats.get("in_use", 0))
+                pool.add_metric(["idle"], stats.get("idle", 0))
+                continue
+            total = stats.get("hits", 0) + stats.get("misses", 0)
+            hits.add_metric([name], stats.get("hits", 0))
+            misses.add_metric([name], stats.get("misses", 0))
+            ratio.add_metric([name], stats.get("hits", 0) / total if total else 0.0)
+            if "size" in stats:
+                entries.add_metric([name], stats["size"])
+
+        yield from (hits, misses, ratio, entries, pool)
+
+
+class SearchMetrics:
+    def __init__(self):
+        self.enabled = CollectorRegistry is not None
+        if not self.enabled:
+            logger.warning("⚠️ 未安裝 prometheus_client，/metrics 停用")
+            noop = _NoopMetric()
+            self.stage_latency = self.stage_errors = noop
+            self.external_calls = self.external_errors = noop
+            self.requests = self.request_latency = self.in_flight = noop
+            self.result_size = noop
+            return
+
+        self.registry = CollectorRegistry()
+        self.stage_latency = Histogram(
+            "rag_stage_duration_seconds",
+            "檢索各階段耗時",
+            ["stage"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.stage_errors = Counter(
+            "rag_stage_errors_total",
+            "檢索階段逾時或失敗次數",
+            ["stage", "reason"],
+            registry=self.registry,
+        )
+        self.external_calls = Counter(
+            "rag_external_calls_total",
+            "外部服務呼叫次數",
+            ["service", "operation"],
+            registry=self.registry,
+        )
+        self.external_errors = Counter(
+            "rag_external_errors_total",
+            "外部服務呼叫失敗次數",
+            ["service", "operation"],
+            registry=self.registry,
+        )
+        self.requests = Counter(
+            "rag_requests_total",
+            "API 請求次數",
+            ["endpoint", "status"],
+            registry=self.registry,
+        )
+        self.request_latency = Histogram(
+            "rag_request_duration_seconds",
+            "API 請求耗時",
+            ["endpoint"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.in_flight = Gauge(
+            "rag_requests_in_flight",
+            "進行中的 API 請求數",
+            ["endpoint"],
+            registry=self.registry,
+        )
+        self.result_size = Histogram(
+            "rag_result_documents",
+            "每次檢索回傳的文件數",
+            ["mode"],
+            buckets=RESULT_SIZE_BUCKETS,
+            registry=self.registry,
+        )
+
+    def register_stats(self, sources: Dict[str, Callable[[], Dict]]):
+        """註冊抓取時讀取的統計來源（快取、連線池）"""
+        if self.enabled:
+            self.registry.register(_StatsCollector(sources))
+
+    def render(self) -> bytes:
+        return generate_latest(self.registry)
+
+    # ---------- 請求層級 ----------
+    @staticmethod
+    def start_request() -> Dict[str, float]:
+        """為目前的請求（及其衍生任務）建立新的階段耗時記錄"""
+        timings: Dict[str, float] = {}
+        _stage_timings.set(timings)
+        return timings
+
+    @staticmethod
+    def current_timings() -> Optional[Dict[str, float]]:
+        return _stage_timings.get()
+
+    @contextlib.contextmanager
+    def request(self, endpoint: str):
+        """進行中請求數、請求次數（依結果）與耗時"""
+        self.in_flight.labels(endpoint).inc()
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.in_flight.labels(endpoint).dec()
+            self.requests.labels(endpoint, status).inc()
+            self.request_latency.labels(endpoint).observe(time.perf_counter() - started)
+
+    # ---------- 階段與外部呼叫 ----------
+    def record_stage(self, name: str, seconds: float):
+        self.stage_latency.labels(name).observe(seconds)
+        timings = _stage_timings.get()
+        if timings is not None:
+            timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 1)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """記錄一個階段的耗時（同一請求內同名階段累加）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - started)
+
+    def stage_failed(self, name: str, reason: str):
+        self.stage_errors.labels(name, reason).inc()
+
+    @contextlib.contextmanager
+    def external(self, service: str, operation: str):
+        """外部呼叫（ES / MySQL / OpenAI）的次數與失敗次數"""
+        self.external_calls.labels(service, operation).inc()
+        try:
+            yield
+        except Exception:
+            self.external_errors.labels(service, operation).inc()
+            raise
+
+    def observe_results(self, mode: str, count: int):
+        self.result_size.labels(mode).observe(count)
+
+
+metrics = SearchMetrics()
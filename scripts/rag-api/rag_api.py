@@ -4,21 +4,33 @@
 文件管理 RAG API 服務 - 多索引版本
 """
 
-import os, json, logging, requests, pymysql, re
+import os, json, logging, pymysql, re, asyncio, threading, time, hashlib, sqlite3
+import unicodedata, contextlib, math, copy
+import httpx
+from array import array
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
-from requests.auth import HTTPBasicAuth
 from pymysql.cursors import DictCursor
 from urllib.parse import quote
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
 except ImportError:
-    OpenAI = None
+    AsyncOpenAI = None
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+
+from embeddings import EmbeddingProvider, build_provider
+from fusion import FUSERS, FusionEvalLogger, build_fuser, parse_weights
+from identifiers import IdentifierIndex, QueryIdentifiers, code_tokens
+from metrics import CONTENT_TYPE_LATEST, metrics
+from segmenter import QuerySegmenter, lexicon_terms
+from snippets import clean_content, extract_snippets
 
 # ==================== 環境配置 ====================
 ES_URL = os.getenv("ES_URL", "http://elasticsearch:9200")
@@ -36,11 +48,202 @@ MYSQL_DATABASE = os.getenv("MYSQL_DATABASE", "fuhsin_erp_demo")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 GPT_MODEL = os.getenv("GPT_MODEL", "gpt-4o-mini")
 
 FILE_SERVICE_PUBLIC_URL = os.getenv("FILE_SERVICE_PUBLIC_URL", "http://localhost:8088")
 
+# MySQL 連線池
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "10"))
+MYSQL_POOL_MAX_LIFETIME = float(os.getenv("MYSQL_POOL_MAX_LIFETIME", "1800"))
+MYSQL_POOL_PING_INTERVAL = float(os.getenv("MYSQL_POOL_PING_INTERVAL", "30"))
+MYSQL_POOL_ACQUIRE_TIMEOUT = float(os.getenv("MYSQL_POOL_ACQUIRE_TIMEOUT", "5"))
+
+# MySQL 全文搜尋：每張表最多取回的筆數
+FULLTEXT_LIMIT = int(os.getenv("FULLTEXT_LIMIT", "100"))
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191
+ER_BAD_FIELD_ERROR = 1054
+
+# 外部呼叫逾時與斷線偵測
+ES_TIMEOUT = float(os.getenv("ES_TIMEOUT", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+# 檢索階段逾時（秒）；SEARCH_DEADLINE 為所有階段合計的上限
+STAGE_TIMEOUT_MYSQL = float(os.getenv("STAGE_TIMEOUT_MYSQL", "3"))
+STAGE_TIMEOUT_KEYWORD = float(os.getenv("STAGE_TIMEOUT_KEYWORD", "5"))
+STAGE_TIMEOUT_VECTOR = float(os.getenv("STAGE_TIMEOUT_VECTOR", "8"))
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "10"))
+
+# 查詢向量快取（EMBEDDING_CACHE_PATH 留空則不啟用磁碟層）
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2000"))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+EMBEDDING_DISK_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_DISK_CACHE_MAX_ROWS", "100000"))
+EMBEDDING_DISK_CACHE_PRUNE_EVERY = 500  # 每寫入幾筆清理一次
+
+# 搜尋結果快取；以 db-sync 狀態檔的 last_modified 水位判斷失效
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "500"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "600"))
+RESULT_CACHE_NEGATIVE_TTL = int(os.getenv("RESULT_CACHE_NEGATIVE_TTL", "30"))
+SYNC_STATE_FILE = os.getenv("SYNC_STATE_FILE", "/state/.sync_state.json")
+WATERMARK_CHECK_INTERVAL = float(os.getenv("WATERMARK_CHECK_INTERVAL", "2"))
+
+# 結果融合：FUSION_METHOD 為 rrf | minmax | zscore
+# FUSION_WEIGHTS 格式 "es_keyword=1,es_vector=1,mysql_products=1,mysql_keywords=0.5"
+# FUSION_CANDIDATE_FACTOR 為每個 ES 來源取回 top_k 的倍數
+FUSION_METHOD = os.getenv("FUSION_METHOD", "rrf")
+FUSION_WEIGHTS = parse_weights(os.getenv("FUSION_WEIGHTS", ""))
+FUSION_RRF_K = int(os.getenv("FUSION_RRF_K", "60"))
+FUSION_CANDIDATE_FACTOR = float(os.getenv("FUSION_CANDIDATE_FACTOR", "1"))
+FUSION_EVAL_LOG = os.getenv("FUSION_EVAL_LOG", "")
+
+# 單一查詢的 ES 搜尋送出方式（批次端點一律合併為一次 _msearch）
+#   separate：關鍵字、向量、段落搜尋各自送出
+#   msearch：查詢向量備妥後以一次 _msearch 送出，仍由 rag-api 融合（預設）
+#   retriever：hybrid 且融合方法為 rrf 時，關鍵字與 kNN 以 ES rrf retriever 合併為單一排序（es_hybrid）；
+#              叢集不支援（版本或授權，背景探測）時同 msearch
+ES_SEARCH_TRANSPORT = os.getenv("ES_SEARCH_TRANSPORT", "msearch").lower()
+
+# 段落索引（db-sync 由 technical_documents.content 切出）
+PASSAGE_INDEX = os.getenv("PASSAGE_INDEX", "erp-passages")
+PASSAGE_TOP_K = int(os.getenv("PASSAGE_TOP_K", "30"))
+PASSAGES_PER_DOC = int(os.getenv("PASSAGES_PER_DOC", "3"))
+STAGE_TIMEOUT_PASSAGE = float(os.getenv("STAGE_TIMEOUT_PASSAGE", "5"))
+# 合併送出（msearch / retriever）時等待查詢向量的上限：保留關鍵字、段落搜尋的時間，
+# 逾時則不帶向量送出，關鍵字結果不受 embeddings 延遲影響
+COMBINED_EMBEDDING_TIMEOUT = max(
+    0.5,
+    min(
+        STAGE_TIMEOUT_VECTOR,
+        SEARCH_DEADLINE - max(STAGE_TIMEOUT_KEYWORD, STAGE_TIMEOUT_PASSAGE),
+    ),
+)
+GPT_PASSAGE_CHARS = int(os.getenv("GPT_PASSAGE_CHARS", "600"))
+
+# 批次查詢（/query/batch）：一次 embeddings 呼叫 + 一次 _msearch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_SEARCH_DEADLINE = float(os.getenv("BATCH_SEARCH_DEADLINE", "30"))
+BATCH_GPT_CONCURRENCY = int(os.getenv("BATCH_GPT_CONCURRENCY", "4"))
+
+# /health 與 /stats 的背景快照
+STATUS_REFRESH_INTERVAL = float(os.getenv("STATUS_REFRESH_INTERVAL", "10"))
+STATUS_STALE_AFTER = float(
+    os.getenv("STATUS_STALE_AFTER", str(STATUS_REFRESH_INTERVAL * 3))
+)
+
+# 查詢斷詞：IK 設定目錄（rag-api 掛載 config/analysis-ik）與查詢端領域字典
+# 品名、客戶名稱自 LEXICON_TABLES 讀入，同步水位前進時重建
+IK_CONFIG_DIR = os.getenv("IK_CONFIG_DIR", "/ik")
+QUERY_DICT_FILES = [
+    path
+    for path in os.getenv(
+        "QUERY_DICT_FILES", os.path.join(IK_CONFIG_DIR, "erp_query_dict.txt")
+    ).split(",")
+    if path.strip()
+]
+LEXICON_TABLES = [
+    "ecn_notices",
+    "ecn_applications",
+    "complaint_records",
+    "structured_documents",
+]
+
+# 識別碼索引：品號與各類單號載入記憶體，查詢前先行辨識（含前綴與容錯比對）
+# 同步水位前進時增量載入，每 IDENTIFIER_FULL_RELOAD 秒全量重建以清除已刪除資料
+IDENTIFIER_FULL_RELOAD = float(os.getenv("IDENTIFIER_FULL_RELOAD", "3600"))
+IDENTIFIER_MAX_DISTANCE = int(os.getenv("IDENTIFIER_MAX_DISTANCE", "2"))
+IDENTIFIER_PREFIX_LIMIT = int(os.getenv("IDENTIFIER_PREFIX_LIMIT", "5"))
+# (資料表, doc_id 欄位, 識別碼欄位, 種類)
+IDENTIFIER_COLUMNS = [
+    ("ecn_notices", "doc_id", "product_code", "product_code"),
+    ("ecn_notices", "doc_id", "notice_number", "notice_number"),
+    ("ecn_notices", "doc_id", "application_number", "application_number"),
+    ("ecn_applications", "doc_id", "product_code", "product_code"),
+    ("ecn_applications", "doc_id", "application_number", "application_number"),
+    ("complaint_records", "doc_id", "product_code", "product_code"),
+    ("complaint_records", "doc_id", "complaint_number", "complaint_number"),
+    ("fmea_records", "doc_id", "case_number", "case_number"),
+    ("structured_documents", "original_doc_id", "doc_number", "doc_number"),
+]
+# 查詢只由下列種類的識別碼（完全比對）組成時走快速路徑：直接 terms 查詢，略過向量、MySQL 與 GPT
+IDENTIFIER_FAST_PATH = os.getenv("IDENTIFIER_FAST_PATH", "true").lower() in ("true", "1", "yes")
+FAST_PATH_KINDS = {
+    "doc_number",
+    "notice_number",
+    "application_number",
+    "complaint_number",
+    "case_number",
+}
+IDENTIFIER_TABLES = list(dict.fromkeys(table for table, _, _, _ in IDENTIFIER_COLUMNS))
+# 辨識出的識別碼以 terms 查詢比對的 ES 欄位（皆為 keyword）
+IDENTIFIER_FIELDS = [
+    "doc_number",
+    "notice_number",
+    "application_number",
+    "complaint_number",
+    "case_number",
+    "product_code",
+    "product_codes",
+]
+# db-sync 為上列欄位建立 .norm（去分隔符、小寫）與 .prefix（edge-ngram）子欄位，
+# 索引的 _meta.identifier_fields 達到此版本後關鍵字搜尋不再預設 fuzziness，
+# 只在子欄位比對無命中時以 fuzziness 重查
+IDENTIFIER_SUBFIELDS_VERSION = 1
+IDENTIFIER_PREFIX_MIN_LENGTH = 4
+
+# 結果摺疊：db-sync 寫入 collapse_key（同一文件跨索引、同一 FMEA 案號共用），
+# 範圍內索引的 _meta.collapse_key 都達到此版本才啟用 ES collapse
+COLLAPSE_KEY_VERSION = 1
+COLLAPSE_INNER_HITS = int(os.getenv("COLLAPSE_INNER_HITS", "5"))
+COLLAPSE_INNER_FIELDS = [
+    "doc_id",
+    "original_doc_id",
+    "doc_type",
+    "doc_number",
+    "notice_number",
+    "application_number",
+    "complaint_number",
+    "case_number",
+    "analysis_item",
+]
+
+# 索引 -> 來源資料表（db-sync-2 的同步對應）
+INDEX_SOURCE_TABLES = {
+    "erp-ecn-notices": "ecn_notices",
+    "erp-ecn-applications": "ecn_applications",
+    "erp-complaint-records": "complaint_records",
+    "erp-fmea": "fmea_records",
+    "erp-structure": "structured_documents",
+}
+
+# 文件詳情（/document、/documents）：technical_documents 為主表，一次查詢 LEFT JOIN
+# 摘要表與各類型專屬表（皆以 doc_id 一對一）；結果放入依位元組數淘汰的 LRU 快取，
+# 快取鍵含 DETAIL_TABLES 的同步水位
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+DOCUMENT_CACHE_TTL = int(os.getenv("DOCUMENT_CACHE_TTL", "3600"))
+DOCUMENT_CACHE_NEGATIVE_TTL = int(os.getenv("DOCUMENT_CACHE_NEGATIVE_TTL", "30"))
+DOCUMENT_BATCH_MAX_IDS = int(os.getenv("DOCUMENT_BATCH_MAX_IDS", "50"))
+# (資料表, 對應 technical_documents.doc_id 的欄位)
+DETAIL_JOINS = [
+    ("structured_documents", "original_doc_id"),
+    ("ecn_notices", "doc_id"),
+    ("ecn_applications", "doc_id"),
+    ("complaint_records", "doc_id"),
+    ("fmea_records", "doc_id"),
+]
+DETAIL_TABLES = ["technical_documents"] + [table for table, _ in DETAIL_JOINS]
+
+# 文件類型 -> 專屬索引；erp-structure 與段落索引另以 doc_type 欄位過濾
+STRUCTURE_INDEX = "erp-structure"
+DOC_TYPE_INDICES = {
+    "ECN_NOTICE": "erp-ecn-notices",
+    "ECN_APPLICATION": "erp-ecn-applications",
+    "COMPLAINT": "erp-complaint-records",
+    "FMEA": "erp-fmea",
+}
+# 各索引的文件日期欄位（段落索引由 db-sync 帶入 doc_date）
+DATE_FIELDS = ["doc_date", "ecn_date", "form_date"]
+
 # ==================== 日誌配置 ====================
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -63,29 +266,6 @@ app.add_middleware(
 )
 
 
-# ==================== 工具函數 ====================
-def clean_content(text: str, preserve_line_breaks: bool = True) -> str:
-    """清理文本中的無用標記"""
-    if not text:
-        return text
-
-    # 移除頁碼標記
-    text = re.sub(r"\[第\s*\d+\s*頁\]", "", text)
-    text = re.sub(r"【第\s*\d+\s*頁】", "", text)
-    text = re.sub(r"Page\s+\d+", "", text, flags=re.IGNORECASE)
-
-    if preserve_line_breaks:
-        # 保留換行，只清理多餘空格
-        text = re.sub(r"[ \t]+", " ", text)
-        text = re.sub(r"\n{3,}", "\n\n", text)
-        text = "\n".join(line.strip() for line in text.split("\n"))
-    else:
-        # 合併所有空白字符
-        text = re.sub(r"\s+", " ", text)
-
-    return text.strip()
-
-
 # ==================== 數據模型 ====================
 class SearchRequest(BaseModel):
     query: str = Field(..., description="搜尋查詢字串")
@@ -96,6 +276,19 @@ class SearchRequest(BaseModel):
     date_from: Optional[str] = Field(None, description="起始日期 (YYYY-MM-DD)")
     date_to: Optional[str] = Field(None, description="結束日期 (YYYY-MM-DD)")
     department: Optional[str] = Field(None, description="部門過濾")
+    fusion: Optional[str] = Field(
+        None, description="結果融合方法: rrf | minmax | zscore（預設 FUSION_METHOD）"
+    )
+    debug: bool = Field(False, description="在 metadata.stages_ms 附上各階段耗時")
+
+    @field_validator("date_from", "date_to")
+    @classmethod
+    def _check_date(cls, value: Optional[str]) -> Optional[str]:
+        value = (value or "").strip()
+        if not value:
+            return None
+        datetime.strptime(value, "%Y-%m-%d")
+        return value
 
 
 class DocumentInfo(BaseModel):
@@ -114,6 +307,8 @@ class DocumentInfo(BaseModel):
     score: float = 0.0
     highlight: Optional[Dict] = None
     index_name: Optional[str] = None
+    passages: Optional[List[Dict[str, Any]]] = None
+    related: Optional[List[Dict[str, Any]]] = None  # 摺疊進同一結果的其他記錄
 
 
 class SearchResponse(BaseModel):
@@ -127,6 +322,20 @@ class SearchResponse(BaseModel):
     metadata: Dict[str, Any] = {}
 
 
+class BatchSearchRequest(BaseModel):
+    requests: List[SearchRequest] = Field(
+        ..., min_length=1, max_length=BATCH_MAX_ITEMS, description="搜尋請求列表"
+    )
+
+
+class BatchSearchResponse(BaseModel):
+    success: bool
+    total: int
+    results: List[SearchResponse]
+    search_time_ms: int
+    metadata: Dict[str, Any] = {}
+
+
 # ==================== 文件 URL 處理器 ====================
 class FileURLHandler:
     """處理文件 URL 生成"""
@@ -163,100 +372,886 @@ class FileURLHandler:
         return public_url
 
 
+# ==================== 快取 ====================
+class TTLCache:
+    """執行緒安全的 LRU + TTL 快取，附命中統計"""
+
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class SizedLRUCache:
+    """
+    以位元組數為上限的 LRU + TTL 快取（值大小差異大時使用，例如含全文的文件詳情）
+
+    大小由呼叫端提供；單一項目超過上限時不寫入。
+    """
+
+    def __init__(self, name: str, max_bytes: int, ttl: float):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, size, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.bytes -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size: int, ttl: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._data[key] = (value, size, expires_at)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self._data.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class EmbeddingDiskCache:
+    """查詢向量的 SQLite 磁碟層，服務重啟後仍可命中"""
+
+    def __init__(self, path: str, ttl: float, max_rows: int = EMBEDDING_DISK_CACHE_MAX_ROWS):
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_created_at ON embeddings (created_at)"
+        )
+        self._conn.commit()
+        with self._lock:
+            self._prune()
+
+    def _prune(self):
+        """刪除過期資料，超過 max_rows 時由最舊的開始刪除（呼叫端需持有鎖）"""
+        cursor = self._conn.execute(
+            "DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.ttl,)
+        )
+        removed = cursor.rowcount
+        if self.max_rows > 0:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_rows:
+                cursor = self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY created_at LIMIT ?)",
+                    (count - self.max_rows,),
+                )
+                removed += cursor.rowcount
+        self._conn.commit()
+        if removed > 0:
+            self.pruned += removed
+            logger.debug(f"向量磁碟快取清除 {removed} 筆")
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row and time.time() - row[1] < self.ttl:
+            self.hits += 1
+            return array("f", row[0]).tolist()
+        self.misses += 1
+        return None
+
+    def set(self, key: str, vector: List[float]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                (key, array("f", vector).tobytes(), time.time()),
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % EMBEDDING_DISK_CACHE_PRUNE_EVERY == 0:
+                self._prune()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "max_rows": self.max_rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "pruned": self.pruned,
+        }
+
+
+class SyncWatermarks:
+    """
+    讀取 db-sync-2 StateManager 的狀態檔，提供各資料表的 last_modified 水位
+
+    狀態檔僅在 mtime 改變時重新解析，且最多每 WATERMARK_CHECK_INTERVAL 秒 stat 一次。
+    """
+
+    def __init__(self, state_file: str = SYNC_STATE_FILE):
+        self.state_file = state_file
+        self._state: Dict[str, Any] = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < WATERMARK_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.state_file).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self._state = json.load(f)
+            self._mtime = mtime
+        except Exception as e:
+            # db-sync 寫檔途中可能讀到不完整 JSON，下次再試
+            logger.debug(f"讀取同步狀態檔失敗: {e}")
+
+    def token(self, tables: List[str]) -> tuple:
+        """回傳指定資料表的水位組合；任一表前進即代表資料已變動"""
+        with self._lock:
+            self._refresh()
+            return tuple(
+                (self._state.get(table) or {}).get("last_modified") for table in tables
+            )
+
+
 # ==================== 向量生成器 ====================
+def normalize_query_text(text: str) -> str:
+    """正規化查詢文字（全半形、空白），作為快取鍵與向量輸入"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+@lru_cache(maxsize=256)
+def build_search_scope(
+    doc_types: tuple, date_from: Optional[str], date_to: Optional[str], department: Optional[str]
+) -> tuple:
+    """
+    將請求的過濾條件轉成搜尋範圍
+
+    doc_type 先縮小索引範圍（只留對應的專屬索引與 erp-structure），
+    其餘條件轉成 bool.filter / knn.filter 子句；filter 不計分，ES 會快取其結果。
+    同一組子句也適用段落索引（doc_type / doc_date / department 欄位）。
+
+    Returns:
+        (索引字串, filter 子句 tuple)
+    """
+    filters = []
+    indices = ES_INDEX_PATTERN
+    if doc_types:
+        typed = [DOC_TYPE_INDICES[t] for t in doc_types if t in DOC_TYPE_INDICES]
+        indices = ",".join(
+            index
+            for index in ES_INDEX_PATTERN.split(",")
+            if index in typed or index == STRUCTURE_INDEX
+        )
+        should = [{"terms": {"doc_type": list(doc_types)}}]
+        if typed:
+            should.append({"terms": {"_index": typed}})
+        filters.append({"bool": {"should": should, "minimum_should_match": 1}})
+
+    if date_from or date_to:
+        bounds = {"format": "yyyy-MM-dd"}
+        if date_from:
+            bounds["gte"] = date_from
+        if date_to:
+            bounds["lte"] = date_to
+        filters.append(
+            {
+                "bool": {
+                    "should": [{"range": {field: bounds}} for field in DATE_FIELDS],
+                    "minimum_should_match": 1,
+                }
+            }
+        )
+
+    if department:
+        # erp-fmea 的 department 為動態映射的 text（含 .keyword 子欄位）
+        filters.append(
+            {
+                "bool": {
+                    "should": [
+                        {"term": {"department": department}},
+                        {"term": {"department.keyword": department}},
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        )
+
+    return indices, tuple(filters)
+
+
 class VectorGenerator:
     def __init__(self):
-        self.client = None
-        if OPENAI_API_KEY and OpenAI:
-            self.client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-            self.model = EMBEDDING_MODEL
-            logger.info(f"向量生成器初始化: {EMBEDDING_MODEL}")
-
-    def generate(self, text: str) -> Optional[List[float]]:
-        if not self.client or not text:
+        self.provider: Optional[EmbeddingProvider] = None
+        # 向量由其他提供者 / 模型產生的索引（由狀態快照依 mapping _meta 更新）
+        self.incompatible_indices: set = set()
+        self.cache = TTLCache("embedding", EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+        self.disk_cache = None
+        # 同一文字的並行請求共用一次 API 呼叫（記錄/段落向量搜尋同時需要查詢向量）
+        self._inflight: Dict[str, asyncio.Future] = {}
+        if EMBEDDING_CACHE_PATH:
+            try:
+                self.disk_cache = EmbeddingDiskCache(
+                    EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_TTL
+                )
+                logger.info(f"向量磁碟快取: {EMBEDDING_CACHE_PATH}")
+            except Exception as e:
+                logger.warning(f"向量磁碟快取停用: {e}")
+
+        try:
+            self.provider = build_provider(timeout=OPENAI_TIMEOUT)
+            logger.info(f"向量生成器初始化: {self.provider.signature()}")
+        except RuntimeError as e:
+            logger.warning(f"⚠️ 向量生成停用: {e}")
+
+    def _cache_key(self, text: str) -> str:
+        # 快取鍵含提供者與維度，切換模型後不會取到舊向量
+        return hashlib.sha1(
+            f"{self.provider.name}\x00{self.provider.model}\x00"
+            f"{self.provider.dimension}\x00{text}".encode("utf-8")
+        ).hexdigest()
+
+    async def aclose(self):
+        if self.provider:
+            await self.provider.aclose()
+
+    def update_compatibility(self, mappings: Dict[str, Dict]):
+        """依各索引 _meta.embedding 與 content_vector 維度，記錄與目前提供者不一致的索引"""
+        if not self.provider:
+            return
+        incompatible = set()
+        for index, body in mappings.items():
+            mapping = body.get("mappings", {})
+            dims = mapping.get("properties", {}).get("content_vector", {}).get("dims")
+            meta = mapping.get("_meta", {}).get("embedding")
+            if self.provider.compatible_with(meta, dims):
+                continue
+            incompatible.add(index)
+            if index not in self.incompatible_indices:
+                logger.error(
+                    f"❌ {index} 的向量來源 {meta or f'{dims} 維（未記錄）'} 與目前 "
+                    f"{self.provider.signature()} 不一致，向量搜尋略過此索引（需重建向量）"
+                )
+        self.incompatible_indices = incompatible
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        if not self.provider:
+            return None
+        return {
+            **self.provider.signature(),
+            "incompatible_indices": sorted(self.incompatible_indices),
+        }
+
+    def vector_indices(self, indices: str) -> str:
+        """去除向量不相容的索引；全部不相容時回傳空字串"""
+        if not self.incompatible_indices:
+            return indices
+        return ",".join(
+            index for index in indices.split(",") if index not in self.incompatible_indices
+        )
+
+    async def generate(self, text: str) -> Optional[List[float]]:
+        text = normalize_query_text(text)[:8000]
+        if not self.provider or not text:
             return None
+
+        key = self._cache_key(text)
+        vector = self.cache.get(key)
+        if vector is not None:
+            return vector
+
+        pending = self._inflight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(key, text))
+            self._inflight[key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield：單一呼叫者逾時取消時不影響其他等待者
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, key: str, text: str) -> Optional[List[float]]:
+        if self.disk_cache:
+            vector = await asyncio.to_thread(self.disk_cache.get, key)
+            if vector is not None:
+                self.cache.set(key, vector)
+                return vector
+
         try:
-            response = self.client.embeddings.create(
-                model=self.model, input=text[:8000]
-            )
-            return response.data[0].embedding
+            with (
+                metrics.stage("embedding"),
+                metrics.external(self.provider.name, "embeddings"),
+            ):
+                vector = (await self.provider.aembed([text]))[0]
         except Exception as e:
             logger.error(f"向量生成失敗: {e}")
             return None
 
+        self.cache.set(key, vector)
+        if self.disk_cache:
+            try:
+                await asyncio.to_thread(self.disk_cache.set, key, vector)
+            except Exception as e:
+                logger.warning(f"寫入向量磁碟快取失敗: {e}")
+        return vector
+
+    async def generate_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        批次產生向量：快取未命中的文字合併為一次 embeddings 呼叫
+
+        Returns:
+            與 texts 對應的向量列表（無法產生者為 None）
+        """
+        texts = [normalize_query_text(text)[:8000] for text in texts]
+        if not self.provider:
+            return [None] * len(texts)
+
+        keys = [self._cache_key(text) if text else None for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key is None or key in vectors or key in missing:
+                continue
+            vector = self.cache.get(key)
+            if vector is not None:
+                vectors[key] = vector
+            else:
+                missing[key] = text
+
+        if missing and self.disk_cache:
+            stored = await asyncio.to_thread(
+                lambda: {key: self.disk_cache.get(key) for key in missing}
+            )
+            for key, vector in stored.items():
+                if vector is not None:
+                    vectors[key] = vector
+                    self.cache.set(key, vector)
+                    del missing[key]
+
+        if missing:
+            try:
+                with (
+                    metrics.stage("embedding"),
+                    metrics.external(self.provider.name, "embeddings"),
+                ):
+                    embedded = await self.provider.aembed(list(missing.values()))
+                fetched = dict(zip(missing, embedded))
+            except Exception as e:
+                logger.error(f"批次向量生成失敗: {e}")
+                fetched = {}
+
+            for key, vector in fetched.items():
+                vectors[key] = vector
+                self.cache.set(key, vector)
+            if fetched and self.disk_cache:
+                try:
+                    await asyncio.to_thread(
+                        lambda: [self.disk_cache.set(k, v) for k, v in fetched.items()]
+                    )
+                except Exception as e:
+                    logger.warning(f"寫入向量磁碟快取失敗: {e}")
+
+        return [vectors.get(key) if key else None for key in keys]
+
+    def cache_stats(self) -> Dict[str, Any]:
+        stats = {"memory": self.cache.stats()}
+        if self.disk_cache:
+            stats["disk"] = self.disk_cache.stats()
+        return stats
+
+
+# ==================== MySQL 連線池 ====================
+class MySQLConnectionPool:
+    """
+    有上限、執行緒安全的 MySQL 連線池
+
+    - 最多 size 條連線同時借出，超過則等待（最多 acquire_timeout 秒）
+    - 閒置超過 ping_interval 的連線借出前先 ping，超過 max_lifetime 則重建
+    - 記錄借用等待時間，供 /stats 觀察連線池是否吃緊
+    """
+
+    def __init__(
+        self,
+        size: int = MYSQL_POOL_SIZE,
+        max_lifetime: float = MYSQL_POOL_MAX_LIFETIME,
+        ping_interval: float = MYSQL_POOL_PING_INTERVAL,
+        acquire_timeout: float = MYSQL_POOL_ACQUIRE_TIMEOUT,
+    ):
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle: List[list] = []  # [connection, created_at, last_used_at]
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+        self.in_use = 0
+        self.acquired = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _create_connection(self) -> list:
+        conn = pymysql.connect(
+            host=MYSQL_HOST,
+            port=MYSQL_PORT,
+            user=MYSQL_USER,
+            password=MYSQL_PASSWORD,
+            database=MYSQL_DATABASE,
+            cursorclass=DictCursor,
+            charset="utf8mb4",
+            autocommit=True,  # 唯讀查詢，避免重用連線時停留在舊快照
+        )
+        self.created += 1
+        now = time.monotonic()
+        return [conn, now, now]
+
+    def _discard(self, entry: list):
+        self.discarded += 1
+        try:
+            entry[0].close()
+        except Exception:
+            pass
+
+    def acquire(self) -> list:
+        """借出連線（阻塞）"""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"MySQL 連線池已滿，等待超過 {self.acquire_timeout}s")
+
+        waited = time.monotonic() - started
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    return self._create_connection()
+
+                now = time.monotonic()
+                if now - entry[1] > self.max_lifetime:
+                    self._discard(entry)
+                    continue
+                if now - entry[2] > self.ping_interval:
+                    try:
+                        entry[0].ping(reconnect=False)
+                    except Exception:
+                        self._discard(entry)
+                        continue
+                return entry
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+            raise
+
+    def release(self, entry: list, broken: bool = False):
+        """歸還連線；損壞的連線直接關閉"""
+        if broken or not entry[0].open:
+            self._discard(entry)
+        else:
+            entry[2] = time.monotonic()
+            with self._lock:
+                self._idle.append(entry)
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        entry = self.acquire()
+        broken = False
+        try:
+            yield entry[0]
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(entry, broken)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            try:
+                entry[0].close()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "in_use": self.in_use,
+            "idle": len(self._idle),
+            "acquired": self.acquired,
+            "created": self.created,
+            "discarded": self.discarded,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total / self.acquired * 1000, 2)
+            if self.acquired
+            else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
+
 
 # ==================== MySQL 管理器 ====================
 class MySQLManager:
+    """
+    MySQL 查詢（同步 pymysql + 連線池）
+
+    由 DocumentSearchService 透過 run() 在工作執行緒中呼叫，避免阻塞事件迴圈；
+    每次查詢自連線池借用獨立連線，不同請求的查詢可並行執行。
+    """
+
     def __init__(self):
-        self.connection = None
+        self.pool = MySQLConnectionPool()
+        self.fulltext_available = True
+        self.precomputed_text_available = True
+        self._detail_columns: Optional[Dict[str, List[str]]] = None
 
-    def ensure_connection(self):
-        """確保 MySQL 連接"""
+    def ping(self) -> bool:
+        """檢查 MySQL 是否可連線"""
         try:
-            if not self.connection or not self.connection.open:
-                self.connection = pymysql.connect(
-                    host=MYSQL_HOST,
-                    port=MYSQL_PORT,
-                    user=MYSQL_USER,
-                    password=MYSQL_PASSWORD,
-                    database=MYSQL_DATABASE,
-                    cursorclass=DictCursor,
-                    charset="utf8mb4",
-                )
-                logger.info("✅ MySQL 連接成功")
+            with self.pool.connection() as conn:
+                conn.ping(reconnect=False)
+            return True
         except Exception as e:
             logger.error(f"MySQL 連接失敗: {e}")
-            self.connection = None
+            return False
+
+    async def run(self, method, *args, **kwargs):
+        """在工作執行緒中執行查詢方法"""
+        return await asyncio.to_thread(method, *args, **kwargs)
 
     def search_by_product_ids(self, product_ids: List[str]) -> set:
         """從多個表搜尋產品相關文件"""
-        self.ensure_connection()
-        if not self.connection:
-            return set()
-
         doc_ids = set()
+        for matched in self.search_product_docs(product_ids).values():
+            doc_ids.update(matched)
+        return doc_ids
+
+    def search_product_docs(self, product_ids: List[str]) -> Dict[str, set]:
+        """
+        依品號分組搜尋產品相關文件（批次查詢時各項目共用同一次查詢）
+
+        structured_documents.product_codes 以多值索引（idx_product_codes）
+        配合 JSON_OVERLAPS 查詢，其餘三表走 product_code 索引；
+        全部以 UNION ALL 合併，N 個品號一次往返。
+
+        Returns:
+            {品號: 命中的 doc_id 集合}
+        """
+        matches: Dict[str, set] = {pid: set() for pid in product_ids}
+        if not product_ids:
+            return matches
+        lookup = {pid.upper(): pid for pid in product_ids}
+
+        placeholders = ",".join(["%s"] * len(product_ids))
+        union_sql = [
+            """
+            SELECT original_doc_id AS doc_id, CAST(product_codes AS CHAR) AS codes,
+                   1 AS is_json
+            FROM structured_documents
+            WHERE JSON_OVERLAPS(product_codes, CAST(%s AS JSON))
+        """
+        ]
+        params = [json.dumps(product_ids, ensure_ascii=False)]
+        for table in ["ecn_notices", "ecn_applications", "complaint_records"]:
+            union_sql.append(
+                f"""
+            SELECT doc_id, product_code AS codes, 0 AS is_json
+            FROM {table} WHERE product_code IN ({placeholders})
+        """
+            )
+            params.extend(product_ids)
+
         try:
-            with self.connection.cursor() as cursor:
-                # structured_documents
-                for pid in product_ids:
-                    cursor.execute(
-                        """
-                        SELECT original_doc_id FROM structured_documents 
-                        WHERE JSON_CONTAINS(product_codes, %s)
-                    """,
-                        (json.dumps(pid),),
-                    )
-                    doc_ids.update(row["original_doc_id"] for row in cursor.fetchall())
-
-                # 其他表
-                if product_ids:
-                    placeholders = ",".join(["%s"] * len(product_ids))
-                    for table in [
-                        "ecn_notices",
-                        "ecn_applications",
-                        "complaint_records",
-                    ]:
-                        cursor.execute(
-                            f"""
-                            SELECT doc_id FROM {table} WHERE product_code IN ({placeholders})
-                        """,
-                            tuple(product_ids),
-                        )
-                        doc_ids.update(row["doc_id"] for row in cursor.fetchall())
+            with (
+                metrics.external("mysql", "product_ids"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
+                cursor.execute("UNION ALL".join(union_sql), tuple(params))
+                rows = cursor.fetchall()
         except Exception as e:
             logger.error(f"MySQL 產品搜尋失敗: {e}")
+            return matches
 
-        return doc_ids
+        for row in rows:
+            codes = row["codes"] or ""
+            if row["is_json"]:
+                try:
+                    codes = json.loads(codes)
+                except json.JSONDecodeError:
+                    continue
+            else:
+                codes = [codes]
+            for code in codes:
+                pid = lookup.get(str(code).upper())
+                if pid is not None:
+                    matches[pid].add(row["doc_id"])
+        return matches
 
     def search_by_keywords(self, keywords: List[str]) -> Dict[str, float]:
-        """從多個表的關鍵字欄位搜尋"""
-        self.ensure_connection()
-        if not self.connection:
+        """
+        從 structured_documents.summary 與 technical_documents.content 全文搜尋
+
+        使用 ngram FULLTEXT 索引，所有關鍵字合併為一個 BOOLEAN MODE 查詢、
+        兩張表以 UNION ALL 一次往返；分數取自索引的相關度。
+        索引尚未建立（未套用 01_fulltext_ngram.sql）時退回 LIKE 掃描。
+        """
+        if not self.fulltext_available:
+            return self._search_by_keywords_like(keywords)
+
+        boolean_query = self._build_boolean_query(keywords)
+        if not boolean_query:
             return {}
 
         doc_scores = {}
         try:
-            with self.connection.cursor() as cursor:
+            with (
+                metrics.external("mysql", "fulltext"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
+                cursor.execute(
+                    """
+                    (SELECT original_doc_id AS doc_id,
+                            MATCH(summary) AGAINST(%s IN BOOLEAN MODE) AS score
+                     FROM structured_documents
+                     WHERE MATCH(summary) AGAINST(%s IN BOOLEAN MODE)
+                     ORDER BY score DESC
+                     LIMIT %s)
+                    UNION ALL
+                    (SELECT doc_id,
+                            MATCH(content) AGAINST(%s IN BOOLEAN MODE) * 0.5 AS score
+                     FROM technical_documents
+                     WHERE MATCH(content) AGAINST(%s IN BOOLEAN MODE)
+                     ORDER BY score DESC
+                     LIMIT %s)
+                """,
+                    (
+                        boolean_query,
+                        boolean_query,
+                        FULLTEXT_LIMIT,
+                        boolean_query,
+                        boolean_query,
+                        FULLTEXT_LIMIT,
+                    ),
+                )
+
+                for row in cursor.fetchall():
+                    doc_id = row["doc_id"]
+                    doc_scores[doc_id] = doc_scores.get(doc_id, 0) + float(
+                        row["score"] or 0
+                    )
+        except pymysql.err.MySQLError as e:
+            if e.args and e.args[0] == ER_FT_MATCHING_KEY_NOT_FOUND:
+                logger.warning("⚠️ 找不到 FULLTEXT 索引，改用 LIKE 搜尋")
+                self.fulltext_available = False
+                return self._search_by_keywords_like(keywords)
+            logger.error(f"MySQL 全文搜尋失敗: {e}")
+        except Exception as e:
+            logger.error(f"MySQL 全文搜尋失敗: {e}")
+
+        return doc_scores
+
+    def search_by_keywords_many(
+        self, keyword_sets: List[tuple]
+    ) -> Dict[tuple, Dict[str, float]]:
+        """批次查詢：相同的關鍵字組合只查一次"""
+        return {
+            keywords: self.search_by_keywords(list(keywords))
+            for keywords in dict.fromkeys(keyword_sets)
+        }
+
+    def fetch_identifiers(self, since: Optional[datetime] = None) -> Optional[List[Dict]]:
+        """
+        讀取品號與各類單號（識別碼索引用）；since 指定時只讀取之後修改的資料列
+
+        Returns:
+            [{"kind", "value", "doc_id", "last_modified"}]；失敗時回傳 None
+        """
+        since = since or datetime(1970, 1, 1)
+        union_sql = [
+            f"""
+            SELECT '{kind}' AS kind, {column} AS value, {doc_column} AS doc_id, last_modified
+            FROM {table} WHERE {column} <> '' AND last_modified >= %s
+        """
+            for table, doc_column, column, kind in IDENTIFIER_COLUMNS
+        ]
+        # structured_documents.product_codes 為 JSON 陣列
+        union_sql.append(
+            """
+            SELECT 'product_code' AS kind, jt.code AS value, sd.original_doc_id AS doc_id,
+                   sd.last_modified
+            FROM structured_documents AS sd,
+                 JSON_TABLE(sd.product_codes, '$[*]'
+                            COLUMNS (code VARCHAR(100) PATH '$')) AS jt
+            WHERE sd.last_modified >= %s AND jt.code <> ''
+        """
+        )
+        try:
+            with (
+                metrics.external("mysql", "identifiers"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
+                cursor.execute("UNION ALL".join(union_sql), (since,) * len(union_sql))
+                return list(cursor.fetchall())
+        except Exception as e:
+            logger.warning(f"⚠️ 讀取識別碼失敗: {e}")
+            return None
+
+    def fetch_lexicon_names(self) -> Optional[List[str]]:
+        """讀取品名與客戶名稱（斷詞字典用）；失敗時回傳 None"""
+        try:
+            with (
+                metrics.external("mysql", "lexicon"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
+                cursor.execute(
+                    """
+                    SELECT product_name AS name FROM ecn_notices
+                    UNION SELECT product_name FROM ecn_applications
+                    UNION SELECT product_name FROM complaint_records
+                    UNION SELECT customer_name FROM complaint_records
+                    UNION SELECT jt.name
+                    FROM structured_documents,
+                         JSON_TABLE(product_names, '$[*]'
+                                    COLUMNS (name VARCHAR(255) PATH '$')) AS jt
+                """
+                )
+                return [row["name"] for row in cursor.fetchall() if row["name"]]
+        except Exception as e:
+            logger.warning(f"⚠️ 讀取品名/客戶名稱失敗: {e}")
+            return None
+
+    @staticmethod
+    def _build_boolean_query(keywords: List[str]) -> str:
+        """將關鍵字組成 BOOLEAN MODE 查詢字串，每個關鍵字作為片語（OR 語意）"""
+        terms = []
+        for keyword in keywords:
+            cleaned = re.sub(r'[+\-<>()~*"@]+', " ", keyword)
+            cleaned = re.sub(r"\s+", " ", cleaned).strip()
+            # ngram_token_size=2，單字元無法命中
+            if len(cleaned) >= 2:
+                terms.append(f'"{cleaned}"')
+        return " ".join(terms)
+
+    def _search_by_keywords_like(self, keywords: List[str]) -> Dict[str, float]:
+        """從多個表的關鍵字欄位搜尋（LIKE 掃描，FULLTEXT 索引不存在時使用）"""
+        doc_scores = {}
+        try:
+            with (
+                metrics.external("mysql", "like_scan"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
                 for keyword in keywords:
                     keyword_pattern = f"%{keyword}%"
 
@@ -300,32 +1295,181 @@ class MySQLManager:
 
         return doc_scores
 
-    def get_full_content(self, doc_ids: List[str]) -> Dict[str, str]:
-        """獲取文件的完整內容"""
-        self.ensure_connection()
-        if not self.connection or not doc_ids:
+    def get_full_content(self, doc_ids: List[str]) -> Dict[str, tuple]:
+        """
+        獲取文件清理後的完整內容
+
+        優先讀取 db-sync 預先計算的 content_clean / content_lower；
+        尚未計算（或欄位不存在）的文件才在此清理。
+
+        Returns:
+            {doc_id: (清理後內容, 小寫版內容)}
+        """
+        if not doc_ids:
             return {}
 
+        placeholders = ",".join(["%s"] * len(doc_ids))
         try:
-            with self.connection.cursor() as cursor:
-                placeholders = ",".join(["%s"] * len(doc_ids))
-                cursor.execute(
-                    f"""
-                    SELECT doc_id, content FROM technical_documents
-                    WHERE doc_id IN ({placeholders})
-                """,
-                    tuple(doc_ids),
-                )
+            with (
+                metrics.external("mysql", "full_content"),
+                self.pool.connection() as conn,
+                conn.cursor() as cursor,
+            ):
+                if self.precomputed_text_available:
+                    try:
+                        cursor.execute(
+                            f"""
+                            SELECT doc_id, content_clean, content_lower,
+                                   IF(content_clean IS NULL, content, NULL) AS content
+                            FROM technical_documents
+                            WHERE doc_id IN ({placeholders})
+                        """,
+                            tuple(doc_ids),
+                        )
+                    except pymysql.err.MySQLError as e:
+                        if not (e.args and e.args[0] == ER_BAD_FIELD_ERROR):
+                            raise
+                        logger.warning("⚠️ 找不到 content_clean 欄位，改為即時清理全文")
+                        self.precomputed_text_available = False
 
-                result = {
-                    row["doc_id"]: row["content"] or "" for row in cursor.fetchall()
-                }
+                if not self.precomputed_text_available:
+                    cursor.execute(
+                        f"""
+                        SELECT doc_id, NULL AS content_clean, NULL AS content_lower, content
+                        FROM technical_documents
+                        WHERE doc_id IN ({placeholders})
+                    """,
+                        tuple(doc_ids),
+                    )
+
+                result = {}
+                for row in cursor.fetchall():
+                    content_clean = row["content_clean"]
+                    content_lower = row["content_lower"]
+                    if content_clean is None:
+                        content_clean = (
+                            clean_content(row["content"] or "", preserve_line_breaks=True)
+                            or ""
+                        )
+                        content_lower = None
+                    result[row["doc_id"]] = (
+                        content_clean,
+                        content_lower or content_clean.lower(),
+                    )
                 logger.info(f"✅ 獲取 {len(result)} 個文件的完整內容")
                 return result
         except Exception as e:
             logger.error(f"獲取完整內容失敗: {e}")
             return {}
 
+    def _load_detail_columns(self, cursor) -> Dict[str, List[str]]:
+        """讀取 DETAIL_TABLES 的欄位（首次查詢詳情時讀取一次，遷移新增的欄位重啟後生效）"""
+        if self._detail_columns is None:
+            placeholders = ",".join(["%s"] * len(DETAIL_TABLES))
+            cursor.execute(
+                f"""
+                SELECT table_name AS table_name, column_name AS column_name
+                FROM information_schema.columns
+                WHERE table_schema = DATABASE() AND table_name IN ({placeholders})
+                ORDER BY table_name, ordinal_position
+            """,
+                tuple(DETAIL_TABLES),
+            )
+            columns: Dict[str, List[str]] = {table: [] for table in DETAIL_TABLES}
+            for row in cursor.fetchall():
+                columns[row["table_name"]].append(row["column_name"])
+            self._detail_columns = columns
+        return self._detail_columns
+
+    def get_document_details(self, doc_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        一次查詢取得文件詳情：technical_documents LEFT JOIN 摘要表與各類型專屬表
+
+        關聯表各以 JSON_OBJECT 整列取回後依 DETAIL_JOINS 順序合併成單層 dict
+        （後者覆蓋前者的非空欄位）；全文優先使用預先計算的 content_clean。
+
+        Returns:
+            {doc_id: 文件詳情}；查無的 doc_id 不在結果中。失敗時拋出例外
+        """
+        if not doc_ids:
+            return {}
+
+        placeholders = ",".join(["%s"] * len(doc_ids))
+        with (
+            metrics.external("mysql", "document_details"),
+            self.pool.connection() as conn,
+            conn.cursor() as cursor,
+        ):
+            columns = self._load_detail_columns(cursor)
+            if "content_clean" in columns["technical_documents"]:
+                content_sql = (
+                    "COALESCE(td.content_clean, td.content) AS content, "
+                    "td.content_clean IS NULL AS raw_content"
+                )
+            else:
+                content_sql = "td.content AS content, 1 AS raw_content"
+
+            selects, joins = [], []
+            for position, (table, doc_column) in enumerate(DETAIL_JOINS):
+                alias = f"j{position}"
+                pairs = ", ".join(
+                    f"'{column}', {alias}.`{column}`" for column in columns[table]
+                )
+                if not pairs:
+                    continue
+                selects.append(
+                    f"IF({alias}.`{doc_column}` IS NULL, NULL, JSON_OBJECT({pairs})) AS `{table}`"
+                )
+                joins.append(
+                    f"LEFT JOIN {table} AS {alias} ON {alias}.`{doc_column}` = td.doc_id"
+                )
+
+            cursor.execute(
+                f"""
+                SELECT td.doc_id, td.doc_type, td.file_name, td.file_size, td.page_count,
+                       td.last_modified, {content_sql}
+                       {"".join(", " + select for select in selects)}
+                FROM technical_documents AS td
+                {" ".join(joins)}
+                WHERE td.doc_id IN ({placeholders})
+            """,
+                tuple(doc_ids),
+            )
+            rows = cursor.fetchall()
+
+        result = {}
+        for row in rows:
+            doc = {
+                key: row[key]
+                for key in ("doc_id", "doc_type", "file_name", "file_size", "page_count")
+            }
+            modified = [row["last_modified"]]
+            sources = ["technical_documents"]
+            for table, doc_column in DETAIL_JOINS:
+                joined = row.get(table)
+                if not joined:
+                    continue
+                if isinstance(joined, (str, bytes)):
+                    joined = json.loads(joined)
+                sources.append(table)
+                modified.append(joined.pop("last_modified", None))
+                for key in (doc_column, "created_at"):
+                    joined.pop(key, None)
+                doc.update({k: v for k, v in joined.items() if v is not None})
+
+            content = row["content"] or ""
+            if row["raw_content"]:
+                content = clean_content(content, preserve_line_breaks=True) or ""
+            doc["content"] = content
+            doc["source_tables"] = sources
+            # datetime 與 JSON_OBJECT 的時間字串統一為到秒的 "YYYY-MM-DD HH:MM:SS"
+            doc["last_modified"] = max(
+                (str(value)[:19] for value in modified if value), default=None
+            )
+            result[row["doc_id"]] = doc
+        logger.info(f"✅ 獲取 {len(result)}/{len(doc_ids)} 個文件的詳情")
+        return result
+
     def extract_content_snippet(
         self, content: str, keywords: List[str], max_length: int = 300
     ) -> str:
@@ -362,16 +1506,18 @@ class MySQLManager:
         keywords: List[str],
         max_snippets: int = 3,
         snippet_length: int = 400,
+        content_lower: Optional[str] = None,
     ) -> List[str]:
         """
         智能提取內容片段，確保與摘要不重複
 
         Args:
-            content: 完整內容
-            summary: 摘要（用於去重）
+            content: 清理後的完整內容（get_full_content 的結果）
+            summary: 清理後的摘要（用於去重）
             keywords: 關鍵字列表
             max_snippets: 最大片段數
             snippet_length: 每個片段長度
+            content_lower: content 的小寫版，未提供時即時轉換
 
         Returns:
             不重複的內容片段列表
@@ -379,133 +1525,73 @@ class MySQLManager:
         if not content or not keywords:
             return []
 
-        # 清理內容
-        content_clean = clean_content(content, preserve_line_breaks=True)
-        summary_clean = (
-            clean_content(summary, preserve_line_breaks=False) if summary else ""
+        return extract_snippets(
+            content,
+            summary or "",
+            keywords,
+            max_snippets,
+            snippet_length,
+            content_lower=content_lower,
         )
 
-        snippets = []
-        used_positions = set()
-
-        # 按關鍵字查找片段
-        for keyword in keywords[: max_snippets * 2]:
-            keyword_lower = keyword.lower()
-            content_lower = content_clean.lower()
-
-            pos = 0
-            while pos < len(content_lower):
-                pos = content_lower.find(keyword_lower, pos)
-                if pos == -1:
-                    break
-
-                # 避免位置重疊
-                if any(
-                    abs(pos - used_pos) < snippet_length // 2
-                    for used_pos in used_positions
-                ):
-                    pos += 1
-                    continue
-
-                # 提取片段
-                start = max(0, pos - 100)
-                end = min(len(content_clean), pos + snippet_length - 100)
-                snippet = content_clean[start:end]
-
-                # 在句子邊界調整
-                if start > 0:
-                    for i in range(min(50, len(snippet))):
-                        if snippet[i] in "。！？\n；":
-                            snippet = snippet[i + 1 :]
-                            break
-                    snippet = "..." + snippet
-
-                if end < len(content_clean):
-                    for i in range(len(snippet) - 1, max(0, len(snippet) - 50), -1):
-                        if snippet[i] in "。！？\n；":
-                            snippet = snippet[: i + 1]
-                            break
-                    snippet = snippet + "..."
-
-                snippet = snippet.strip()
-
-                # 檢查是否與 summary 重複
-                if self._is_content_similar(snippet, summary_clean):
-                    pos += 1
-                    continue
-
-                # 檢查是否與已有片段重複
-                if any(
-                    self._is_content_similar(snippet, existing) for existing in snippets
-                ):
-                    pos += 1
-                    continue
-
-                # 檢查片段長度
-                if len(snippet.strip(".\n ")) < 20:
-                    pos += 1
-                    continue
-
-                snippets.append(snippet)
-                used_positions.add(pos)
-
-                if len(snippets) >= max_snippets:
-                    return snippets
-
-                pos += 1
-
-        return snippets
-
-    def _is_content_similar(
-        self, text1: str, text2: str, threshold: float = 0.7
-    ) -> bool:
-        """檢查兩段文本是否相似"""
-        if not text1 or not text2:
-            return False
-
-        # 移除標點和空白
-        clean1 = re.sub(r"[^\w]", "", text1.lower())
-        clean2 = re.sub(r"[^\w]", "", text2.lower())
-
-        if not clean1 or not clean2:
-            return False
-
-        # 包含檢查
-        if clean1 in clean2 or clean2 in clean1:
-            return True
-
-        # Jaccard 相似度
-        set1 = set(clean1[i : i + 3] for i in range(len(clean1) - 2))
-        set2 = set(clean2[i : i + 3] for i in range(len(clean2) - 2))
-
-        if not set1 or not set2:
-            return False
-
-        intersection = len(set1 & set2)
-        union = len(set1 | set2)
-        similarity = intersection / union if union > 0 else 0
-
-        return similarity > threshold
-
 
 # ==================== 文件搜尋服務 ====================
 class DocumentSearchService:
     def __init__(self):
-        self.es_session = requests.Session()
-        if ES_USER and ES_PASS:
-            self.es_session.auth = HTTPBasicAuth(ES_USER, ES_PASS)
-        self.es_session.headers.update({"Content-Type": "application/json"})
+        self.es_client = httpx.AsyncClient(
+            auth=(ES_USER, ES_PASS) if ES_USER and ES_PASS else None,
+            headers={"Content-Type": "application/json"},
+            timeout=ES_TIMEOUT,
+        )
 
         self.vector_gen = VectorGenerator()
         self.mysql = MySQLManager()
         self.file_handler = FileURLHandler()
-        self.gpt_client = None
+        self.watermarks = SyncWatermarks()
+        self.base_segmenter = QuerySegmenter.from_ik_config(
+            IK_CONFIG_DIR, QUERY_DICT_FILES
+        )
+        self.segmenter = self.base_segmenter
+        self._lexicon_token = None
+        self.identifiers = IdentifierIndex(
+            max_distance=IDENTIFIER_MAX_DISTANCE, prefix_limit=IDENTIFIER_PREFIX_LIMIT
+        )
+        self._identifier_token = None
+        self.collapse_indices: set = set()
+        self.identifier_subfield_indices: set = set()
+        self.rrf_retriever: Optional[bool] = None  # 叢集是否支援 rrf retriever（None 為尚未探測，實際查詢失敗後為 False）
+        self.result_cache = TTLCache("result", RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+        self.document_cache = SizedLRUCache(
+            "document", DOCUMENT_CACHE_MAX_BYTES, DOCUMENT_CACHE_TTL
+        )
+        self._document_loads: Dict[tuple, asyncio.Task] = {}
+        self.fusers = {
+            name: build_fuser(name, FUSION_WEIGHTS, rrf_k=FUSION_RRF_K)
+            for name in FUSERS
+        }
+        self.default_fusion = (
+            FUSION_METHOD.lower() if FUSION_METHOD.lower() in FUSERS else "rrf"
+        )
+        self.fusion_log = FusionEvalLogger(FUSION_EVAL_LOG)
+        self.gpt_client = None
+
+        if OPENAI_API_KEY and AsyncOpenAI:
+            self.gpt_client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, timeout=OPENAI_TIMEOUT
+            )
 
-        if OPENAI_API_KEY and OpenAI:
-            self.gpt_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+    async def aclose(self):
+        """關閉非同步連線"""
+        await self.es_client.aclose()
+        if self.gpt_client:
+            await self.gpt_client.close()
+        await self.vector_gen.aclose()
+        self.mysql.pool.close_all()
 
     def extract_product_ids(self, query: str) -> List[str]:
-        """提取產品編號"""
+        """提取產品編號（識別碼索引載入前以正規表示式推測）"""
+        if self.identifiers.loaded:
+            return self.identifiers.resolve(query).values("product_code")
         patterns = [
             r"[A-Z]{2,4}[\d]{2,4}[A-Z]?[\d]{0,4}[A-Z]{0,4}[\d]{0,4}[A-Z]{0,4}",
             r"\d{2,3}[-]\d{1,4}",
@@ -517,60 +1603,158 @@ class DocumentSearchService:
         return list(set(product_ids))
 
     def extract_keywords(self, query: str) -> List[str]:
-        stop_words = {"的", "是", "在", "和", "將", "或", "有", "為", "等", "了", "請", "所有", "來", "出", "未來", "改善", "統整", "列出"}
-    
-        # 1️⃣ 先提取英文數字組合（產品代碼）
-        product_codes = re.findall(r'[A-Z0-9]{2,}[-]?[A-Z0-9]*', query)
-        
-        # 2️⃣ 提取中文關鍵詞：按停用詞分割
-        cleaned = query
-        for stop_word in stop_words:
-            cleaned = cleaned.replace(stop_word, '|')
-        
-        # 按分隔符切分，過濾短詞
-        chinese_words = [w.strip() for w in cleaned.split('|') 
-                        if w.strip() and len(w.strip()) >= 2]
-        
-        # 3️⃣ 合併所有關鍵字
-        all_keywords = product_codes + chinese_words
-        
-        logger.info(f"🔍 從查詢 '{query}' 提取到關鍵字: {all_keywords}")
-        
-        # 如果還是沒有
-        if not all_keywords:
-            # 嘗試提取任何 2 個字以上的詞
-            words = re.findall(r'[\u4e00-\u9fff]{2,}', query)  # 只匹配中文 2+ 字
-            if words:
-                all_keywords = words
-                logger.info(f"⚠️ 使用中文詞組: {all_keywords}")
-            else:
-                all_keywords = [query.strip()]
-                logger.info(f"⚠️ 使用整個查詢: {all_keywords}")
-        
-        return list(set(all_keywords))[:10]
+        """以字典斷詞提取關鍵字（英數代碼、字典詞、字典外片段，最多 10 個）"""
+        keywords = self.segmenter.keywords(query)
+        logger.info(f"🔍 從查詢 '{query}' 提取到關鍵字: {keywords}")
+        return keywords
+
+    async def refresh_identifiers(self):
+        """
+        更新識別碼索引
+
+        首次與每 IDENTIFIER_FULL_RELOAD 秒在工作執行緒中全量重建後替換；
+        其間僅在同步水位前進時讀取 last_modified 之後的資料列增量加入。
+        """
+        index = self.identifiers
+        token = self.watermarks.token(IDENTIFIER_TABLES)
+        full = not index.loaded or time.monotonic() - index.loaded_at > IDENTIFIER_FULL_RELOAD
+        if not full and token == self._identifier_token:
+            return
+        rows = await self.mysql.run(
+            self.mysql.fetch_identifiers, None if full else index.watermark
+        )
+        if rows is None:
+            return
+        if full:
+            self.identifiers = await asyncio.to_thread(
+                IdentifierIndex.build,
+                rows,
+                max_distance=IDENTIFIER_MAX_DISTANCE,
+                prefix_limit=IDENTIFIER_PREFIX_LIMIT,
+            )
+            logger.info(f"🔖 識別碼索引載入: {len(self.identifiers)} 筆")
+        else:
+            index.update(rows)
+        self._identifier_token = token
+
+    async def refresh_lexicon(self):
+        """將 MySQL 品名、客戶名稱加入斷詞字典；首次載入後僅在同步水位前進時重建"""
+        token = self.watermarks.token(LEXICON_TABLES)
+        if self._lexicon_token is not None and token == self._lexicon_token:
+            return
+        names = await self.mysql.run(self.mysql.fetch_lexicon_names)
+        if names is None:
+            return
+        self.segmenter = self.base_segmenter.with_terms(lexicon_terms(names))
+        self._lexicon_token = token
+        logger.info(f"📖 斷詞字典加入 {self.segmenter.term_count} 個品名/客戶名稱")
+
+    def update_collapse_support(self, mappings: Dict[str, Dict]):
+        """記錄已補寫 collapse_key 的索引（StatusMonitor 讀取 mapping 後呼叫）"""
+        supported = {
+            index
+            for index, body in mappings.items()
+            if ((body.get("mappings") or {}).get("_meta") or {}).get("collapse_key", 0)
+            >= COLLAPSE_KEY_VERSION
+        }
+        if supported != self.collapse_indices:
+            logger.info(f"🔗 結果摺疊啟用索引: {sorted(supported) or '無'}")
+        self.collapse_indices = supported
+
+    def update_identifier_support(self, mappings: Dict[str, Dict]):
+        """記錄已建立識別碼子欄位的索引（StatusMonitor 讀取 mapping 後呼叫）"""
+        supported = {
+            index
+            for index, body in mappings.items()
+            if ((body.get("mappings") or {}).get("_meta") or {}).get("identifier_fields", 0)
+            >= IDENTIFIER_SUBFIELDS_VERSION
+        }
+        if supported != self.identifier_subfield_indices:
+            logger.info(f"🔖 識別碼子欄位啟用索引: {sorted(supported) or '無'}")
+        self.identifier_subfield_indices = supported
+
+    def _identifier_subfields_enabled(self, indices: str) -> bool:
+        """範圍內所有索引都有識別碼子欄位才略過 fuzziness（舊索引仍需容錯比對）"""
+        return bool(indices) and all(
+            index in self.identifier_subfield_indices for index in indices.split(",")
+        )
+
+    def _collapse_enabled(self, indices: str) -> bool:
+        """範圍內所有索引都有 collapse_key 才可摺疊（缺欄位的文件會被併成同一組）"""
+        return bool(indices) and all(
+            index in self.collapse_indices for index in indices.split(",")
+        )
+
+    @staticmethod
+    def _collapse_clause() -> Dict:
+        """以 collapse_key 摺疊，inner_hits 帶回同組各索引記錄的識別欄位"""
+        return {
+            "field": "collapse_key",
+            "inner_hits": {
+                "name": "related",
+                "size": COLLAPSE_INNER_HITS,
+                "_source": COLLAPSE_INNER_FIELDS,
+            },
+            "max_concurrent_group_searches": 4,
+        }
+
+    @staticmethod
+    def _keyword_search_body(
+        query: str,
+        size: int,
+        filters: tuple = (),
+        identifiers: Optional[QueryIdentifiers] = None,
+        collapse: bool = False,
+        fuzzy: bool = True,
+    ) -> Dict:
+        """
+        關鍵字搜尋；查詢中已辨識的識別碼以 terms 精確比對（含容錯更正後的正式值），
+        代碼片段另以識別碼子欄位做正規化 term 與前綴比對（部分單號如 "L1120"）。
+        fuzziness 只在 fuzzy 且仍有無法辨識的代碼片段時使用；should 第一項固定為文字 multi_match
+        """
+        multi_match = {
+            "query": query,
+            "fields": [
+                "doc_number^10",
+                "file_name^7",
+                "summary^5",
+                "keywords^7",
+            ],
+            "type": "best_fields",
+        }
+        if fuzzy and (identifiers is None or identifiers.unresolved):
+            multi_match["fuzziness"] = "AUTO"
+        should = [{"multi_match": multi_match}]
+        values = identifiers.values() if identifiers else []
+        if values:
+            should.extend(
+                {"terms": {field: values, "boost": 20}} for field in IDENTIFIER_FIELDS
+            )
+        # 尚未建立子欄位的索引沒有這些欄位，比對不到也不會出錯
+        tokens = code_tokens(query)
+        if tokens:
+            should.extend(
+                {"terms": {f"{field}.norm": tokens, "boost": 15}}
+                for field in IDENTIFIER_FIELDS
+            )
+            should.extend(
+                {
+                    "multi_match": {
+                        "query": token,
+                        "fields": [f"{field}.prefix" for field in IDENTIFIER_FIELDS],
+                        "boost": 5,
+                    }
+                }
+                for token in tokens
+                if len(token) >= IDENTIFIER_PREFIX_MIN_LENGTH
+            )
 
-    def keyword_search(self, query: str, size: int = 10, filters: Dict = None) -> Dict:
-        """多索引關鍵字搜尋"""
         search_body = {
             "size": size,
             "_source": {"excludes": ["original_extracted_content", "content_vector"]},
             "query": {
                 "bool": {
-                    "should": [
-                        {
-                            "multi_match": {
-                                "query": query,
-                                "fields": [
-                                    "doc_number^10",
-                                    "file_name^7",
-                                    "summary^5",
-                                    "keywords^7",
-                                ],
-                                "type": "best_fields",
-                                "fuzziness": "AUTO",
-                            }
-                        }
-                    ],
+                    "should": should,
                     "minimum_should_match": 1,
                 }
             },
@@ -590,85 +1774,638 @@ class DocumentSearchService:
                 "post_tags": ["</em>"],
             },
         }
+        if filters:
+            search_body["query"]["bool"]["filter"] = list(filters)
+        if collapse:
+            search_body["collapse"] = DocumentSearchService._collapse_clause()
+        return search_body
 
-        try:
-            response = self.es_session.post(
-                f"{ES_URL}/{ES_INDEX_PATTERN}/_search", json=search_body, timeout=10
+    @staticmethod
+    def _knn_clause(query_vector: List[float], size: int, filters: tuple = ()) -> Dict:
+        """kNN 子句；filter 在 HNSW 搜尋時即套用（pre-filter），候選數不被過濾掉的文件佔用"""
+        knn = {
+            "field": "content_vector",
+            "query_vector": query_vector,
+            "k": size,
+            "num_candidates": size * 10,
+        }
+        if filters:
+            knn["filter"] = {"bool": {"filter": list(filters)}}
+        return knn
+
+    @classmethod
+    def _vector_search_body(
+        cls,
+        query_vector: List[float],
+        size: int,
+        filters: tuple = (),
+        collapse: bool = False,
+    ) -> Dict:
+        """kNN 搜尋；可摺疊時多取一倍候選，由 _collect_rankings 依 collapse_key 去重"""
+        if collapse:
+            size *= 2
+        return {
+            "size": size,
+            "_source": {"excludes": ["original_extracted_content", "content_vector"]},
+            "knn": cls._knn_clause(query_vector, size, filters),
+        }
+
+    @classmethod
+    def _passage_search_body(
+        cls,
+        query: str,
+        mode: str,
+        query_vector: Optional[List[float]],
+        size: int,
+        filters: tuple = (),
+    ) -> Optional[Dict]:
+        """段落搜尋：關鍵字模式用 BM25，向量模式用 kNN，hybrid 兩者合併評分"""
+        search_body = {
+            "size": size,
+            "_source": {"excludes": ["content_vector"]},
+        }
+        if mode in ("keyword", "hybrid"):
+            match = {"match": {"content": {"query": query}}}
+            search_body["query"] = (
+                {"bool": {"must": [match], "filter": list(filters)}} if filters else match
             )
-            response.raise_for_status()
-            return response.json()
+        if mode in ("vector", "hybrid") and query_vector:
+            search_body["knn"] = cls._knn_clause(query_vector, size, filters)
+        if "query" not in search_body and "knn" not in search_body:
+            return None
+        return search_body
+
+    def _retriever_search_body(
+        self,
+        query: str,
+        query_vector: List[float],
+        size: int,
+        filters: tuple = (),
+        identifiers: Optional[QueryIdentifiers] = None,
+        fuzzy: bool = True,
+    ) -> Dict:
+        """
+        ES rrf retriever：關鍵字查詢與 kNN 由 ES 依名次合併，一次搜尋取回單一排序
+
+        rank_constant 與 rag-api 的 RRF 相同；retriever 不支援 collapse，
+        同一群組的多筆命中由 _collect_rankings 依 collapse_key 去重。
+        """
+        keyword = self._keyword_search_body(
+            query, size, filters, identifiers, fuzzy=fuzzy
+        )
+        return {
+            "size": size,
+            "_source": keyword["_source"],
+            "retriever": {
+                "rrf": {
+                    "retrievers": [
+                        {"standard": {"query": keyword["query"]}},
+                        {"knn": self._knn_clause(query_vector, size, filters)},
+                    ],
+                    "rank_constant": FUSION_RRF_K,
+                    "rank_window_size": size,
+                }
+            },
+            "highlight": keyword["highlight"],
+        }
+
+    def _use_retriever(
+        self, request: SearchRequest, indices: str, vector_indices: str
+    ) -> bool:
+        """hybrid 的關鍵字與向量能否交給 ES rrf retriever 合併"""
+        if ES_SEARCH_TRANSPORT != "retriever" or not self.rrf_retriever:
+            return False
+        if request.mode != "hybrid" or self._fusion_method(request) != "rrf":
+            return False
+        # ES 的 RRF 不加權，兩來源權重不同時仍由 rag-api 融合
+        weights = self.fusers["rrf"].weights
+        if weights.get("es_keyword") != weights.get("es_vector"):
+            return False
+        # 部分索引的向量與目前提供者不相容時，kNN 與關鍵字的範圍不同
+        return set(vector_indices.split(",")) == set(indices.split(","))
+
+    def _es_searches(
+        self,
+        request: SearchRequest,
+        query_vector: Optional[List[float]],
+        identifiers: Optional[QueryIdentifiers] = None,
+    ) -> tuple:
+        """
+        本次請求要送出的 ES 搜尋
+
+        Returns:
+            (sources, searches)：sources 為本次涉及的來源名稱，
+            searches 為 [(來源名稱, 索引, 搜尋 body)]（缺向量或無可搜尋索引者不含在內）
+        """
+        query = request.query
+        indices, filters = self._search_scope(request)
+        es_size = max(request.top_k, math.ceil(request.top_k * FUSION_CANDIDATE_FACTOR))
+        vector_indices = self.vector_gen.vector_indices(indices)
+        fuzzy = not self._identifier_subfields_enabled(indices)
+        sources, searches = [], []
+        if query_vector and self._use_retriever(request, indices, vector_indices):
+            sources.append("es_hybrid")
+            searches.append(
+                (
+                    "es_hybrid",
+                    indices,
+                    self._retriever_search_body(
+                        query, query_vector, es_size, filters, identifiers, fuzzy
+                    ),
+                )
+            )
+        else:
+            if request.mode in ("keyword", "hybrid"):
+                sources.append("es_keyword")
+                searches.append(
+                    (
+                        "es_keyword",
+                        indices,
+                        self._keyword_search_body(
+                            query,
+                            es_size,
+                            filters,
+                            identifiers,
+                            self._collapse_enabled(indices),
+                            fuzzy,
+                        ),
+                    )
+                )
+            if request.mode in ("vector", "hybrid"):
+                sources.append("es_vector")
+                if query_vector and vector_indices:
+                    searches.append(
+                        (
+                            "es_vector",
+                            vector_indices,
+                            self._vector_search_body(
+                                query_vector,
+                                es_size,
+                                filters,
+                                self._collapse_enabled(vector_indices),
+                            ),
+                        )
+                    )
+        sources.append("es_passages")
+        passage_body = self._passage_search_body(
+            query,
+            request.mode,
+            query_vector if self.vector_gen.vector_indices(PASSAGE_INDEX) else None,
+            PASSAGE_TOP_K,
+            filters,
+        )
+        if passage_body is not None:
+            searches.append(("es_passages", PASSAGE_INDEX, passage_body))
+        return sources, searches
+
+    def _search_scope(self, request: SearchRequest) -> tuple:
+        """請求的搜尋範圍：(索引字串, filter 子句 tuple)"""
+        doc_types = tuple(
+            sorted({t.strip().upper() for t in request.doc_type_filter or [] if t.strip()})
+        )
+        return build_search_scope(
+            doc_types,
+            request.date_from or None,
+            request.date_to or None,
+            (request.department or "").strip() or None,
+        )
+
+    async def keyword_search(
+        self,
+        query: str,
+        size: int = 10,
+        filters: tuple = (),
+        indices: str = ES_INDEX_PATTERN,
+        identifiers: Optional[QueryIdentifiers] = None,
+    ) -> Dict:
+        """多索引關鍵字搜尋"""
+        search_body = self._keyword_search_body(
+            query,
+            size,
+            filters,
+            identifiers,
+            self._collapse_enabled(indices),
+            not self._identifier_subfields_enabled(indices),
+        )
+
+        try:
+            with metrics.external("elasticsearch", "keyword_search"):
+                response = await self.es_client.post(
+                    f"{ES_URL}/{indices}/_search", json=search_body
+                )
+                response.raise_for_status()
         except Exception as e:
             logger.error(f"關鍵字搜尋失敗: {e}")
             return {"hits": {"hits": [], "total": {"value": 0}}}
+        (result,) = await self._fuzzy_fallbacks(
+            [(indices, search_body, identifiers, response.json())]
+        )
+        return result
 
-    def vector_search(self, query: str, size: int = 10, filters: Dict = None) -> Dict:
+    async def vector_search(
+        self,
+        query: str,
+        size: int = 10,
+        filters: tuple = (),
+        indices: str = ES_INDEX_PATTERN,
+    ) -> Dict:
         """多索引向量搜尋"""
-        query_vector = self.vector_gen.generate(query)
+        indices = self.vector_gen.vector_indices(indices)
+        query_vector = await self.vector_gen.generate(query) if indices else None
         if not query_vector:
             return {"hits": {"hits": [], "total": {"value": 0}}}
 
-        search_body = {
-            "size": size,
-            "_source": {"excludes": ["original_extracted_content", "content_vector"]},
-            "knn": {
-                "field": "content_vector",
-                "query_vector": query_vector,
-                "k": size,
-                "num_candidates": size * 10,
-            },
-        }
+        search_body = self._vector_search_body(
+            query_vector, size, filters, self._collapse_enabled(indices)
+        )
 
         try:
-            response = self.es_session.post(
-                f"{ES_URL}/{ES_INDEX_PATTERN}/_search", json=search_body, timeout=10
-            )
-            response.raise_for_status()
+            with metrics.external("elasticsearch", "vector_search"):
+                response = await self.es_client.post(
+                    f"{ES_URL}/{indices}/_search", json=search_body
+                )
+                response.raise_for_status()
             return response.json()
         except Exception as e:
             logger.error(f"向量搜尋失敗: {e}")
             return {"hits": {"hits": [], "total": {"value": 0}}}
 
-    def _merge_results(self, keyword_result: Dict, vector_result: Dict) -> Dict:
-        """合併關鍵字和向量搜尋結果"""
-        merged_hits = []
-        seen_ids = set()
+    async def passage_search(
+        self, query: str, mode: str, size: int = PASSAGE_TOP_K, filters: tuple = ()
+    ) -> Dict:
+        """段落索引搜尋"""
+        query_vector = None
+        if mode in ("vector", "hybrid") and self.vector_gen.vector_indices(PASSAGE_INDEX):
+            query_vector = await self.vector_gen.generate(query)
+        search_body = self._passage_search_body(query, mode, query_vector, size, filters)
+        if search_body is None:
+            return {"hits": {"hits": [], "total": {"value": 0}}}
 
-        all_hits = keyword_result.get("hits", {}).get("hits", []) + vector_result.get(
-            "hits", {}
-        ).get("hits", [])
+        try:
+            with metrics.external("elasticsearch", "passage_search"):
+                response = await self.es_client.post(
+                    f"{ES_URL}/{PASSAGE_INDEX}/_search",
+                    params={"ignore_unavailable": "true"},
+                    json=search_body,
+                )
+                response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            logger.error(f"段落搜尋失敗: {e}")
+            return {"hits": {"hits": [], "total": {"value": 0}}}
 
-        for hit in all_hits:
-            doc_id = hit.get("_id")
-            if doc_id not in seen_ids:
-                seen_ids.add(doc_id)
-                merged_hits.append(hit)
+    async def _msearch(
+        self, searches: List[tuple], errors: Optional[List[int]] = None
+    ) -> List[Dict]:
+        """
+        以一次 _msearch 送出多個搜尋
 
-        return {"hits": {"hits": merged_hits, "total": {"value": len(merged_hits)}}}
+        Args:
+            searches: [(索引, 搜尋 body), ...]
+            errors: 若提供，附加失敗項目的位置
+
+        Returns:
+            與 searches 對應的回應；個別失敗的搜尋回傳空結果
+        """
+        lines = []
+        for index, body in searches:
+            header = {"index": index}
+            if index == PASSAGE_INDEX:
+                header["ignore_unavailable"] = True
+            lines.append(json.dumps(header))
+            lines.append(json.dumps(body, ensure_ascii=False))
+
+        with metrics.external("elasticsearch", "msearch"):
+            response = await self.es_client.post(
+                f"{ES_URL}/_msearch",
+                content=("\n".join(lines) + "\n").encode("utf-8"),
+                headers={"Content-Type": "application/x-ndjson"},
+                timeout=BATCH_SEARCH_DEADLINE,
+            )
+            response.raise_for_status()
+
+        results = []
+        for position, item in enumerate(response.json().get("responses", [])):
+            if "error" in item:
+                logger.error(f"批次搜尋項目失敗: {item['error']}")
+                if errors is not None:
+                    errors.append(position)
+                item = {"hits": {"hits": [], "total": {"value": 0}}}
+            results.append(item)
+        results.extend(
+            {"hits": {"hits": [], "total": {"value": 0}}}
+            for _ in range(len(searches) - len(results))
+        )
+        return results
 
-    def _process_results(
-        self, es_result: Dict, mysql_scores: Dict, mysql_doc_ids: set, query: str = ""
+    @staticmethod
+    def _fuzzy_fallback_body(
+        body: Dict, identifiers: Optional[QueryIdentifiers]
+    ) -> Optional[Dict]:
+        """容錯重查的 body（文字 multi_match 加上 fuzziness）；已含 fuzziness 或代碼皆已辨識時為 None"""
+        if identifiers is not None and not identifiers.unresolved:
+            return None
+        if "fuzziness" in body["query"]["bool"]["should"][0]["multi_match"]:
+            return None
+        fallback = copy.deepcopy(body)
+        fallback["query"]["bool"]["should"][0]["multi_match"]["fuzziness"] = "AUTO"
+        return fallback
+
+    async def _fuzzy_fallbacks(self, items: List[tuple]) -> List[Dict]:
+        """
+        識別碼子欄位比對無命中的關鍵字搜尋，以 fuzziness 合併為一次 _msearch 重查
+
+        Args:
+            items: [(索引, 原搜尋 body, 識別碼, 原回應)]
+
+        Returns:
+            與 items 對應的回應；不需重查或重查失敗者為原回應
+        """
+        results = [result for _, _, _, result in items]
+        retries = []
+        for position, (index, body, identifiers, result) in enumerate(items):
+            if result.get("hits", {}).get("hits"):
+                continue
+            fallback = self._fuzzy_fallback_body(body, identifiers)
+            if fallback is not None:
+                retries.append((position, index, fallback))
+        if not retries:
+            return results
+
+        logger.info(f"🔁 識別碼子欄位比對無命中，以 fuzziness 重查 {len(retries)} 筆")
+        try:
+            responses = await self._msearch([(index, body) for _, index, body in retries])
+        except Exception as e:
+            logger.error(f"容錯重查失敗: {e}")
+            return results
+        for (position, _, _), response in zip(retries, responses):
+            results[position] = response
+        return results
+
+    async def combined_search(
+        self,
+        request: SearchRequest,
+        identifiers: Optional[QueryIdentifiers] = None,
+        timed_out: Optional[List[str]] = None,
+    ) -> Dict[str, Dict]:
+        """
+        單一查詢的 ES 搜尋合併為一次 _msearch（關鍵字、向量、段落；可用時改為 rrf retriever）
+
+        需要向量的模式先取得查詢向量（最多等 COMBINED_EMBEDDING_TIMEOUT 秒），關鍵字搜尋隨同一次請求送出；
+        向量逾時則只送關鍵字與段落全文搜尋，並將 es_vector 加入 timed_out。
+        retriever 項目失敗（例如授權變更）時停用 retriever 至服務重啟，改以分開的關鍵字、向量搜尋重送。
+
+        Returns:
+            {來源名稱: ES 回應}
+        """
+        empty_es = {"hits": {"hits": [], "total": {"value": 0}}}
+        query_vector = None
+        if request.mode in ("vector", "hybrid"):
+            indices, _ = self._search_scope(request)
+            if self.vector_gen.vector_indices(f"{indices},{PASSAGE_INDEX}"):
+                try:
+                    query_vector = await asyncio.wait_for(
+                        self.vector_gen.generate(request.query),
+                        COMBINED_EMBEDDING_TIMEOUT,
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning(
+                        f"⏱️ 查詢向量逾時 ({COMBINED_EMBEDDING_TIMEOUT}s)，不帶向量送出搜尋"
+                    )
+                    metrics.stage_failed("es_vector", "timeout")
+                    if timed_out is not None:
+                        timed_out.append("es_vector")
+
+        sources, searches = self._es_searches(request, query_vector, identifiers)
+        results = {name: empty_es for name in sources}
+        if not searches:
+            return results
+        errors: List[int] = []
+        responses = await self._msearch(
+            [(index, body) for _, index, body in searches], errors
+        )
+        for (name, _, _), response in zip(searches, responses):
+            results[name] = response
+        for name, index, body in searches:
+            if name == "es_keyword":
+                (results[name],) = await self._fuzzy_fallbacks(
+                    [(index, body, identifiers, results[name])]
+                )
+        if any(searches[position][0] == "es_hybrid" for position in errors):
+            logger.warning("⚠️ rrf retriever 查詢失敗，停用至服務重啟，改由 rag-api 融合")
+            # 設為 False 而非 None：背景探測的 match_none 查詢通常會成功，否則每輪都會重新啟用再失敗
+            self.rrf_retriever = False
+            return await self.combined_search(request, identifiers, timed_out)
+        return results
+
+    async def _fetch_parent_hits(
+        self, doc_ids: List[str], indices: str = ES_INDEX_PATTERN
+    ) -> Dict[str, Dict]:
+        """只由段落命中的文件，補查其記錄（任一索引中 doc_id / original_doc_id 相符者）"""
+        if not doc_ids:
+            return {}
+        search_body = {
+            "size": len(doc_ids) * 3,
+            "_source": {"excludes": ["original_extracted_content", "content_vector"]},
+            "query": {
+                "bool": {
+                    "should": [
+                        {"terms": {"original_doc_id": doc_ids}},
+                        {"terms": {"doc_id": doc_ids}},
+                    ],
+                    "minimum_should_match": 1,
+                }
+            },
+        }
+        try:
+            with (
+                metrics.stage("parent_fetch"),
+                metrics.external("elasticsearch", "parent_fetch"),
+            ):
+                response = await asyncio.wait_for(
+                    self.es_client.post(
+                        f"{ES_URL}/{indices}/_search", json=search_body
+                    ),
+                    STAGE_TIMEOUT_KEYWORD,
+                )
+                response.raise_for_status()
+        except Exception as e:
+            logger.error(f"段落上層文件查詢失敗: {e}")
+            return {}
+
+        parents = {}
+        for hit in response.json().get("hits", {}).get("hits", []):
+            parents.setdefault(self._hit_doc_id(hit), hit)
+        return parents
+
+    @staticmethod
+    def _group_passages(passage_result: Dict) -> tuple:
+        """
+        依上層文件分組段落
+
+        Returns:
+            (ranking, passages): ranking 為 [(doc_id, 最佳段落分數)]（依分數排序），
+            passages 為 {doc_id: [段落, ...]}（每份文件最多 PASSAGES_PER_DOC 段）
+        """
+        ranking = []
+        passages: Dict[str, List[Dict[str, Any]]] = {}
+        for hit in passage_result.get("hits", {}).get("hits", []):
+            source = hit.get("_source", {})
+            doc_id = source.get("doc_id")
+            if not doc_id or not source.get("content"):
+                continue
+            if doc_id not in passages:
+                passages[doc_id] = []
+                ranking.append((doc_id, float(hit.get("_score") or 0)))
+            if len(passages[doc_id]) < PASSAGES_PER_DOC:
+                passages[doc_id].append(
+                    {
+                        "content": source["content"],
+                        "page_start": source.get("page_start"),
+                        "page_end": source.get("page_end"),
+                        "score": round(float(hit.get("_score") or 0), 4),
+                    }
+                )
+        return ranking, passages
+
+    @staticmethod
+    def _hit_doc_id(hit: Dict) -> str:
+        """ES 命中對應的文件 ID（跨索引共用，與 MySQL 評分的鍵一致）"""
+        source = hit.get("_source", {})
+        return source.get("original_doc_id") or source.get("doc_id") or hit["_id"]
+
+    @classmethod
+    def _hit_group_key(cls, hit: Dict) -> str:
+        """結果去重的鍵：collapse_key（同一文件或同一 FMEA 案號），舊資料退回 doc_id"""
+        return hit.get("_source", {}).get("collapse_key") or cls._hit_doc_id(hit)
+
+    @classmethod
+    def _related_rows(cls, hit: Dict) -> List[Dict[str, Any]]:
+        """collapse inner_hits 中代表命中以外的記錄（各索引的識別欄位）"""
+        related = []
+        inner = hit.get("inner_hits", {}).get("related", {}).get("hits", {}).get("hits", [])
+        for row in inner:
+            if row.get("_id") == hit.get("_id") and row.get("_index") == hit.get("_index"):
+                continue
+            related.append(
+                {
+                    "index_name": row.get("_index"),
+                    **{k: v for k, v in row.get("_source", {}).items() if v not in (None, "")},
+                }
+            )
+        return related
+
+    def _collect_rankings(
+        self, results: Dict[str, Any], passage_ranking: Optional[List[tuple]] = None
+    ) -> tuple:
+        """
+        將各階段結果整理成融合器的排序列表
+
+        ES 命中依 collapse_key 去重；MySQL 與段落來源的 doc_id 若屬於已摺疊的群組
+        （出現在 inner_hits 中），換成群組鍵以便與 ES 命中合併。
+
+        Returns:
+            (rankings, hits): rankings 為 {來源: [(群組鍵, 原始分數)]}，
+            hits 為 {群組鍵: 代表該文件的 ES 命中}（取最先出現者）
+        """
+        rankings = {}
+        hits = {}
+        aliases: Dict[str, str] = {}
+
+        for source in ("es_keyword", "es_vector", "es_hybrid"):
+            if source not in results:
+                continue
+            ranking = []
+            seen = set()
+            for hit in results[source].get("hits", {}).get("hits", []):
+                key = self._hit_group_key(hit)
+                aliases.setdefault(self._hit_doc_id(hit), key)
+                for row in hit.get("inner_hits", {}).get("related", {}).get("hits", {}).get("hits", []):
+                    aliases.setdefault(self._hit_doc_id(row), key)
+                if key in seen:
+                    continue
+                seen.add(key)
+                hits.setdefault(key, hit)
+                ranking.append((key, float(hit.get("_score") or 0)))
+            rankings[source] = ranking
+
+        def merged(items):
+            best: Dict[str, float] = {}
+            for doc_id, score in items:
+                key = aliases.get(doc_id, doc_id)
+                best[key] = max(best.get(key, score), score)
+            return best
+
+        if "mysql_products" in results:
+            # 品號命中沒有分數，視為同名次
+            rankings["mysql_products"] = [
+                (key, 1.0) for key in sorted(merged((d, 1.0) for d in results["mysql_products"]))
+            ]
+        if "mysql_keywords" in results:
+            rankings["mysql_keywords"] = sorted(
+                merged(results["mysql_keywords"].items()).items(),
+                key=lambda item: item[1],
+                reverse=True,
+            )
+        if passage_ranking:
+            rankings["es_passages"] = sorted(
+                merged(passage_ranking).items(), key=lambda item: item[1], reverse=True
+            )
+
+        return rankings, hits
+
+    def _fusion_method(self, request: SearchRequest) -> str:
+        method = (request.fusion or "").lower()
+        return method if method in self.fusers else self.default_fusion
+
+    async def _process_results(
+        self,
+        hits: List[Dict],
+        scores: Dict[str, float],
+        query: str = "",
+        passages: Optional[Dict[str, List[Dict[str, Any]]]] = None,
     ) -> List[DocumentInfo]:
         """處理搜尋結果"""
-        documents = []
+        passages = passages or {}
+        # 已有段落命中的文件直接以段落作為片段，其餘才取完整內容；
+        # hits 已依 collapse_key 去重，每份文件只取一次內容、產生一次片段
+        doc_ids = list(
+            dict.fromkeys(
+                doc_id
+                for doc_id in (self._hit_doc_id(hit) for hit in hits)
+                if doc_id not in passages
+            )
+        )
+        full_contents = {}
+        if doc_ids:
+            with metrics.stage("full_content"):
+                full_contents = await self.mysql.run(self.mysql.get_full_content, doc_ids)
+
+        # 片段提取為 CPU 密集工作，移出事件迴圈
+        with metrics.stage("snippets"):
+            return await asyncio.to_thread(
+                self._build_documents, hits, scores, full_contents, query, passages
+            )
 
-        # 批量獲取完整內容
-        doc_ids = [
-            hit["_source"].get("original_doc_id")
-            or hit["_source"].get("doc_id")
-            or hit["_id"]
-            for hit in es_result.get("hits", {}).get("hits", [])
-        ]
-        full_contents = self.mysql.get_full_content(doc_ids) if doc_ids else {}
+    def _build_documents(
+        self,
+        hits: List[Dict],
+        scores: Dict[str, float],
+        full_contents: Dict[str, tuple],
+        query: str = "",
+        passages: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+    ) -> List[DocumentInfo]:
+        """組裝 DocumentInfo 列表（scores 為融合分數）"""
+        passages = passages or {}
+        documents = []
         query_keywords = self.extract_keywords(query) if query else []
 
-        for hit in es_result.get("hits", {}).get("hits", []):
+        for hit in hits:
             source = hit["_source"]
-            doc_id = source.get("original_doc_id") or source.get("doc_id") or hit["_id"]
-
-            # 計算評分
-            es_score = hit.get("_score", 0)
-            mysql_score = mysql_scores.get(doc_id, 0)
-            total_score = es_score + mysql_score
+            doc_id = self._hit_doc_id(hit)
+            total_score = scores.get(
+                self._hit_group_key(hit), scores.get(doc_id, hit.get("_score") or 0)
+            )
 
             # 解析 JSON 欄位
             product_codes = source.get("product_codes", [])
@@ -685,8 +2422,8 @@ class DocumentSearchService:
                 except:
                     keywords = []
 
-            # 清理內容
-            summary = clean_content(
+            # 清理內容（db-sync 已預先清理者直接使用）
+            summary = source.get("summary_clean") or clean_content(
                 source.get("summary", ""), preserve_line_breaks=True
             )
 
@@ -718,9 +2455,27 @@ class DocumentSearchService:
                 cleaned_highlight["_searchable_preview"] = [searchable_preview]
 
             # 提取內容片段
-            full_content = full_contents.get(doc_id, "")
+            doc_passages = passages.get(doc_id)
+            full_content, content_lower = full_contents.get(doc_id, ("", None))
             content_snippets = []
-            if full_content and query_keywords:
+            if doc_passages:
+                # 段落已是相關內容，每段取一個關鍵字片段（找不到則取開頭）
+                for passage in doc_passages:
+                    snippet = self.mysql.extract_smart_snippets(
+                        content=passage["content"],
+                        summary=summary,
+                        keywords=query_keywords,
+                        max_snippets=1,
+                        snippet_length=500,
+                    )
+                    content_snippets.extend(
+                        snippet
+                        or [
+                            passage["content"][:500]
+                            + ("..." if len(passage["content"]) > 500 else "")
+                        ]
+                    )
+            elif full_content and query_keywords:
                 # 🔥 使用智能片段提取方法
                 content_snippets = self.mysql.extract_smart_snippets(
                     content=full_content,
@@ -728,6 +2483,7 @@ class DocumentSearchService:
                     keywords=query_keywords,
                     max_snippets=5,  # 🔥 最多5個片段（原本是3個）
                     snippet_length=500,  # 🔥 每個片段500字元（原本是300）
+                    content_lower=content_lower,
                 )
             logger.info(content_snippets)
             if content_snippets:
@@ -773,9 +2529,11 @@ class DocumentSearchService:
                 keywords=keywords if keywords else None,
                 file_url=file_url,
                 file_name=file_name,
-                score=round(total_score, 3),
+                score=round(total_score, 4),
                 highlight=cleaned_highlight if cleaned_highlight else None,
                 index_name=hit.get("_index"),
+                passages=doc_passages,
+                related=self._related_rows(hit) or None,
             )
 
             documents.append(doc_info)
@@ -783,37 +2541,42 @@ class DocumentSearchService:
         documents.sort(key=lambda x: x.score, reverse=True)
         return documents
 
-    def _generate_gpt_response(
+    def _build_gpt_messages(
         self, query: str, documents: List[DocumentInfo]
-    ) -> Optional[str]:
-        """使用 GPT 生成智慧回應"""
-        if not self.gpt_client or not documents:
-            return None
-
-        try:
-            context_parts = []
-            for idx, doc in enumerate(documents[:5], start=1):
-                doc_identifier = doc.doc_number or doc.title or f"文件 {idx}"
-                products_str = (
-                    ", ".join(doc.product_codes) if doc.product_codes else "無"
-                )
-
-                context_parts.append(
-                    f"""
+    ) -> List[Dict[str, str]]:
+        """組裝 GPT 提示訊息"""
+        context_parts = []
+        for idx, doc in enumerate(documents[:5], start=1):
+            doc_identifier = doc.doc_number or doc.title or f"文件 {idx}"
+            products_str = ", ".join(doc.product_codes) if doc.product_codes else "無"
+
+            context_parts.append(
+                f"""
 【{doc_identifier}】
 類型: {doc.doc_type or '技術文件'}
 產品: {products_str}
 部門: {doc.department or '未指定'}
 摘要: {doc.summary[:200] if doc.summary else '無摘要'}
                 """.strip()
+            )
+            for passage in doc.passages or []:
+                page_start, page_end = passage.get("page_start"), passage.get("page_end")
+                if page_start and page_end and page_end != page_start:
+                    pages = f"第 {page_start}-{page_end} 頁"
+                elif page_start:
+                    pages = f"第 {page_start} 頁"
+                else:
+                    pages = "內文"
+                context_parts[-1] += (
+                    f"\n相關段落（{pages}）: {passage['content'][:GPT_PASSAGE_CHARS]}"
                 )
 
-            context = "\n\n".join(context_parts)
+        context = "\n\n".join(context_parts)
 
-            messages = [
-                {
-                    "role": "system",
-                    "content": """你是專業的技術文件助理。根據搜尋到的文件內容，提供準確、有條理的回答。
+        return [
+            {
+                "role": "system",
+                "content": """你是專業的技術文件助理。根據搜尋到的文件內容，提供準確、有條理的回答。
                     
 回答格式：
 【主要發現】
@@ -824,73 +2587,455 @@ class DocumentSearchService:
 
 【建議】
 建議參考文件 XXX 以了解更多細節。""",
-                },
-                {
-                    "role": "user",
-                    "content": f"查詢: {query}\n\n相關文件:\n{context}\n\n請根據以上文件回答查詢。",
-                },
-            ]
+            },
+            {
+                "role": "user",
+                "content": f"查詢: {query}\n\n相關文件:\n{context}\n\n請根據以上文件回答查詢。",
+            },
+        ]
 
-            response = self.gpt_client.chat.completions.create(
-                model=GPT_MODEL, messages=messages, max_tokens=500, temperature=0.7
-            )
+    async def _generate_gpt_response(
+        self, query: str, documents: List[DocumentInfo]
+    ) -> Optional[str]:
+        """使用 GPT 生成智慧回應"""
+        if not self.gpt_client or not documents:
+            return None
+
+        try:
+            with metrics.stage("gpt"), metrics.external("openai", "chat"):
+                response = await self.gpt_client.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=self._build_gpt_messages(query, documents),
+                    max_tokens=500,
+                    temperature=0.7,
+                )
 
             return response.choices[0].message.content
         except Exception as e:
             logger.error(f"GPT 回應生成失敗: {e}")
             return None
 
-    def hybrid_search(self, request: SearchRequest) -> SearchResponse:
-        """混合搜尋"""
+    async def stream_gpt_response(self, query: str, documents: List[DocumentInfo]):
+        """以串流方式產生 GPT 回應，逐段 yield 文字"""
+        if not self.gpt_client or not documents:
+            return
+
+        with metrics.external("openai", "chat_stream"):
+            stream = await self.gpt_client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=self._build_gpt_messages(query, documents),
+                max_tokens=500,
+                temperature=0.7,
+                stream=True,
+            )
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            # 客戶端斷線或取消時關閉上游連線，停止計費中的生成
+            await stream.close()
+
+    def _result_cache_key(self, request: SearchRequest) -> tuple:
+        """以正規化後的請求內容作為結果快取鍵"""
+        return (
+            normalize_query_text(request.query).lower(),
+            request.mode,
+            request.top_k,
+            request.use_gpt,
+            tuple(sorted(request.doc_type_filter or [])),
+            request.date_from or None,
+            request.date_to or None,
+            (request.department or "").strip() or None,
+            self._fusion_method(request),
+        )
+
+    def _searched_tables(self, request: SearchRequest) -> List[str]:
+        """本次搜尋涉及的索引所對應的來源資料表（含提供內容片段的 technical_documents）"""
+        indices, _ = self._search_scope(request)
+        return [
+            INDEX_SOURCE_TABLES[index]
+            for index in indices.split(",")
+            if index in INDEX_SOURCE_TABLES
+        ] + ["technical_documents"]
+
+    def cache_key(self, request: SearchRequest) -> tuple:
+        """結果快取鍵；水位納入鍵中，任一來源表前進後舊項目不再命中，由 LRU 自然淘汰"""
+        token = self.watermarks.token(self._searched_tables(request))
+        return (self._result_cache_key(request), token)
+
+    def cache_lookup(self, key: tuple, start_time: datetime) -> Optional[SearchResponse]:
+        cached = self.result_cache.get(key)
+        if cached is None:
+            return None
+        response = cached.model_copy(deep=True)
+        response.search_time_ms = int(
+            (datetime.now() - start_time).total_seconds() * 1000
+        )
+        response.metadata["cache"] = "hit"
+        return response
+
+    def cache_store(self, key: tuple, response: SearchResponse):
+        # 階段逾時的結果不完整，不寫入快取
+        if response.metadata.get("stages_timed_out"):
+            return
+        ttl = RESULT_CACHE_TTL if response.documents else RESULT_CACHE_NEGATIVE_TTL
+        stored = response.model_copy(deep=True)
+        # 階段耗時只屬於產生結果的那次請求
+        stored.metadata.pop("stages_ms", None)
+        self.result_cache.set(key, stored, ttl=ttl)
+
+    _NOT_CACHED = object()
+
+    async def get_documents(self, doc_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        批次取得文件詳情（快取未命中的 doc_id 合併成一次 MySQL 查詢）
+
+        快取鍵含 DETAIL_TABLES 的同步水位，任一表前進後舊項目不再命中，由 LRU 自然淘汰；
+        查無的 doc_id 以 DOCUMENT_CACHE_NEGATIVE_TTL 記錄。並行請求中查詢中的 doc_id
+        等待同一次查詢，不重複查詢。
+
+        Returns:
+            {doc_id: 文件詳情}；查無的 doc_id 不在結果中
+        """
+        token = self.watermarks.token(DETAIL_TABLES)
+        found: Dict[str, Optional[Dict[str, Any]]] = {}
+        loads: Dict[str, asyncio.Task] = {}
+        misses = []
+        for doc_id in dict.fromkeys(doc_ids):
+            key = (doc_id, token)
+            cached = self.document_cache.get(key, self._NOT_CACHED)
+            if cached is not self._NOT_CACHED:
+                found[doc_id] = cached
+            elif key in self._document_loads:
+                loads[doc_id] = self._document_loads[key]
+            else:
+                misses.append(doc_id)
+
+        if misses:
+            task = asyncio.ensure_future(self._load_documents(misses, token))
+            for doc_id in misses:
+                self._document_loads[(doc_id, token)] = task
+                loads[doc_id] = task
+
+        # shield：發起查詢的請求取消時，等待同一查詢的其他請求不受影響
+        for doc_id, task in loads.items():
+            found[doc_id] = (await asyncio.shield(task)).get(doc_id)
+        return {doc_id: doc for doc_id, doc in found.items() if doc is not None}
+
+    async def _load_documents(self, doc_ids: List[str], token: tuple) -> Dict[str, Any]:
+        """查詢文件詳情並寫入快取"""
+        try:
+            details = await self.mysql.run(self.mysql.get_document_details, doc_ids)
+            for doc_id in doc_ids:
+                doc = details.get(doc_id)
+                if doc is None:
+                    self.document_cache.set(
+                        (doc_id, token), None, len(doc_id), ttl=DOCUMENT_CACHE_NEGATIVE_TTL
+                    )
+                    continue
+                file_path = doc.get("file_path") or doc.get("file_name")
+                if file_path:
+                    doc["file_url"] = self.file_handler.generate_file_url(
+                        file_path, doc.get("file_name")
+                    )
+                    doc["download_url"] = doc["file_url"]
+                size = len(json.dumps(doc, ensure_ascii=False, default=str).encode("utf-8"))
+                self.document_cache.set((doc_id, token), doc, size)
+            return details
+        finally:
+            for doc_id in doc_ids:
+                self._document_loads.pop((doc_id, token), None)
+
+    async def hybrid_search(self, request: SearchRequest) -> SearchResponse:
+        """混合搜尋（含結果快取）"""
         start_time = datetime.now()
-        query = request.query
+        timings = metrics.start_request()
+        key = self.cache_key(request)
+        cached = self.cache_lookup(key, start_time)
+        if cached is not None:
+            if request.debug:
+                cached.metadata["stages_ms"] = dict(timings)
+            return cached
+
+        # retrieve 先分類查詢：純單號走快速路徑，自由文字才跑完整混合檢索
+        response = await self.retrieve(request)
+
+        # 生成 GPT 回應
+        if self.gpt_client and self._wants_gpt(request, response):
+            response.gpt_response = await self._generate_gpt_response(
+                request.query, response.documents
+            )
+        response.search_time_ms = int(
+            (datetime.now() - start_time).total_seconds() * 1000
+        )
+
+        self.cache_store(key, response)
+        response.metadata["cache"] = "miss"
+        if request.debug:
+            response.metadata["stages_ms"] = dict(timings)
+        return response
 
-        # 提取產品編號和關鍵字
-        product_ids = self.extract_product_ids(query)
+    def _analyze_query(self, query: str) -> tuple:
+        """辨識識別碼並提取產品編號和關鍵字；回傳 (產品編號, 關鍵字, 識別碼)"""
+        if self.identifiers.loaded:
+            identifiers = self.identifiers.resolve(query)
+            product_ids = identifiers.values("product_code")
+        else:
+            identifiers = None
+            product_ids = self.extract_product_ids(query)
         keywords = self.extract_keywords(query)
 
         logger.info(f"搜尋查詢: {query}")
+        if identifiers and identifiers.matches:
+            logger.info(
+                "識別碼: "
+                + ", ".join(
+                    f"{m.token}→{m.value}({m.match})" for m in identifiers.matches
+                )
+            )
         logger.info(f"識別產品編號: {product_ids}")
         logger.info(f"提取關鍵字: {keywords}")
+        return product_ids, keywords, identifiers
 
-        # MySQL 輔助查詢
-        mysql_doc_ids = set()
-        mysql_scores = {}
+    async def retrieve(self, request: SearchRequest) -> SearchResponse:
+        """檢索與排序（不含 GPT 回應）"""
+        start_time = datetime.now()
+        query = request.query
+        product_ids, keywords, identifiers = self._analyze_query(query)
+        indices, filters = self._search_scope(request)
 
-        if product_ids:
-            product_doc_ids = self.mysql.search_by_product_ids(product_ids)
-            mysql_doc_ids.update(product_doc_ids)
-            for doc_id in product_doc_ids:
-                mysql_scores[doc_id] = mysql_scores.get(doc_id, 0) + 10
+        values = self._fast_path_identifiers(query, identifiers)
+        if values:
+            response = await self._identifier_lookup(
+                request, values, indices, filters, product_ids, keywords, start_time
+            )
+            if response.documents:
+                return response
+            logger.info(f"識別碼 {values} 無符合文件，改走完整檢索")
 
+        # 各檢索階段互不相依，同時發出
+        empty_es = {"hits": {"hits": [], "total": {"value": 0}}}
+        stages = {}
+        if product_ids:
+            stages["mysql_products"] = (
+                self.mysql.run(self.mysql.search_by_product_ids, product_ids),
+                STAGE_TIMEOUT_MYSQL,
+                set(),
+            )
         if keywords:
-            keyword_scores = self.mysql.search_by_keywords(keywords)
-            mysql_doc_ids.update(keyword_scores.keys())
-            for doc_id, score in keyword_scores.items():
-                mysql_scores[doc_id] = mysql_scores.get(doc_id, 0) + score * 2
-
-        # Elasticsearch 搜尋
-        if request.mode == "keyword":
-            es_result = self.keyword_search(query, request.top_k * 2)
-        elif request.mode == "vector":
-            es_result = self.vector_search(query, request.top_k * 2)
-        else:
-            keyword_result = self.keyword_search(query, request.top_k)
-            vector_result = self.vector_search(query, request.top_k)
-            es_result = self._merge_results(keyword_result, vector_result)
+            stages["mysql_keywords"] = (
+                self.mysql.run(self.mysql.search_by_keywords, keywords),
+                STAGE_TIMEOUT_MYSQL,
+                {},
+            )
+        combined = ES_SEARCH_TRANSPORT != "separate"
+        # 合併送出時查詢向量另有逾時（COMBINED_EMBEDDING_TIMEOUT），逾時的來源由 combined_search 記錄於此
+        combined_timed_out: List[str] = []
+        if combined:
+            stages["es_search"] = (
+                self.combined_search(request, identifiers, combined_timed_out),
+                max(STAGE_TIMEOUT_KEYWORD, STAGE_TIMEOUT_PASSAGE)
+                + (COMBINED_EMBEDDING_TIMEOUT if request.mode in ("vector", "hybrid") else 0),
+                {},
+            )
+        es_size = max(request.top_k, math.ceil(request.top_k * FUSION_CANDIDATE_FACTOR))
+        if not combined and request.mode in ("keyword", "hybrid"):
+            stages["es_keyword"] = (
+                self.keyword_search(query, es_size, filters, indices, identifiers),
+                STAGE_TIMEOUT_KEYWORD,
+                empty_es,
+            )
+        if not combined and request.mode in ("vector", "hybrid"):
+            stages["es_vector"] = (
+                self.vector_search(query, es_size, filters, indices),
+                STAGE_TIMEOUT_VECTOR,
+                empty_es,
+            )
+        if not combined:
+            stages["es_passages"] = (
+                self.passage_search(query, request.mode, filters=filters),
+                STAGE_TIMEOUT_PASSAGE,
+                empty_es,
+            )
 
-        # 處理結果
-        final_documents = self._process_results(
-            es_result, mysql_scores, mysql_doc_ids, query=query
+        results, timed_out = await self._gather_stages(stages, SEARCH_DEADLINE)
+        if combined:
+            # 合併送出的搜尋逾時或失敗時，視為其涵蓋的各來源皆逾時
+            results.update(results.pop("es_search"))
+            timed_out.extend(combined_timed_out)
+            if "es_search" in timed_out:
+                timed_out.remove("es_search")
+                timed_out.extend(
+                    name
+                    for name, modes in (
+                        ("es_keyword", ("keyword", "hybrid")),
+                        ("es_vector", ("vector", "hybrid")),
+                        ("es_passages", (request.mode,)),
+                    )
+                    if request.mode in modes and name not in timed_out
+                )
+        return await self._rank_results(
+            request, product_ids, keywords, results, timed_out, start_time
         )
-        final_documents = final_documents[: request.top_k]
 
-        # 生成 GPT 回應
-        gpt_response = None
-        if request.use_gpt and self.gpt_client and final_documents:
-            gpt_response = self._generate_gpt_response(query, final_documents)
+    @staticmethod
+    def _fast_path_identifiers(
+        query: str, identifiers: Optional[QueryIdentifiers]
+    ) -> List[str]:
+        """
+        查詢路由：查詢去掉完全比對的單號/案號後只剩空白與標點時，回傳要直接查詢的識別碼；
+        含其他文字（自由文字問題）、容錯比對或無法辨識的代碼時回傳空列表走完整檢索
+        """
+        if not IDENTIFIER_FAST_PATH or not identifiers or not identifiers.matches:
+            return []
+        if identifiers.unresolved or any(m.match != "exact" for m in identifiers.matches):
+            return []
+        if not all(m.kinds & FAST_PATH_KINDS for m in identifiers.matches):
+            return []
+        residual = unicodedata.normalize("NFKC", query)
+        for token in {m.token for m in identifiers.matches}:
+            residual = residual.replace(token, " ")
+        if re.sub(r"[\W_]+", "", residual):
+            return []
+        return identifiers.values()
+
+    async def _identifier_lookup(
+        self,
+        request: SearchRequest,
+        values: List[str],
+        indices: str,
+        filters: tuple,
+        product_ids: List[str],
+        keywords: List[str],
+        start_time: datetime,
+    ) -> SearchResponse:
+        """識別碼快速路徑：一次 terms 查詢取回記錄，不產生向量、不查 MySQL 關鍵字、不呼叫 GPT"""
+        search_body = {
+            "size": request.top_k,
+            "_source": {"excludes": ["original_extracted_content", "content_vector"]},
+            "query": {
+                "bool": {
+                    "should": [{"terms": {field: values}} for field in IDENTIFIER_FIELDS],
+                    "minimum_should_match": 1,
+                    "filter": list(filters),
+                }
+            },
+        }
+        if self._collapse_enabled(indices):
+            search_body["collapse"] = self._collapse_clause()
+
+        hits = []
+        try:
+            with (
+                metrics.stage("identifier_lookup"),
+                metrics.external("elasticsearch", "identifier_lookup"),
+            ):
+                response = await asyncio.wait_for(
+                    self.es_client.post(f"{ES_URL}/{indices}/_search", json=search_body),
+                    STAGE_TIMEOUT_KEYWORD,
+                )
+                response.raise_for_status()
+            hits = response.json().get("hits", {}).get("hits", [])
+        except Exception as e:
+            logger.error(f"識別碼查詢失敗: {e}")
+
+        unique = {}
+        for hit in hits:
+            unique.setdefault(self._hit_group_key(hit), hit)
+        documents = []
+        if unique:
+            documents = await self._process_results(
+                list(unique.values()),
+                {key: float(hit.get("_score") or 0) for key, hit in unique.items()},
+                query=request.query,
+            )
+
+        search_time = int((datetime.now() - start_time).total_seconds() * 1000)
+        metrics.observe_results(request.mode, len(documents))
+        return SearchResponse(
+            success=True,
+            query=request.query,
+            mode=request.mode,
+            total=len(documents),
+            documents=documents,
+            search_time_ms=search_time,
+            metadata={
+                "route": "identifier",
+                "identifiers": values,
+                "product_ids_found": product_ids,
+                "keywords_used": keywords,
+                "indices_searched": indices,
+                "stages_timed_out": [],
+                "candidates": len(unique),
+            },
+        )
+
+    @staticmethod
+    def _wants_gpt(request: SearchRequest, response: SearchResponse) -> bool:
+        """快速路徑的結果是單號直接查詢，不需要 GPT 摘要"""
+        return (
+            request.use_gpt
+            and bool(response.documents)
+            and response.metadata.get("route") != "identifier"
+        )
+
+    async def _rank_results(
+        self,
+        request: SearchRequest,
+        product_ids: List[str],
+        keywords: List[str],
+        results: Dict[str, Any],
+        timed_out: List[str],
+        start_time: datetime,
+    ) -> SearchResponse:
+        """融合各階段結果、補查上層文件並組成回應"""
+        query = request.query
+        indices, _ = self._search_scope(request)
+        empty_es = {"hits": {"hits": [], "total": {"value": 0}}}
+
+        # 各來源依名次或正規化分數融合；段落以最佳段落代表其上層文件，
+        # MySQL 來源僅影響排序
+        passage_ranking, passages = self._group_passages(
+            results.get("es_passages", empty_es)
+        )
+        rankings, hits = self._collect_rankings(results, passage_ranking)
+        method = self._fusion_method(request)
+        with metrics.stage("fusion"):
+            fused = [
+                (doc_id, score)
+                for doc_id, score in self.fusers[method].fuse(rankings)
+                if doc_id in hits or doc_id in passages
+            ]
+
+        # 先截斷再取片段，避免處理不會回傳的候選；只由段落命中的文件補查記錄
+        selected = fused[: request.top_k]
+        missing = [doc_id for doc_id, _ in selected if doc_id not in hits]
+        if missing:
+            hits.update(await self._fetch_parent_hits(missing, indices))
+            selected = [(doc_id, score) for doc_id, score in selected if doc_id in hits]
+
+        if self.fusion_log.enabled:
+            await asyncio.to_thread(
+                self.fusion_log.log, query, request.mode, method, rankings, fused
+            )
+
+        final_documents = await self._process_results(
+            [hits[doc_id] for doc_id, _ in selected],
+            dict(selected),
+            query=query,
+            passages=passages,
+        )
+
+        mysql_doc_ids = set(results.get("mysql_products", set())) | set(
+            results.get("mysql_keywords", {})
+        )
 
         search_time = int((datetime.now() - start_time).total_seconds() * 1000)
+        metrics.observe_results(request.mode, len(final_documents))
 
         return SearchResponse(
             success=True,
@@ -898,19 +3043,568 @@ class DocumentSearchService:
             mode=request.mode,
             total=len(final_documents),
             documents=final_documents,
-            gpt_response=gpt_response,
             search_time_ms=search_time,
             metadata={
+                "route": "hybrid",
                 "mysql_hits": len(mysql_doc_ids),
                 "product_ids_found": product_ids,
                 "keywords_used": keywords,
-                "indices_searched": ES_INDEX_PATTERN,
+                "indices_searched": indices,
+                "stages_timed_out": timed_out,
+                "fusion": method,
+                "candidates": len(hits),
+                "passage_hits": sum(len(p) for p in passages.values()),
             },
         )
 
+    async def batch_search(self, requests: List[SearchRequest]) -> List[SearchResponse]:
+        """
+        批次搜尋（含結果快取）
+
+        快取未命中且內容相同的請求只檢索一次；各項目的 GPT 回應
+        以 BATCH_GPT_CONCURRENCY 限制並行數。
+        """
+        start_time = datetime.now()
+        timings = metrics.start_request()
+        keys = [self.cache_key(request) for request in requests]
+        responses: List[Optional[SearchResponse]] = [
+            self.cache_lookup(key, start_time) for key in keys
+        ]
+
+        pending: Dict[tuple, int] = {}
+        for i, response in enumerate(responses):
+            if response is None:
+                pending.setdefault(keys[i], i)
+
+        if pending:
+            retrieved = await self.retrieve_batch([requests[i] for i in pending.values()])
+            semaphore = asyncio.Semaphore(max(1, BATCH_GPT_CONCURRENCY))
+
+            async def _finish(request: SearchRequest, response: SearchResponse):
+                started = time.perf_counter()
+                if self.gpt_client and self._wants_gpt(request, response):
+                    async with semaphore:
+                        response.gpt_response = await self._generate_gpt_response(
+                            request.query, response.documents
+                        )
+                gpt_ms = int((time.perf_counter() - started) * 1000)
+                response.metadata["timings_ms"]["gpt"] = gpt_ms
+                response.search_time_ms += gpt_ms
+                return response
+
+            finished = await asyncio.gather(
+                *(
+                    _finish(requests[i], response)
+                    for i, response in zip(pending.values(), retrieved)
+                )
+            )
+            for (key, i), response in zip(pending.items(), finished):
+                self.cache_store(key, response)
+                response.metadata["cache"] = "miss"
+                responses[i] = response
+
+        # 批次內重複的請求共用結果，各自持有副本
+        results = []
+        for request, key, response in zip(requests, keys, responses):
+            if response is None:
+                response = responses[pending[key]].model_copy(deep=True)
+            if request.debug:
+                response.metadata["stages_ms"] = {
+                    **timings,
+                    **response.metadata.get("stages_ms", {}),
+                }
+            elif "stages_ms" in response.metadata:
+                del response.metadata["stages_ms"]
+            results.append(response)
+        return results
+
+    async def retrieve_batch(self, requests: List[SearchRequest]) -> List[SearchResponse]:
+        """
+        批次檢索與排序（不含 GPT 回應）
+
+        所有查詢文字以一次 embeddings 呼叫產生向量，全部 ES 搜尋以一次
+        _msearch 送出，MySQL 品號查詢合併為一次、相同關鍵字組合只查一次；
+        之後各項目分別融合與組成回應。純單號的項目先走識別碼快速路徑，
+        不參與上述共用階段。
+
+        各項目的 metadata.timings_ms 記錄共用階段（embedding / search）
+        與該項目自身的 rank 耗時，search_time_ms 為三者之和。
+        """
+        start_time = datetime.now()
+        empty_es = {"hits": {"hits": [], "total": {"value": 0}}}
+        analyses = [self._analyze_query(request.query) for request in requests]
+
+        # 0. 純單號項目走快速路徑；查無文件者仍併入完整檢索
+        routed = {
+            i: values
+            for i, request in enumerate(requests)
+            if (values := self._fast_path_identifiers(request.query, analyses[i][2]))
+        }
+        fast: Dict[int, SearchResponse] = {}
+        if routed:
+            looked_up = await asyncio.gather(
+                *(
+                    self._identifier_lookup(
+                        requests[i],
+                        values,
+                        *self._search_scope(requests[i]),
+                        analyses[i][0],
+                        analyses[i][1],
+                        start_time,
+                    )
+                    for i, values in routed.items()
+                )
+            )
+            fast = {
+                i: response
+                for i, response in zip(routed, looked_up)
+                if response.documents
+            }
+        full = [i for i in range(len(requests)) if i not in fast]
+
+        # 1. 向量：一次 embeddings 呼叫
+        started = time.perf_counter()
+        vector_texts = list(
+            dict.fromkeys(
+                requests[i].query for i in full if requests[i].mode in ("vector", "hybrid")
+            )
+        )
+        vectors = {}
+        embedding_timed_out = False
+        if vector_texts:
+            try:
+                embedded = await asyncio.wait_for(
+                    self.vector_gen.generate_many(vector_texts), STAGE_TIMEOUT_VECTOR
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"⏱️ 批次向量生成逾時 ({STAGE_TIMEOUT_VECTOR}s)")
+                embedded = [None] * len(vector_texts)
+                embedding_timed_out = True
+            vectors = dict(zip(vector_texts, embedded))
+        embedding_ms = int((time.perf_counter() - started) * 1000)
+
+        # 2. ES（一次 _msearch）與 MySQL（跨項目共用）同時發出
+        started = time.perf_counter()
+        searches = []
+        per_item: List[Dict[str, Any]] = []
+        for i, request in enumerate(requests):
+            if i in fast:
+                per_item.append({})
+                continue
+            sources, item_searches = self._es_searches(
+                request, vectors.get(request.query), analyses[i][2]
+            )
+            results = {name: empty_es for name in sources}
+            searches.extend((i, name, index, body) for name, index, body in item_searches)
+            per_item.append(results)
+
+        all_product_ids = list(
+            dict.fromkeys(pid for i in full for pid in analyses[i][0])
+        )
+        keyword_sets = [tuple(analyses[i][1]) for i in full if analyses[i][1]]
+        stages = {}
+        msearch_errors: List[int] = []
+        if searches:
+            stages["es_msearch"] = (
+                self._msearch(
+                    [(index, body) for _, _, index, body in searches], msearch_errors
+                ),
+                BATCH_SEARCH_DEADLINE,
+                [],
+            )
+        if all_product_ids:
+            stages["mysql_products"] = (
+                self.mysql.run(self.mysql.search_product_docs, all_product_ids),
+                STAGE_TIMEOUT_MYSQL,
+                {},
+            )
+        if keyword_sets:
+            stages["mysql_keywords"] = (
+                self.mysql.run(self.mysql.search_by_keywords_many, keyword_sets),
+                min(BATCH_SEARCH_DEADLINE, STAGE_TIMEOUT_MYSQL * len(set(keyword_sets))),
+                {},
+            )
+        shared, failed = await self._gather_stages(stages, BATCH_SEARCH_DEADLINE)
+
+        # 3. 依項目分配結果；子欄位比對無命中的關鍵字搜尋合併一次容錯重查
+        timed_out = [[] for _ in requests]
+        for (i, stage, _, _), result in zip(searches, shared.get("es_msearch") or []):
+            per_item[i][stage] = result
+        # retriever 項目失敗（同 combined_search）：停用 retriever，失敗項目改以分開的關鍵字、向量搜尋再送一次 _msearch
+        hybrid_failed = [searches[p][0] for p in msearch_errors if searches[p][1] == "es_hybrid"]
+        if hybrid_failed:
+            logger.warning("⚠️ rrf retriever 查詢失敗，停用至服務重啟，改由 rag-api 融合")
+            self.rrf_retriever = False
+            resend = []
+            for i in hybrid_failed:
+                del per_item[i]["es_hybrid"]
+                sources, item_searches = self._es_searches(
+                    requests[i], vectors.get(requests[i].query), analyses[i][2]
+                )
+                # 段落搜尋不在 retriever 內，已有結果
+                per_item[i].update(
+                    (name, empty_es) for name in sources if name != "es_passages"
+                )
+                resend.extend(
+                    (i, name, index, body)
+                    for name, index, body in item_searches
+                    if name != "es_passages"
+                )
+            resend_errors: List[int] = []
+            try:
+                resent = await self._msearch(
+                    [(index, body) for _, _, index, body in resend], resend_errors
+                )
+            except Exception as e:
+                logger.error(f"批次搜尋重送失敗: {e}")
+                resent = [empty_es] * len(resend)
+                resend_errors = list(range(len(resend)))
+            for (i, stage, _, _), result in zip(resend, resent):
+                per_item[i][stage] = result
+            msearch_errors = [
+                p for p in msearch_errors if searches[p][1] != "es_hybrid"
+            ] + [len(searches) + p for p in resend_errors]
+            searches.extend(resend)
+        keyword_searches = [
+            (i, index, body)
+            for i, stage, index, body in searches
+            if stage == "es_keyword" and "es_msearch" not in failed
+        ]
+        if keyword_searches:
+            retried = await self._fuzzy_fallbacks(
+                [
+                    (index, body, analyses[i][2], per_item[i]["es_keyword"])
+                    for i, index, body in keyword_searches
+                ]
+            )
+            for (i, _, _), result in zip(keyword_searches, retried):
+                per_item[i]["es_keyword"] = result
+        search_ms = int((time.perf_counter() - started) * 1000)
+        for position in msearch_errors:
+            i, stage, _, _ = searches[position]
+            timed_out[i].append(stage)
+        for i in full:
+            product_ids, keywords, _ = analyses[i]
+            if product_ids:
+                matches = shared.get("mysql_products", {})
+                per_item[i]["mysql_products"] = set().union(
+                    *(matches.get(pid, set()) for pid in product_ids)
+                )
+                if "mysql_products" in failed:
+                    timed_out[i].append("mysql_products")
+            if keywords:
+                per_item[i]["mysql_keywords"] = shared.get("mysql_keywords", {}).get(
+                    tuple(keywords), {}
+                )
+                if "mysql_keywords" in failed:
+                    timed_out[i].append("mysql_keywords")
+            if "es_msearch" in failed:
+                timed_out[i].extend(
+                    name for name in ("es_keyword", "es_vector", "es_hybrid", "es_passages")
+                    if name in per_item[i]
+                )
+            elif embedding_timed_out and "es_vector" in per_item[i]:
+                timed_out[i].append("es_vector")
+
+        # 4. 各項目分別融合與組成回應
+        async def _rank(i: int) -> SearchResponse:
+            # 每個項目在自己的任務中記錄 fusion / snippets 等階段
+            item_timings = metrics.start_request()
+            started = time.perf_counter()
+            product_ids, keywords, _ = analyses[i]
+            if i in fast:
+                response = fast[i]
+            else:
+                response = await self._rank_results(
+                    requests[i], product_ids, keywords, per_item[i], timed_out[i], start_time
+                )
+            rank_ms = int((time.perf_counter() - started) * 1000)
+            if requests[i].debug:
+                response.metadata["stages_ms"] = dict(item_timings)
+            response.search_time_ms = embedding_ms + search_ms + rank_ms
+            response.metadata["timings_ms"] = {
+                "embedding": embedding_ms,
+                "search": search_ms,
+                "rank": rank_ms,
+            }
+            response.metadata["batch_size"] = len(requests)
+            return response
+
+        return list(await asyncio.gather(*(_rank(i) for i in range(len(requests)))))
+
+    async def _gather_stages(self, stages: Dict[str, tuple], deadline: float):
+        """
+        並行執行檢索階段
+
+        Args:
+            stages: {階段名稱: (協程, 階段逾時秒數, 逾時/失敗時的預設值)}
+            deadline: 全部階段的整體上限（秒）
+
+        Returns:
+            (各階段結果 dict, 逾時或失敗的階段名稱列表)
+        """
+
+        async def _run(name, coro, timeout):
+            try:
+                with metrics.stage(name):
+                    return await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⏱️ 檢索階段 {name} 逾時 ({timeout}s)")
+                metrics.stage_failed(name, "timeout")
+                raise
+
+        tasks = {
+            name: asyncio.ensure_future(_run(name, coro, timeout))
+            for name, (coro, timeout, _) in stages.items()
+        }
+        if not tasks:
+            return {}, []
+
+        try:
+            _, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"⏱️ 檢索截止時間 {deadline}s 已到，{len(pending)} 個階段未完成")
+
+        results, failed = {}, []
+        for name, task in tasks.items():
+            default = stages[name][2]
+            if task in pending or task.cancelled():
+                metrics.stage_failed(name, "deadline")
+                results[name] = default
+                failed.append(name)
+            elif task.exception() is not None:
+                if not isinstance(task.exception(), asyncio.TimeoutError):
+                    logger.error(f"檢索階段 {name} 失敗: {task.exception()}")
+                    metrics.stage_failed(name, "error")
+                results[name] = default
+                failed.append(name)
+            else:
+                results[name] = task.result()
+        return results, failed
+
+
+# ==================== 狀態快照 ====================
+class StatusMonitor:
+    """
+    /health 與 /stats 的背景快照
+
+    ES 叢集狀態、MySQL ping 與各索引文件數（單次 _cat/indices）由背景任務
+    每 STATUS_REFRESH_INTERVAL 秒更新一次；探測請求只讀取記憶體中的快照。
+    同時讀取索引 mapping，更新向量來源與目前提供者不一致的索引及可摺疊的索引；
+    ES_SEARCH_TRANSPORT=retriever 時探測叢集是否支援 rrf retriever。
+
+    斷詞字典的品名/客戶名稱與識別碼索引由另一個背景任務以相同間隔更新（同步水位前進時重建），
+    不佔用快照更新，重建失敗或耗時也不影響 /health。
+    """
+
+    def __init__(self, service: "DocumentSearchService"):
+        self.service = service
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self.refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._reload_task: Optional[asyncio.Task] = None
+
+    async def _cluster_status(self) -> Optional[str]:
+        try:
+            with metrics.external("elasticsearch", "cluster_health"):
+                response = await self.service.es_client.get(
+                    f"{ES_URL}/_cluster/health", timeout=5
+                )
+                response.raise_for_status()
+            return response.json().get("status")
+        except Exception as e:
+            logger.warning(f"⚠️ ES 叢集狀態查詢失敗: {e}")
+            return None
+
+    async def _index_counts(self) -> Optional[Dict[str, int]]:
+        try:
+            with metrics.external("elasticsearch", "cat_indices"):
+                response = await self.service.es_client.get(
+                    f"{ES_URL}/_cat/indices",
+                    params={"format": "json", "h": "index,docs.count"},
+                    timeout=5,
+                )
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"⚠️ 索引文件數查詢失敗: {e}")
+            return None
+
+        counts = {
+            row["index"]: int(row.get("docs.count") or 0) for row in response.json()
+        }
+        return {
+            index: counts.get(index, 0)
+            for index in ES_INDEX_PATTERN.split(",") + [PASSAGE_INDEX]
+        }
+
+    async def _index_mappings(self):
+        """讀取各索引 mapping，更新向量相容性（提供者停用時略過）與可摺疊的索引"""
+        try:
+            with metrics.external("elasticsearch", "get_mapping"):
+                response = await self.service.es_client.get(
+                    f"{ES_URL}/{ES_INDEX_PATTERN},{PASSAGE_INDEX}/_mapping",
+                    params={"ignore_unavailable": "true"},
+                    timeout=5,
+                )
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"⚠️ 索引 mapping 查詢失敗: {e}")
+            return
+        mappings = response.json()
+        if self.service.vector_gen.provider:
+            self.service.vector_gen.update_compatibility(mappings)
+        self.service.update_collapse_support(mappings)
+        self.service.update_identifier_support(mappings)
+
+    async def _probe_retriever(self):
+        """以不命中任何文件的 rrf retriever 查詢探測版本與授權；取得明確結果後不再探測"""
+        if ES_SEARCH_TRANSPORT != "retriever" or self.service.rrf_retriever is not None:
+            return
+        match_none = {"standard": {"query": {"match_none": {}}}}
+        body = {
+            "size": 0,
+            "retriever": {"rrf": {"retrievers": [match_none, match_none]}},
+            "highlight": {"fields": {"summary": {}}},
+        }
+        try:
+            with metrics.external("elasticsearch", "retriever_probe"):
+                response = await self.service.es_client.post(
+                    f"{ES_URL}/{ES_INDEX_PATTERN}/_search",
+                    params={"ignore_unavailable": "true", "allow_no_indices": "true"},
+                    json=body,
+                    timeout=5,
+                )
+        except Exception as e:
+            logger.warning(f"⚠️ rrf retriever 探測失敗: {e}")
+            return
+        if response.status_code == 200:
+            self.service.rrf_retriever = True
+            logger.info("🔀 ES 支援 rrf retriever，hybrid 查詢由 ES 合併關鍵字與向量排序")
+        elif 400 <= response.status_code < 500:
+            self.service.rrf_retriever = False
+            logger.warning(
+                f"⚠️ ES 不支援 rrf retriever，改由 rag-api 融合: {response.text[:200]}"
+            )
+
+    async def refresh(self):
+        names = ("cluster_status", "mysql", "index_counts", "index_mappings", "retriever_probe")
+        results = await asyncio.gather(
+            self._cluster_status(),
+            self.service.mysql.run(self.service.mysql.ping),
+            self._index_counts(),
+            self._index_mappings(),
+            self._probe_retriever(),
+            return_exceptions=True,
+        )
+        # 個別項目失敗時視為未知，其餘結果照常寫入快照
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error(f"狀態快照 {name} 更新失敗: {result}")
+        cluster_status, mysql_ok, index_counts = (
+            None if isinstance(result, Exception) else result for result in results[:3]
+        )
+        if index_counts is None and self.snapshot:
+            # 查詢失敗時沿用上一份文件數
+            index_counts = self.snapshot["index_counts"]
+        self.snapshot = {
+            "elasticsearch_status": cluster_status,
+            "mysql": mysql_ok,
+            "index_counts": index_counts or {},
+            "timestamp": datetime.now().isoformat(),
+        }
+        self.refreshed_at = time.monotonic()
+
+    async def get(self) -> tuple:
+        """回傳 (快照, 快照年齡秒數)；尚無快照時先同步更新一次"""
+        if self.snapshot is None:
+            async with self._lock:
+                if self.snapshot is None:
+                    await self.refresh()
+        return self.snapshot, time.monotonic() - self.refreshed_at
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"狀態快照更新失敗: {e}")
+            await asyncio.sleep(STATUS_REFRESH_INTERVAL)
+
+    async def reload(self):
+        """重建斷詞字典與識別碼索引；兩者互不影響"""
+        results = await asyncio.gather(
+            self.service.refresh_lexicon(),
+            self.service.refresh_identifiers(),
+            return_exceptions=True,
+        )
+        for name, result in zip(("lexicon", "identifiers"), results):
+            if isinstance(result, Exception):
+                logger.error(f"{name} 更新失敗: {result}")
+
+    async def _run_reloads(self):
+        while True:
+            await self.reload()
+            await asyncio.sleep(STATUS_REFRESH_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        if self._reload_task is None:
+            self._reload_task = asyncio.ensure_future(self._run_reloads())
+
+    async def stop(self):
+        for task in (self._task, self._reload_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self._task = None
+        self._reload_task = None
+
 
 # ==================== 初始化服務 ====================
 search_service = DocumentSearchService()
+status_monitor = StatusMonitor(search_service)
+metrics.register_stats(
+    {
+        "embedding_memory": search_service.vector_gen.cache.stats,
+        **(
+            {"embedding_disk": search_service.vector_gen.disk_cache.stats}
+            if search_service.vector_gen.disk_cache
+            else {}
+        ),
+        "result": search_service.result_cache.stats,
+        "mysql_pool": search_service.mysql.pool.stats,
+    }
+)
+
+
+async def run_until_disconnect(http_request: Request, coro):
+    """
+    執行協程並監看客戶端連線；客戶端斷線時取消任務，
+    讓進行中的 ES / OpenAI 呼叫一併中止。
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                logger.info("客戶端已斷線，取消搜尋")
+                task.cancel()
+                raise HTTPException(status_code=499, detail="客戶端已斷線")
+    finally:
+        if not task.done():
+            task.cancel()
 
 
 # ==================== API 端點 ====================
@@ -928,20 +3622,25 @@ async def root():
 @app.get("/health")
 async def health_check():
     try:
-        es_health = search_service.es_session.get(
-            f"{ES_URL}/_cluster/health", timeout=5
-        )
-        es_status = es_health.status_code == 200
-
-        search_service.mysql.ensure_connection()
-        mysql_status = search_service.mysql.connection is not None
+        snapshot, age = await status_monitor.get()
+        es_status = snapshot["elasticsearch_status"] is not None
+        mysql_status = snapshot["mysql"]
+        stale = age > STATUS_STALE_AFTER
 
         return {
-            "status": "healthy" if (es_status and mysql_status) else "degraded",
+            "status": "healthy"
+            if (es_status and mysql_status and not stale)
+            else "degraded",
             "elasticsearch": es_status,
+            "elasticsearch_status": snapshot["elasticsearch_status"],
             "mysql": mysql_status,
             "openai": search_service.gpt_client is not None,
-            "timestamp": datetime.now().isoformat(),
+            "embedding": search_service.vector_gen.status(),
+            "search_transport": ES_SEARCH_TRANSPORT,
+            "rrf_retriever": search_service.rrf_retriever,
+            "timestamp": snapshot["timestamp"],
+            "age_seconds": round(age, 1),
+            "stale": stale,
         }
     except Exception as e:
         logger.error(f"健康檢查失敗: {e}")
@@ -954,28 +3653,32 @@ async def health_check():
 
 @app.get("/stats")
 async def get_statistics():
-    """獲取系統統計資訊"""
+    """獲取系統統計資訊（索引文件數取自背景快照）"""
     try:
-        indices = ES_INDEX_PATTERN.split(",")
-        index_counts = {}
-        total_docs = 0
-
-        for index in indices:
-            try:
-                count_response = search_service.es_session.get(
-                    f"{ES_URL}/{index}/_count", timeout=5
-                )
-                if count_response.status_code == 200:
-                    count = count_response.json().get("count", 0)
-                    index_counts[index] = count
-                    total_docs += count
-            except:
-                index_counts[index] = 0
+        snapshot, age = await status_monitor.get()
+        counts = snapshot["index_counts"]
+        index_counts = {
+            index: counts.get(index, 0) for index in ES_INDEX_PATTERN.split(",")
+        }
 
         return {
             "success": True,
-            "stats": {"total_documents": total_docs, "index_counts": index_counts},
-            "timestamp": datetime.now().isoformat(),
+            "stats": {
+                "total_documents": sum(index_counts.values()),
+                "index_counts": index_counts,
+                "passages": counts.get(PASSAGE_INDEX, 0),
+                "embedding": search_service.vector_gen.status(),
+                "embedding_cache": search_service.vector_gen.cache_stats(),
+                "result_cache": search_service.result_cache.stats(),
+                "document_cache": search_service.document_cache.stats(),
+                "mysql_pool": search_service.mysql.pool.stats(),
+                "query_analysis": {
+                    **search_service.identifiers.stats(),
+                    **search_service.segmenter.stats(),
+                },
+            },
+            "timestamp": snapshot["timestamp"],
+            "age_seconds": round(age, 1),
         }
     except Exception as e:
         logger.error(f"獲取統計失敗: {e}")
@@ -983,35 +3686,159 @@ async def get_statistics():
 
 
 @app.post("/query", response_model=SearchResponse)
-async def search_documents(request: SearchRequest):
+async def search_documents(request: SearchRequest, http_request: Request):
     """文件搜尋端點"""
     try:
         logger.info(f"收到搜尋請求: {request.query}, 模式: {request.mode}")
-        response = search_service.hybrid_search(request)
+        with metrics.request("query"):
+            response = await run_until_disconnect(
+                http_request, search_service.hybrid_search(request)
+            )
         return response
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"搜尋失敗: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/query/batch", response_model=BatchSearchResponse)
+async def search_documents_batch(request: BatchSearchRequest, http_request: Request):
+    """
+    批次搜尋端點
+
+    所有查詢共用一次 embeddings 呼叫、一次 ES _msearch 與合併後的 MySQL 查詢；
+    results 與 requests 順序一致，各項目保有自己的 metadata 與耗時。
+    """
+    start_time = datetime.now()
+    try:
+        logger.info(f"收到批次搜尋請求: {len(request.requests)} 筆")
+        with metrics.request("query_batch"):
+            results = await run_until_disconnect(
+                http_request, search_service.batch_search(request.requests)
+            )
+        return BatchSearchResponse(
+            success=True,
+            total=len(results),
+            results=results,
+            search_time_ms=int((datetime.now() - start_time).total_seconds() * 1000),
+            metadata={
+                "cache_hits": sum(
+                    1 for response in results if response.metadata.get("cache") == "hit"
+                ),
+            },
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"批次搜尋失敗: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def sse_event(event: str, data: Any) -> str:
+    """格式化一則 server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/query/stream")
+async def search_documents_stream(request: SearchRequest, http_request: Request):
+    """
+    串流搜尋端點 (text/event-stream)
+
+    事件順序：documents（檢索完成即送出）→ token（GPT 逐段輸出，可多則）→ done；
+    發生錯誤時送出 error。客戶端斷線時停止並關閉上游 GPT 串流。
+    """
+    logger.info(f"收到串流搜尋請求: {request.query}, 模式: {request.mode}")
+
+    async def event_stream():
+        start_time = datetime.now()
+        timings = metrics.start_request()
+        key = search_service.cache_key(request)
+        try:
+            with metrics.request("query_stream"):
+                response = search_service.cache_lookup(key, start_time)
+                cached = response is not None
+                if not cached:
+                    response = await search_service.retrieve(request)
+                    response.metadata["cache"] = "miss"
+
+                metadata = dict(response.metadata)
+                if request.debug:
+                    metadata["stages_ms"] = dict(timings)
+                yield sse_event(
+                    "documents",
+                    {
+                        "query": response.query,
+                        "mode": response.mode,
+                        "total": response.total,
+                        "documents": [d.model_dump(mode="json") for d in response.documents],
+                        "search_time_ms": response.search_time_ms,
+                        "metadata": metadata,
+                    },
+                )
+
+                if cached:
+                    if response.gpt_response:
+                        yield sse_event("token", {"content": response.gpt_response})
+                elif search_service.gpt_client and search_service._wants_gpt(request, response):
+                    parts = []
+                    with metrics.stage("gpt"):
+                        async with contextlib.aclosing(
+                            search_service.stream_gpt_response(
+                                request.query, response.documents
+                            )
+                        ) as deltas:
+                            async for delta in deltas:
+                                if await http_request.is_disconnected():
+                                    logger.info("客戶端已斷線，停止串流")
+                                    return
+                                parts.append(delta)
+                                yield sse_event("token", {"content": delta})
+                    response.gpt_response = "".join(parts) or None
+
+                total_ms = int((datetime.now() - start_time).total_seconds() * 1000)
+                if not cached:
+                    response.search_time_ms = total_ms
+                    search_service.cache_store(key, response)
+                done = {"search_time_ms": total_ms}
+                if request.debug:
+                    done["stages_ms"] = dict(timings)
+                yield sse_event("done", done)
+        except asyncio.CancelledError:
+            logger.info("客戶端已斷線，串流已取消")
+            raise
+        except Exception as e:
+            logger.error(f"串流搜尋失敗: {e}", exc_info=True)
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 指標"""
+    if not metrics.enabled:
+        return PlainTextResponse("prometheus_client 未安裝\n", status_code=503)
+    return Response(metrics.render(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/document/{doc_id}")
 async def get_document(doc_id: str):
     """獲取單一文件詳情"""
     try:
-        docs = search_service.mysql.get_document_details([doc_id])
-        if not docs:
+        docs = await search_service.get_documents([doc_id])
+        doc = docs.get(doc_id)
+        if not doc:
             raise HTTPException(status_code=404, detail="文件不存在")
 
-        doc = docs[0]
-        file_path = doc.get("file_path") or doc.get("file_name")
-        if file_path:
-            doc["file_url"] = search_service.file_handler.generate_file_url(file_path)
-            doc["download_url"] = doc["file_url"]
-
         return {
             "success": True,
             "document": doc,
-            "related_documents": doc.get("related_doc_numbers", []),
+            "related_documents": doc.get("related_doc_numbers") or [],
         }
     except HTTPException:
         raise
@@ -1020,6 +3847,32 @@ async def get_document(doc_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/documents")
+async def get_documents(ids: str = Query(..., description="以逗號分隔的 doc_id")):
+    """
+    批次獲取文件詳情
+
+    documents 依 ids 順序排列，查無的 doc_id 列於 missing。
+    """
+    doc_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not doc_ids:
+        raise HTTPException(status_code=400, detail="請提供 ids")
+    if len(doc_ids) > DOCUMENT_BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"一次最多 {DOCUMENT_BATCH_MAX_IDS} 個文件"
+        )
+    try:
+        docs = await search_service.get_documents(doc_ids)
+        return {
+            "success": True,
+            "documents": [docs[doc_id] for doc_id in doc_ids if doc_id in docs],
+            "missing": [doc_id for doc_id in doc_ids if doc_id not in docs],
+        }
+    except Exception as e:
+        logger.error(f"批次獲取文件失敗: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("=" * 50)
@@ -1030,13 +3883,14 @@ async def startup_event():
     logger.info(f"文件服務: {FILE_SERVICE_PUBLIC_URL}")
     logger.info(f"GPT Model: {GPT_MODEL if search_service.gpt_client else 'Disabled'}")
     logger.info("=" * 50)
+    status_monitor.start()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("文件管理 RAG API 服務關閉")
-    if search_service.mysql.connection:
-        search_service.mysql.connection.close()
+    await status_monitor.stop()
+    await search_service.aclose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+"""
+查詢斷詞
+
+以 IK 字典（config/analysis-ik：IKAnalyzer.cfg.xml 列出的 ext_dict / ext_stopwords，
+目錄中若有 main.dic 也一併載入）與 MySQL 的品名、客戶名稱建立字元 trie，
+對查詢做正向最大匹配：字典詞與英數代碼直接成為關鍵字，停用詞作為分隔，
+字典外的中文片段短者保留、過長者切成雙字（對齊 MySQL ngram_token_size=2）。
+查詢與字典詞皆先做 NFKC 正規化（與 identifiers 相同），全形英數代碼也能成為關鍵字。
+
+字典檔只在啟動時讀取一次；資料庫名稱另存一棵 trie，以 with_terms() 產生新實例替換，
+查詢中的斷詞不受重建影響。
+"""
+
+import logging
+import os
+import re
+import unicodedata
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 查詢常見的指示用語（IK stopwords.txt 之外）
+QUERY_STOP_WORDS = (
+    "的", "是", "在", "和", "將", "或", "有", "為", "等", "了", "請", "所有",
+    "來", "出", "未來", "改善", "統整", "列出", "與", "及", "哪些", "整理",
+)
+
+_END = ""  # trie 節點的詞尾標記（不會與單一字元衝突）
+_WORD, _STOP = 1, 2
+_CODE = re.compile(r"[A-Za-z0-9]+(?:[-_.][A-Za-z0-9]+)*")
+_CJK = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+_TERM_SPLIT = re.compile(r"[\s,，、;；/|()（）\[\]【】:：*\"'“”]+")
+
+
+def _read_words(path: str) -> List[str]:
+    """讀取一行一詞的字典檔（忽略空行與 # 註解）"""
+    words = []
+    try:
+        with open(path, "r", encoding="utf-8-sig") as f:
+            for line in f:
+                word = line.strip()
+                if word and not word.startswith("#"):
+                    words.append(word)
+    except OSError as e:
+        logger.warning(f"⚠️ 無法讀取字典 {path}: {e}")
+    return words
+
+
+def _ik_entries(config_dir: str) -> Dict[str, List[str]]:
+    """解析 IKAnalyzer.cfg.xml，回傳 {ext_dict: [...], ext_stopwords: [...]}"""
+    entries = {"ext_dict": [], "ext_stopwords": []}
+    cfg_path = os.path.join(config_dir, "IKAnalyzer.cfg.xml")
+    try:
+        root = ET.parse(cfg_path).getroot()
+    except (OSError, ET.ParseError) as e:
+        logger.warning(f"⚠️ 無法解析 {cfg_path}: {e}")
+        return entries
+    for entry in root.iter("entry"):
+        key = entry.get("key")
+        if key in entries and entry.text:
+            entries[key] = [
+                os.path.join(config_dir, name.strip())
+                for name in entry.text.split(";")
+                if name.strip()
+            ]
+    return entries
+
+
+def lexicon_terms(names: Iterable[str], max_length: int = 20) -> List[str]:
+    """
+    將品名、客戶名稱整理成字典詞
+
+    名稱以空白與標點切開，保留含中文、長度 2..max_length 的片段
+    （OCR 欄位常混入雜訊，整串名稱很少與查詢完全相同）。
+    """
+    terms = set()
+    for name in names:
+        for part in _TERM_SPLIT.split(str(name or "")):
+            part = part.strip("-_.")
+            if 2 <= len(part) <= max_length and _CJK.search(part):
+                terms.add(part)
+    return sorted(terms)
+
+
+class QuerySegmenter:
+    """字元 trie 正向最大匹配斷詞器"""
+
+    def __init__(
+        self,
+        words: Iterable[str] = (),
+        stop_words: Iterable[str] = (),
+        unknown_max_length: int = 6,
+        _base: Optional[Dict] = None,
+    ):
+        self.unknown_max_length = unknown_max_length
+        if _base is None:
+            _base = {}
+            self._insert(_base, stop_words, _STOP)
+            self._insert(_base, words, _WORD)
+        self._base = _base
+        self._terms: Dict = {}
+        self.term_count = 0
+
+    @classmethod
+    def from_ik_config(
+        cls, config_dir: str, extra_files: Iterable[str] = (), **kwargs
+    ) -> "QuerySegmenter":
+        """由 IK 設定目錄建立；extra_files 為只供查詢端使用的字典（不影響 ES 分詞）"""
+        entries = _ik_entries(config_dir)
+        dict_files = list(entries["ext_dict"])
+        main_dic = os.path.join(config_dir, "main.dic")
+        if os.path.exists(main_dic):
+            dict_files.insert(0, main_dic)
+        dict_files.extend(extra_files)
+
+        words = [w for path in dict_files for w in _read_words(path)]
+        stop_words = [w for path in entries["ext_stopwords"] for w in _read_words(path)]
+        stop_words.extend(QUERY_STOP_WORDS)
+        segmenter = cls(words, stop_words, **kwargs)
+        logger.info(
+            f"📖 斷詞字典載入: {len(words)} 詞、{len(set(stop_words))} 停用詞"
+            f"（{', '.join(os.path.basename(p) for p in dict_files) or '無字典檔'}）"
+        )
+        return segmenter
+
+    @staticmethod
+    def _insert(trie: Dict, words: Iterable[str], kind: int) -> int:
+        count = 0
+        for word in words:
+            word = unicodedata.normalize("NFKC", word).strip().lower()
+            if not word:
+                continue
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            # 同一詞同時出現在字典與停用詞時以字典為準
+            node[_END] = max(node.get(_END, 0), kind)
+            count += 1
+        return count
+
+    def with_terms(self, terms: Iterable[str]) -> "QuerySegmenter":
+        """回傳共用字典 trie、另含資料庫名稱的新實例"""
+        segmenter = QuerySegmenter(
+            unknown_max_length=self.unknown_max_length, _base=self._base
+        )
+        segmenter.term_count = self._insert(segmenter._terms, terms, _WORD)
+        return segmenter
+
+    def _longest_match(self, text: str, start: int) -> Tuple[int, int]:
+        """回傳 (詞長, 類型)；無匹配時為 (0, 0)"""
+        best = (0, 0)
+        for trie in (self._base, self._terms):
+            node = trie
+            for i in range(start, len(text)):
+                node = node.get(text[i])
+                if node is None:
+                    break
+                kind = node.get(_END)
+                if kind and i + 1 - start > best[0]:
+                    best = (i + 1 - start, kind)
+        return best
+
+    def segment(self, text: str) -> List[Tuple[str, str]]:
+        """
+        斷詞
+
+        Returns:
+            [(詞, 類型)]，類型為 word（字典詞）/ code（英數代碼）/ unknown（字典外中文）
+        """
+        tokens: List[Tuple[str, str]] = []
+        text = unicodedata.normalize("NFKC", text or "")
+        lowered = text.lower()
+        unknown_start = None
+
+        def flush(end: int):
+            nonlocal unknown_start
+            if unknown_start is None:
+                return
+            run = text[unknown_start:end]
+            unknown_start = None
+            if len(run) <= self.unknown_max_length:
+                tokens.append((run, "unknown"))
+            else:
+                # 重疊 bigram：奇數長度不漏尾字、跨切點的組合也保留；數量由 keywords 的 limit 控制
+                tokens.extend(
+                    (run[i : i + 2], "unknown") for i in range(len(run) - 1)
+                )
+
+        i = 0
+        while i < len(text):
+            length, kind = self._longest_match(lowered, i)
+            code = _CODE.match(text, i) if text[i].isascii() else None
+            if code and code.end() - i >= length:
+                flush(i)
+                tokens.append((code.group(), "code"))
+                i = code.end()
+            elif length:
+                flush(i)
+                if kind == _WORD:
+                    tokens.append((text[i : i + length], "word"))
+                i += length
+            elif _CJK.match(text[i]):
+                if unknown_start is None:
+                    unknown_start = i
+                i += 1
+            else:
+                flush(i)
+                i += 1
+        flush(len(text))
+        return tokens
+
+    def keywords(self, text: str, limit: int = 10) -> List[str]:
+        """查詢關鍵字：代碼、字典詞、字典外片段依序去重，略過單字元"""
+        order = {"code": 0, "word": 1, "unknown": 2}
+        tokens = sorted(
+            (token for token in self.segment(text) if len(token[0]) >= 2),
+            key=lambda token: order[token[1]],
+        )
+        return list(dict.fromkeys(token for token, _ in tokens))[:limit]
+
+    def stats(self) -> Dict[str, int]:
+        return {"lexicon_terms": self.term_count}
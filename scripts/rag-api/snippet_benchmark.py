@@ -0,0 +1,195 @@
+"""
+片段提取微基準測試
+
+以 csv/ 下的 technical_documents 與 structured_documents 匯出檔為語料，
+比較舊版逐關鍵字掃描（legacy）與 snippets.extract_snippets 的耗時，
+並確認兩者產出的片段相同。precomputed 一列模擬 db-sync 已預先清理全文
+（content_clean / content_lower），只計入查詢時的片段提取成本。
+
+用法：
+    python snippet_benchmark.py [--csv-dir ../../csv] [--rounds 5]
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from snippets import clean_content, extract_snippets
+
+# 一般查詢常見的詞，加在每份文件自身的關鍵字之後
+EXTRA_KEYWORDS = ["異常", "原因", "對策", "品質", "檢驗", "客戶"]
+
+
+# ==================== 舊版實作（對照組） ====================
+def legacy_is_similar(text1: str, text2: str, threshold: float = 0.7) -> bool:
+    if not text1 or not text2:
+        return False
+    clean1 = re.sub(r"[^\w]", "", text1.lower())
+    clean2 = re.sub(r"[^\w]", "", text2.lower())
+    if not clean1 or not clean2:
+        return False
+    if clean1 in clean2 or clean2 in clean1:
+        return True
+    set1 = set(clean1[i : i + 3] for i in range(len(clean1) - 2))
+    set2 = set(clean2[i : i + 3] for i in range(len(clean2) - 2))
+    if not set1 or not set2:
+        return False
+    intersection = len(set1 & set2)
+    union = len(set1 | set2)
+    return (intersection / union if union > 0 else 0) > threshold
+
+
+def legacy_extract(content, summary, keywords, max_snippets=5, snippet_length=500):
+    if not content or not keywords:
+        return []
+    content_clean = clean_content(content, preserve_line_breaks=True)
+    summary_clean = clean_content(summary, preserve_line_breaks=False) if summary else ""
+    snippets = []
+    used_positions = set()
+    for keyword in keywords[: max_snippets * 2]:
+        keyword_lower = keyword.lower()
+        content_lower = content_clean.lower()
+        pos = 0
+        while pos < len(content_lower):
+            pos = content_lower.find(keyword_lower, pos)
+            if pos == -1:
+                break
+            if any(abs(pos - used) < snippet_length // 2 for used in used_positions):
+                pos += 1
+                continue
+            start = max(0, pos - 100)
+            end = min(len(content_clean), pos + snippet_length - 100)
+            snippet = content_clean[start:end]
+            if start > 0:
+                for i in range(min(50, len(snippet))):
+                    if snippet[i] in "。！？\n；":
+                        snippet = snippet[i + 1 :]
+                        break
+                snippet = "..." + snippet
+            if end < len(content_clean):
+                for i in range(len(snippet) - 1, max(0, len(snippet) - 50), -1):
+                    if snippet[i] in "。！？\n；":
+                        snippet = snippet[: i + 1]
+                        break
+                snippet = snippet + "..."
+            snippet = snippet.strip()
+            if legacy_is_similar(snippet, summary_clean):
+                pos += 1
+                continue
+            if any(legacy_is_similar(snippet, existing) for existing in snippets):
+                pos += 1
+                continue
+            if len(snippet.strip(".\n ")) < 20:
+                pos += 1
+                continue
+            snippets.append(snippet)
+            used_positions.add(pos)
+            if len(snippets) >= max_snippets:
+                return snippets
+            pos += 1
+    return snippets
+
+
+# ==================== 新版 ====================
+def engine_extract(content, summary, keywords, max_snippets=5, snippet_length=500):
+    if not content or not keywords:
+        return []
+    content_clean = clean_content(content, preserve_line_breaks=True)
+    summary_clean = clean_content(summary, preserve_line_breaks=False) if summary else ""
+    return extract_snippets(content_clean, summary_clean, keywords, max_snippets, snippet_length)
+
+
+def precompute(cases):
+    """模擬 db-sync 預先計算的欄位"""
+    prepared = []
+    for content, summary, keywords in cases:
+        content_clean = clean_content(content, preserve_line_breaks=True)
+        summary_clean = clean_content(summary, preserve_line_breaks=True) if summary else ""
+        prepared.append((content_clean, content_clean.lower(), summary_clean, keywords))
+    return prepared
+
+
+def precomputed_extract(case):
+    content_clean, content_lower, summary_clean, keywords = case
+    return extract_snippets(
+        content_clean, summary_clean, keywords, 5, 500, content_lower=content_lower
+    )
+
+
+# ==================== 語料 ====================
+def load_corpus(csv_dir: str):
+    csv.field_size_limit(sys.maxsize)
+
+    def read(pattern):
+        files = sorted(glob.glob(os.path.join(csv_dir, pattern)))
+        if not files:
+            raise SystemExit(f"找不到 {pattern}（--csv-dir {csv_dir}）")
+        with open(files[-1], encoding="utf-8-sig", newline="") as f:
+            return list(csv.DictReader(f))
+
+    contents = {row["doc_id"]: row["content"] for row in read("technical_documents_*.csv")}
+    cases = []
+    for row in read("structured_documents_*.csv"):
+        content = contents.get(row["original_doc_id"])
+        if not content:
+            continue
+        try:
+            keywords = json.loads(row.get("keywords") or "[]")
+        except json.JSONDecodeError:
+            keywords = []
+        cases.append((content, row.get("summary") or "", keywords + EXTRA_KEYWORDS))
+    return cases
+
+
+def run(extract, cases, rounds):
+    best = float("inf")
+    outputs = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        outputs = [extract(*case) for case in cases]
+        best = min(best, time.perf_counter() - started)
+    return best, outputs
+
+
+def main():
+    default_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "csv")
+    parser = argparse.ArgumentParser(description="片段提取微基準測試")
+    parser.add_argument("--csv-dir", default=default_csv)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = load_corpus(args.csv_dir)
+    total_chars = sum(len(content) for content, _, _ in cases)
+    print(f"語料: {len(cases)} 份文件, {total_chars:,} 字元, 每次取最佳 {args.rounds} 輪")
+
+    legacy_time, legacy_out = run(legacy_extract, cases, args.rounds)
+    engine_time, engine_out = run(engine_extract, cases, args.rounds)
+    prepared = [(case,) for case in precompute(cases)]
+    precomputed_time, precomputed_out = run(precomputed_extract, prepared, args.rounds)
+
+    mismatches = sum(
+        1
+        for a, b, c in zip(legacy_out, engine_out, precomputed_out)
+        if not (a == b == c)
+    )
+    for name, elapsed in (
+        ("legacy", legacy_time),
+        ("engine", engine_time),
+        ("precomputed", precomputed_time),
+    ):
+        print(
+            f"{name:<12}: {elapsed * 1000:9.1f} ms  "
+            f"({elapsed / len(cases) * 1000:.2f} ms/doc, {legacy_time / elapsed:.1f}x)"
+        )
+    print(f"輸出不一致: {mismatches} 份")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+內容片段提取
+
+對每份文件只做一次多關鍵字掃描（Aho-Corasick），以排序後的位置表檢查片段重疊，
+並以快取的 trigram shingle 集合判斷片段與摘要／既有片段是否近似重複。
+"""
+
+import re
+from bisect import bisect_left, insort
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+SENTENCE_BOUNDARIES = "。！？\n；"
+_NON_WORD = re.compile(r"[^\w]")
+
+
+def clean_content(text: str, preserve_line_breaks: bool = True) -> str:
+    """清理文本中的無用標記"""
+    if not text:
+        return text
+
+    # 移除頁碼標記
+    text = re.sub(r"\[第\s*\d+\s*頁\]", "", text)
+    text = re.sub(r"【第\s*\d+\s*頁】", "", text)
+    text = re.sub(r"Page\s+\d+", "", text, flags=re.IGNORECASE)
+
+    if preserve_line_breaks:
+        # 保留換行，只清理多餘空格
+        text = re.sub(r"[ \t]+", " ", text)
+        text = re.sub(r"\n{3,}", "\n\n", text)
+        text = "\n".join(line.strip() for line in text.split("\n"))
+    else:
+        # 合併所有空白字符
+        text = re.sub(r"\s+", " ", text)
+
+    return text.strip()
+
+
+# ==================== 多關鍵字比對 ====================
+class KeywordMatcher:
+    """Aho-Corasick 自動機：一次掃描找出所有關鍵字（含重疊）的出現位置"""
+
+    def __init__(self, patterns: Tuple[str, ...]):
+        self.patterns = patterns
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(index)
+
+        # 回到根節點時，直接跳到下一個可能是關鍵字開頭的字元
+        self._root_chars = re.compile(
+            "[" + "".join(re.escape(c) for c in self._goto[0]) + "]"
+        )
+
+        # BFS 建立失敗連結
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._out[next_state] = (
+                    self._out[next_state] + self._out[self._fail[next_state]]
+                )
+
+    def find_all(self, text: str) -> List[List[int]]:
+        """回傳每個關鍵字的起始位置列表（依位置遞增），索引對應 patterns"""
+        positions: List[List[int]] = [[] for _ in self.patterns]
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        if not self._goto[0]:
+            return positions
+
+        root_search = self._root_chars.search
+        state = 0
+        i = 0
+        length = len(text)
+        while i < length:
+            if not state:
+                match = root_search(text, i)
+                if match is None:
+                    break
+                i = match.start()
+            char = text[i]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in out[state]:
+                positions[index].append(i - len(patterns[index]) + 1)
+            i += 1
+        return positions
+
+
+@lru_cache(maxsize=256)
+def get_matcher(patterns: Tuple[str, ...]) -> KeywordMatcher:
+    """同一查詢的關鍵字在多份文件間共用自動機"""
+    return KeywordMatcher(patterns)
+
+
+# ==================== 近似重複判斷 ====================
+class Fingerprint:
+    """去除標點後的文字與其 trigram 集合，建立一次後重複比對"""
+
+    __slots__ = ("text", "shingles")
+
+    def __init__(self, text: str):
+        self.text = _NON_WORD.sub("", text.lower()) if text else ""
+        self.shingles: FrozenSet[str] = frozenset(
+            self.text[i : i + 3] for i in range(len(self.text) - 2)
+        )
+
+
+@lru_cache(maxsize=1024)
+def cached_fingerprint(text: str) -> Fingerprint:
+    """摘要等重複出現的文字共用指紋"""
+    return Fingerprint(text)
+
+
+def is_similar(a: Fingerprint, b: Fingerprint, threshold: float = 0.7) -> bool:
+    """包含關係或 trigram Jaccard 相似度超過門檻即視為重複"""
+    if not a.text or not b.text:
+        return False
+
+    if a.text in b.text or b.text in a.text:
+        return True
+
+    if not a.shingles or not b.shingles:
+        return False
+
+    intersection = len(a.shingles & b.shingles)
+    union = len(a.shingles) + len(b.shingles) - intersection
+    return union > 0 and intersection / union > threshold
+
+
+# ==================== 片段提取 ====================
+def _cut_snippet(content: str, pos: int, snippet_length: int) -> str:
+    """以關鍵字位置為中心切出片段，並對齊句子邊界"""
+    start = max(0, pos - 100)
+    end = min(len(content), pos + snippet_length - 100)
+    snippet = content[start:end]
+
+    if start > 0:
+        for i in range(min(50, len(snippet))):
+            if snippet[i] in SENTENCE_BOUNDARIES:
+                snippet = snippet[i + 1 :]
+                break
+        snippet = "..." + snippet
+
+    if end < len(content):
+        for i in range(len(snippet) - 1, max(0, len(snippet) - 50), -1):
+            if snippet[i] in SENTENCE_BOUNDARIES:
+                snippet = snippet[: i + 1]
+                break
+        snippet = snippet + "..."
+
+    return snippet.strip()
+
+
+def extract_snippets(
+    content_clean: str,
+    summary_clean: str,
+    keywords: List[str],
+    max_snippets: int = 3,
+    snippet_length: int = 400,
+    content_lower: Optional[str] = None,
+) -> List[str]:
+    """
+    從已清理的內容提取不重複的關鍵字片段
+
+    依關鍵字順序、再依出現位置挑選片段；與已選位置距離小於
+    snippet_length // 2、與摘要或已選片段近似、或過短的候選會被略過。
+
+    Args:
+        content_clean: clean_content(preserve_line_breaks=True) 後的內容
+        summary_clean: 清理後的摘要（去除標點與空白後比對，換行保留與否皆可）
+        keywords: 關鍵字列表（只取前 max_snippets * 2 個）
+        max_snippets: 最大片段數
+        snippet_length: 每個片段長度
+        content_lower: content_clean.lower()，db-sync 已預先計算時直接傳入
+
+    Returns:
+        不重複的內容片段列表
+    """
+    if not content_clean or not keywords:
+        return []
+
+    # 重複的關鍵字不會產生新片段，去重後建立自動機
+    patterns = tuple(
+        dict.fromkeys(k.lower() for k in keywords[: max_snippets * 2] if k)
+    )
+    if not patterns:
+        return []
+
+    if content_lower is None or len(content_lower) != len(content_clean):
+        content_lower = content_clean.lower()
+    occurrences = get_matcher(patterns).find_all(content_lower)
+
+    summary_fp = cached_fingerprint(summary_clean) if summary_clean else None
+    radius = snippet_length // 2
+    used_positions: List[int] = []
+    snippets: List[str] = []
+    accepted: List[Fingerprint] = []
+
+    for positions in occurrences:
+        for pos in positions:
+            # 與已選位置重疊（排序後只需檢查左右鄰居）
+            i = bisect_left(used_positions, pos)
+            if i < len(used_positions) and used_positions[i] - pos < radius:
+                continue
+            if i > 0 and pos - used_positions[i - 1] < radius:
+                continue
+
+            snippet = _cut_snippet(content_clean, pos, snippet_length)
+            if len(snippet.strip(".\n ")) < 20:
+                continue
+
+            fp = Fingerprint(snippet)
+            if summary_fp is not None and is_similar(fp, summary_fp):
+                continue
+            if any(is_similar(fp, existing) for existing in accepted):
+                continue
+
+            snippets.append(snippet)
+            accepted.append(fp)
+            insort(used_positions, pos)
+
+            if len(snippets) >= max_snippets:
+                return snippets
+
+    return snippets
@@ -12,18 +12,14 @@ from typing import List, Dict, Any, Optional, Tuple
 from requests.auth import HTTPBasicAuth
 import logging
 
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
+# 與 rag-api 共用（compose 將 scripts/rag-api/embeddings.py 掛載到 PYTHONPATH）
+from embeddings import EmbeddingProvider, build_provider
 
 # ========== 環境變數 ==========
 ES_URL = os.environ.get("ES_URL", "http://localhost:9200")
 ES_USER = os.environ.get("ES_USER", "elastic")
 ES_PASS = os.environ.get("ES_PASS", "admin@12345")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
-EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "openai")
 INDEX_PATTERN = os.environ.get("INDEX_PATTERN", "erp-*")
 BATCH_SIZE = int(os.environ.get("VECTOR_BATCH_SIZE", "100"))
 SLEEP_SEC = int(os.environ.get("SLEEP", "10"))
@@ -48,10 +44,6 @@ session = requests.Session()
 if ES_USER and ES_PASS:
     session.auth = HTTPBasicAuth(ES_USER, ES_PASS)
 
-client: Optional[OpenAI] = None
-if OPENAI_API_KEY and OpenAI is not None:
-    client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-
 _SHOULD_STOP = False
 
 # ========== 工具方法 ==========
@@ -122,31 +114,18 @@ def _is_finite_vector(vec: Optional[List[float]], dims: int) -> bool:
 class VectorGenerator:
     """向量生成器"""
     
-    def __init__(self, model: str):
-        self.model = model
-        if "text-embedding-3-large" in model:
-            self.dimension = 3072
-        else:
-            self.dimension = 1536
+    def __init__(self, provider: EmbeddingProvider):
+        self.provider = provider
+        self.dimension = provider.dimension
     
     def generate(self, text: str) -> Optional[List[float]]:
-        if client is None:
-            log("❌ OpenAI client 未初始化")
-            return None
         try:
-            resp = client.embeddings.create(
-                model=self.model,
-                input=text[:8000],
-                encoding_format="float",
-            )
-            return resp.data[0].embedding
+            return self.provider.embed([text[:8000]])[0]
         except Exception as e:
             log(f"⚠️ 向量生成失敗：{e}")
             return None
     
     def batch_generate(self, texts: List[str]) -> List[Optional[List[float]]]:
-        if client is None:
-            return [None for _ in texts]
         
         # 預處理
         processed: List[str] = []
@@ -167,13 +146,8 @@ class VectorGenerator:
             return [None for _ in texts]
         
         try:
-            resp = client.embeddings.create(
-                model=self.model,
-                input=inputs,
-                encoding_format="float",
-            )
             result: List[Optional[List[float]]] = [None for _ in texts]
-            for out_vec, orig_idx in zip([d.embedding for d in resp.data], idx_map):
+            for out_vec, orig_idx in zip(self.provider.embed(inputs), idx_map):
                 result[orig_idx] = out_vec
             return result
         except Exception as e:
@@ -190,40 +164,66 @@ class ElasticsearchVectorUpdater:
         self.index_pattern = INDEX_PATTERN
         self.dims = vector_gen.dimension
         self.session = requests.Session()
+        self._mapped_indices = set()
+        # 既有向量由其他提供者 / 模型產生的索引：不再寫入，也不列入待處理
+        self.incompatible_indices = set()
     
-    def _list_indices(self, index_pattern: str) -> List[str]:
-        try:
-            r = http_get(f"{ES_URL}/_cat/indices/{index_pattern}", params={"format": "json"})
-            if r.ok:
-                return [row["index"] for row in r.json()]
-        except Exception:
-            pass
+    def _get_mappings(self, index_pattern: str) -> Dict[str, Any]:
         try:
-            r = http_get(f"{ES_URL}/{index_pattern}")
+            r = http_get(f"{ES_URL}/{index_pattern}/_mapping")
             if r.ok and isinstance(r.json(), dict):
-                return list(r.json().keys())
-        except Exception:
-            pass
-        return []
-    
+                return r.json()
+        except Exception as e:
+            log(f"⚠️ 讀取索引映射失敗：{e}")
+        return {}
+
     def update_index_mapping(self, index_pattern: str = INDEX_PATTERN) -> None:
-        """更新索引映射，添加向量欄位"""
-        mapping_update = {
-            "properties": {
-                "content_vector": {
-                    "type": "dense_vector",
-                    "dims": self.vector_gen.dimension,
-                    "index": True,
-                    "similarity": "cosine",
-                },
-                "vector_generated_at": {"type": "date"},
-            }
-        }
-        indices = self._list_indices(index_pattern)
-        if not indices:
-            log(f"ℹ️ 未找到符合的索引：{index_pattern}")
+        """
+        更新索引映射：添加向量欄位，並在 _meta.embedding 記錄向量提供者
+
+        每輪重新讀取 mapping（db-sync 重建的索引也會補上）。_meta 以 PUT 整個取代，
+        因此先與既有內容（例如 db-sync 的 passage_schema）合併再寫入。
+        既有向量與目前提供者不一致的索引記為不相容，不再寫入向量。
+        """
+        signature = self.vector_gen.provider.signature()
+        mappings = self._get_mappings(index_pattern)
+        if not mappings:
+            if not self._mapped_indices:
+                log(f"ℹ️ 未找到符合的索引：{index_pattern}")
             return
-        for index in indices:
+
+        for index, body in mappings.items():
+            mapping = body.get("mappings", {})
+            meta = mapping.get("_meta", {}) or {}
+            vector_field = mapping.get("properties", {}).get("content_vector")
+            dims = vector_field.get("dims") if vector_field else None
+
+            if not self.vector_gen.provider.compatible_with(meta.get("embedding"), dims):
+                if index not in self.incompatible_indices:
+                    self.incompatible_indices.add(index)
+                    log(
+                        f"❌ 索引 {index} 的向量來源 {meta.get('embedding') or f'{dims} 維（未記錄）'} "
+                        f"與目前 {signature} 不一致，略過此索引；"
+                        f"請刪除索引並清除 db-sync 狀態後重新同步"
+                    )
+                continue
+            self.incompatible_indices.discard(index)
+
+            if vector_field and meta.get("embedding") == signature:
+                self._mapped_indices.add(index)
+                continue
+
+            mapping_update: Dict[str, Any] = {"_meta": {**meta, "embedding": signature}}
+            if not vector_field:
+                mapping_update["properties"] = {
+                    "content_vector": {
+                        "type": "dense_vector",
+                        "dims": self.vector_gen.dimension,
+                        "index": True,
+                        "similarity": "cosine",
+                    },
+                    "vector_generated_at": {"type": "date"},
+                }
             try:
                 r = session.put(
                     f"{ES_URL}/{index}/_mapping",
@@ -231,12 +231,13 @@ class ElasticsearchVectorUpdater:
                     timeout=REQUESTS_TIMEOUT,
                 )
                 if r.ok:
+                    self._mapped_indices.add(index)
                     log(f"✅ 已更新索引映射：{index}")
                 else:
                     log(f"⚠️ 更新索引映射失敗：{index} {r.status_code}")
             except Exception as e:
                 log(f"⚠️ 索引 {index} 映射更新例外：{e}")
-    
+
     def find_documents_without_vectors(self, index_pattern: str = INDEX_PATTERN, 
                                       size: int = 100) -> List[Dict[str, Any]]:
         """搜尋尚未建立 content_vector 的文件"""
@@ -246,8 +247,10 @@ class ElasticsearchVectorUpdater:
             "query": {"bool": {"must_not": [{"exists": {"field": "content_vector"}}]}},
             "sort": [{"_doc": "asc"}],
         }
+        # 排除不相容的索引（萬用字元後接 -索引名）
+        target = ",".join([index_pattern] + [f"-{i}" for i in sorted(self.incompatible_indices)])
         try:
-            r = http_post(f"{ES_URL}/{index_pattern}/_search", json_body=query)
+            r = http_post(f"{ES_URL}/{target}/_search", json_body=query)
             if r.ok:
                 body = r.json()
                 hits = body.get("hits", {}).get("hits", [])
@@ -273,6 +276,8 @@ class ElasticsearchVectorUpdater:
             return self._extract_fmea_text(source)
         elif 'document' in index_name:
             return self._extract_structured_document_text(source)
+        elif 'passage' in index_name:
+            return self._extract_passage_text(source)
         else:
             return self._extract_generic_text(source)
     
@@ -474,6 +479,19 @@ class ElasticsearchVectorUpdater:
         
         return ' '.join(filter(None, parts))
     
+    def _extract_passage_text(self, source: Dict) -> str:
+        """提取 technical_documents 段落的文本"""
+        parts = []
+
+        # 檔名提供文件脈絡（單號多半在檔名中）
+        if source.get('file_name'):
+            parts.append(source['file_name'].replace('.pdf', ''))
+
+        if source.get('content'):
+            parts.append(source['content'])
+
+        return ' '.join(filter(None, parts))
+
     def _extract_generic_text(self, source: Dict) -> str:
         """通用文本提取 (備用)"""
         priority_fields = [
@@ -605,11 +623,10 @@ def _handle_sigterm(signum, frame):
 
 # ========== 主流程 ==========
 def main() -> None:
-    if not OPENAI_API_KEY:
-        log("❌ 未設置 OPENAI_API_KEY")
-        return
-    if client is None:
-        log("❌ OpenAI 套件未正確安裝")
+    try:
+        provider = build_provider()
+    except RuntimeError as e:
+        log(f"❌ 向量提供者 {EMBEDDING_PROVIDER} 無法使用：{e}")
         return
     
     signal.signal(signal.SIGTERM, _handle_sigterm)
@@ -617,7 +634,7 @@ def main() -> None:
     
     log("=" * 60)
     log("🚀 向量服務啟動")
-    log(f"📊 模型：{EMBEDDING_MODEL}")
+    log(f"📊 向量提供者：{provider.signature()}")
     log(f"🔍 索引模式：{INDEX_PATTERN}")
     log(f"📦 批次大小：{BATCH_SIZE}")
     log(f"🤖 自動停止：{'啟用' if AUTO_STOP_ENABLED else '停用'}")
@@ -632,7 +649,7 @@ def main() -> None:
         log(f"❌ 等待 Elasticsearch 失敗：{e}")
         return
     
-    vg = VectorGenerator(EMBEDDING_MODEL)
+    vg = VectorGenerator(provider)
     updater = ElasticsearchVectorUpdater(vg)
     updater.update_index_mapping(INDEX_PATTERN)
     
@@ -643,6 +660,8 @@ def main() -> None:
     
     while not _SHOULD_STOP:
         try:
+            # db-sync 之後才建立的索引（例如段落索引）也要先設定向量欄位
+            updater.update_index_mapping(INDEX_PATTERN)
             docs = updater.find_documents_without_vectors(INDEX_PATTERN, size=BATCH_SIZE)
             if docs:
                 # 找到文檔，重置空輪計數器
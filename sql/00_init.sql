@@ -18,6 +18,8 @@ CREATE TABLE IF NOT EXISTS technical_documents (
     
     -- 全文內容 (供全文檢索)
     content LONGTEXT COMMENT '文檔全文內容',
+    content_clean LONGTEXT COMMENT '清理後全文（db-sync 預先計算）',
+    content_lower LONGTEXT COMMENT '清理後全文小寫版（關鍵字比對用）',
     
     -- 時間戳記
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP COMMENT '建立時間',
@@ -26,7 +28,8 @@ CREATE TABLE IF NOT EXISTS technical_documents (
     -- 索引
     INDEX idx_doc_type (doc_type),
     INDEX idx_created_at (created_at),
-    FULLTEXT idx_content (content)
+    INDEX idx_last_modified (last_modified),
+    FULLTEXT idx_content (content) WITH PARSER ngram
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
 COMMENT='技術文件主表 - 存放PDF原始資料';
 
@@ -265,6 +268,8 @@ CREATE TABLE IF NOT EXISTS structured_documents (
     INDEX idx_doc_number (doc_number),
     INDEX idx_doc_type (doc_type),
     INDEX idx_last_modified (last_modified),
+    INDEX idx_product_codes ((CAST(product_codes AS CHAR(100) ARRAY))),
+    FULLTEXT idx_summary (summary) WITH PARSER ngram,
     FOREIGN KEY (original_doc_id) REFERENCES technical_documents(doc_id) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
 COMMENT='結構化文件摘要表';
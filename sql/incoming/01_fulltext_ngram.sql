@@ -0,0 +1,40 @@
+-- ============================================================================
+-- 遷移：FULLTEXT 索引改用 ngram parser
+-- 用途：讓 rag-api 以 MATCH ... AGAINST 取代 LIKE '%kw%' 搜尋中文內容
+-- 可重複執行：索引存在時先刪除再重建
+-- ============================================================================
+USE fuhsin_erp_demo;
+
+-- technical_documents.content：預設 parser 無法切分中文，改為 ngram
+SET @idx_exists := (
+    SELECT COUNT(*) FROM information_schema.statistics
+    WHERE table_schema = DATABASE()
+      AND table_name = 'technical_documents'
+      AND index_name = 'idx_content'
+);
+SET @ddl := IF(@idx_exists > 0,
+    'ALTER TABLE technical_documents DROP INDEX idx_content',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+ALTER TABLE technical_documents
+    ADD FULLTEXT INDEX idx_content (content) WITH PARSER ngram;
+
+-- structured_documents.summary：新增 ngram 全文索引
+SET @idx_exists := (
+    SELECT COUNT(*) FROM information_schema.statistics
+    WHERE table_schema = DATABASE()
+      AND table_name = 'structured_documents'
+      AND index_name = 'idx_summary'
+);
+SET @ddl := IF(@idx_exists > 0,
+    'ALTER TABLE structured_documents DROP INDEX idx_summary',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+ALTER TABLE structured_documents
+    ADD FULLTEXT INDEX idx_summary (summary) WITH PARSER ngram;
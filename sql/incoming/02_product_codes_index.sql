@@ -0,0 +1,19 @@
+-- ============================================================================
+-- 遷移：structured_documents.product_codes 多值索引
+-- 用途：rag-api 以 JSON_OVERLAPS 一次查詢多個品號，不再逐筆 JSON_CONTAINS 全表掃描
+-- 可重複執行：索引已存在時略過
+-- ============================================================================
+USE fuhsin_erp_demo;
+
+SET @idx_exists := (
+    SELECT COUNT(*) FROM information_schema.statistics
+    WHERE table_schema = DATABASE()
+      AND table_name = 'structured_documents'
+      AND index_name = 'idx_product_codes'
+);
+SET @ddl := IF(@idx_exists = 0,
+    'ALTER TABLE structured_documents ADD INDEX idx_product_codes ((CAST(product_codes AS CHAR(100) ARRAY)))',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
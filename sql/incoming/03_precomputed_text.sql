@@ -0,0 +1,32 @@
+-- ============================================================================
+-- 遷移：technical_documents 預先計算的清理後全文
+-- 用途：db-sync 寫入 content_clean / content_lower，rag-api 查詢時直接讀取
+-- 可重複執行：欄位已存在時略過
+-- ============================================================================
+USE fuhsin_erp_demo;
+
+SET @col_exists := (
+    SELECT COUNT(*) FROM information_schema.columns
+    WHERE table_schema = DATABASE()
+      AND table_name = 'technical_documents'
+      AND column_name = 'content_clean'
+);
+SET @ddl := IF(@col_exists = 0,
+    'ALTER TABLE technical_documents ADD COLUMN content_clean LONGTEXT COMMENT ''清理後全文（db-sync 預先計算）'' AFTER content',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+SET @col_exists := (
+    SELECT COUNT(*) FROM information_schema.columns
+    WHERE table_schema = DATABASE()
+      AND table_name = 'technical_documents'
+      AND column_name = 'content_lower'
+);
+SET @ddl := IF(@col_exists = 0,
+    'ALTER TABLE technical_documents ADD COLUMN content_lower LONGTEXT COMMENT ''清理後全文小寫版（關鍵字比對用）'' AFTER content_clean',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
@@ -0,0 +1,19 @@
+-- ============================================================================
+-- 遷移：technical_documents.last_modified 索引
+-- 用途：db-sync 以 last_modified 水位做範圍查詢，不必每輪掃描全表
+-- 可重複執行：索引已存在時略過
+-- ============================================================================
+USE fuhsin_erp_demo;
+
+SET @idx_exists := (
+    SELECT COUNT(*) FROM information_schema.statistics
+    WHERE table_schema = DATABASE()
+      AND table_name = 'technical_documents'
+      AND index_name = 'idx_last_modified'
+);
+SET @ddl := IF(@idx_exists = 0,
+    'ALTER TABLE technical_documents ADD INDEX idx_last_modified (last_modified)',
+    'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
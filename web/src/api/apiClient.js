@@ -187,6 +187,70 @@ export async function postQuery(payload) {
     return mapped
 }
 
+// 串流搜尋 (SSE)：檢索完成先回傳文件，再逐段回傳 GPT 回應
+// handlers: { onDocuments(mapped), onToken(text), onDone(info), onError(detail) }
+// 可傳入 AbortController.signal 於使用者離開時中止
+export async function postQueryStream(payload, handlers = {}, signal) {
+    const body = JSON.stringify({
+        query: String(payload.query || '').trim(),
+        mode: payload.mode || 'hybrid',
+        top_k: Number(payload.top_k ?? 10),
+        use_gpt: Boolean(payload.use_gpt ?? true),
+        doc_type_filter: payload.doc_type_filter || null,
+        date_from: payload.date_from || null,
+        date_to: payload.date_to || null,
+        department: payload.department || null
+    })
+
+    const resp = await fetch(`${API_BASE_URL}/query/stream`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            Accept: 'text/event-stream'
+        },
+        body,
+        signal
+    })
+
+    if (!resp.ok || !resp.body) {
+        const e = new Error(`POST /query/stream 失敗 (${resp.status}) ${resp.statusText}`)
+        e.status = resp.status
+        throw e
+    }
+
+    const reader = resp.body.getReader()
+    const decoder = new TextDecoder('utf-8')
+    let buffer = ''
+
+    const dispatch = (block) => {
+        let event = 'message'
+        const dataLines = []
+        for (const line of block.split('\n')) {
+            if (line.startsWith('event:')) event = line.slice(6).trim()
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim())
+        }
+        if (dataLines.length === 0) return
+        const data = JSON.parse(dataLines.join('\n'))
+
+        if (event === 'documents') handlers.onDocuments?.(mapQueryResponse(data))
+        else if (event === 'token') handlers.onToken?.(data.content)
+        else if (event === 'done') handlers.onDone?.(data)
+        else if (event === 'error') handlers.onError?.(data.detail)
+    }
+
+    while (true) {
+        const { value, done } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+
+        let sep
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            dispatch(buffer.slice(0, sep))
+            buffer = buffer.slice(sep + 2)
+        }
+    }
+}
+
 // 取得單一文件詳情
 export async function getDoc(params = {}) {
     const { id } = params
@@ -205,19 +269,16 @@ export async function getDoc(params = {}) {
     return raw
 }
 
-// 批量取得文件
+// 批量取得文件（一次請求，後端合併成一次資料庫查詢並快取）
 export async function getDocuments(docIds = []) {
     if (!Array.isArray(docIds) || docIds.length === 0) {
         throw new Error('getDocuments 需要提供文件 ID 陣列')
     }
     
-    // 由於後端沒有批量查詢端點，這裡使用 Promise.all 並行查詢
-    const promises = docIds.map(id => getDoc({ id }))
-    const results = await Promise.allSettled(promises)
+    const ids = docIds.map(id => encodeURIComponent(id)).join(',')
+    const raw = await fetchJSON(`/documents?ids=${ids}`, { method: 'GET' })
     
-    return results
-        .filter(r => r.status === 'fulfilled')
-        .map(r => r.value.document)
+    return raw.documents || []
 }
 
 // 導出 API 基礎 URL（用於除錯）